@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+CHECKPOINT_VERSION = 1  # Bumped whenever the contents of a checkpoint change
+CHECKPOINT_FIELDS = ('particles', 'weights', 'log_weights', 'pose', 'stamp')  # Restored from a checkpoint
+
+'''
+  Saving and loading of the particle filter state, so that a restarted filter can pick up
+  where the previous one stopped instead of relocalizing from scratch
+'''
+
+'''
+  Returns the map metadata a checkpoint is only valid for
+    map_info: Info about the map, see nav_msgs/MapMetaData
+'''
+def map_signature(map_info):
+    return np.array([map_info.resolution, map_info.width, map_info.height,
+                     map_info.origin.position.x, map_info.origin.position.y], dtype=np.float64)
+
+'''
+  Writes a checkpoint. The file is written under a temporary name and renamed into place,
+  so a crash while writing never leaves a partial checkpoint behind
+    path: The file to write
+    particles: The Nx3 particles
+    weights: The weights of the particles
+    log_weights: The accumulated log weights of the particles
+    pose: The expected pose of the particles
+    stamp: The time in seconds of the particles
+    map_info: Info about the map the particles are in
+'''
+def save_checkpoint(path, particles, weights, log_weights, pose, stamp, map_info):
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_name = tempfile.mkstemp(suffix='.npz', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, version=CHECKPOINT_VERSION, particles=particles, weights=weights,
+                     log_weights=log_weights, pose=pose, stamp=stamp, wall_time=time.time(),
+                     map=map_signature(map_info))
+        os.rename(tmp_name, path)
+    except Exception:
+        os.remove(tmp_name)
+        raise
+
+'''
+  Reads a checkpoint, if there is a usable one
+    path: The file to read
+    map_info: Info about the map, the checkpoint must have been saved with the same map
+    max_age: The maximum age in seconds of the checkpoint
+    Returns a dict with the particles, weights, log_weights, pose and stamp of the
+    checkpoint, or None if it is missing, unreadable, too old or for another map
+'''
+def load_checkpoint(path, map_info, max_age):
+    if not os.path.exists(path):
+        return None
+    try:
+        data = np.load(path)
+        checkpoint = dict((name, data[name]) for name in data.files)
+        data.close()
+    except (IOError, ValueError, KeyError, zipfile.BadZipfile) as e:
+        print('Ignoring unreadable checkpoint ' + path + ': ' + str(e))
+        return None
+
+    try:
+        if int(checkpoint.get('version', -1)) != CHECKPOINT_VERSION:
+            print('Ignoring checkpoint ' + path + ' of another version')
+            return None
+        if not np.allclose(checkpoint['map'], map_signature(map_info)):
+            print('Ignoring checkpoint ' + path + ' saved with another map')
+            return None
+        age = time.time() - float(checkpoint['wall_time'])
+    except (ValueError, KeyError, TypeError) as e:
+        print('Ignoring malformed checkpoint ' + path + ': ' + str(e))
+        return None
+    missing = [name for name in CHECKPOINT_FIELDS if name not in checkpoint]
+    if missing:
+        print('Ignoring checkpoint ' + path + ' missing ' + ', '.join(missing))
+        return None
+    if age > max_age:
+        print('Ignoring checkpoint ' + path + ' saved %.0f s ago' % age)
+        return None
+    return checkpoint
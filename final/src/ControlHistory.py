@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+from collections import deque
+from threading import Lock
+
+import numpy as np
+
+CONTROL_RATE = 50.0  # Rate (Hz) of the controls, one per VESC state message
+SCAN_RATE = 10.0  # Lowest expected rate (Hz) of the scans that integrate the controls
+STALLED_SCANS = 50  # Consecutive scans that may be missed before controls are dropped
+CONTROL_HISTORY_SIZE = int(np.ceil(CONTROL_RATE / SCAN_RATE * (STALLED_SCANS + 1)))  # Controls kept before the oldest ones are dropped
+
+'''
+  Time-indexed buffer of the controls of the car, so that the particles can be
+  propagated once per scan instead of once per control message.
+  The control recorded at time t_k is taken to have been applied over (t_{k-1}, t_k],
+  like the kinematic motion model does when it is updated on every message, and the
+  last control is held until the next one arrives.
+  If the scans stall for long enough that the buffer fills up, the oldest control is
+  dropped together with the interval it covers, which is then not integrated at all,
+  rather than applying a later control over it.
+'''
+
+
+class ControlHistory:
+
+    '''
+    Initializes an empty history
+      size: The number of controls kept before the oldest ones are dropped
+  '''
+
+    def __init__(self, size=CONTROL_HISTORY_SIZE):
+        self.lock = Lock()
+        self.controls = deque(maxlen=size)  # (stamp, speed, steering) tuples that have not been integrated
+        self.last_control = None  # The most recent control that has been integrated
+        self.integrated_until = None  # The stamp up to which controls have been handed out
+        self.dropped_controls = 0  # The number of controls dropped before they were integrated
+
+    '''
+    Records a control
+      stamp: The time of the control in seconds
+      speed: The speed of the car
+      steering: The steering angle of the car
+  '''
+
+    def add(self, stamp, speed, steering):
+        self.lock.acquire()
+        if self.integrated_until is None:
+            # Like the motion model, start integrating from the first control
+            self.integrated_until = stamp
+            self.last_control = (stamp, speed, steering)
+        elif stamp > self.integrated_until:
+            if len(self.controls) == self.controls.maxlen:
+                # Skip the interval of the oldest control, so that the next one is only
+                # applied over its own interval
+                self.last_control = self.controls.popleft()
+                self.integrated_until = self.last_control[0]
+                self.dropped_controls += 1
+            self.controls.append((stamp, speed, steering))
+        self.lock.release()
+
+    '''
+    Hands out the pieces of constant control between the previous call and stamp
+      stamp: The time in seconds up to which to integrate
+      Returns three arrays (speeds, steerings, durations) with one element per piece.
+      They are empty if there is nothing to integrate
+  '''
+
+    def pieces_until(self, stamp):
+        self.lock.acquire()
+        start = self.integrated_until
+        if start is None or stamp <= start:
+            self.lock.release()
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+
+        pieces = []
+        while len(self.controls) > 0 and self.controls[0][0] <= stamp:
+            control = self.controls.popleft()
+            pieces.append((control[1], control[2], control[0] - start))
+            start = control[0]
+            self.last_control = control
+        if len(self.controls) > 0:
+            # The next control already covers the rest of the interval
+            control = self.controls[0]
+            pieces.append((control[1], control[2], stamp - start))
+        elif stamp > start:
+            # Hold the last control until the next one arrives
+            pieces.append((self.last_control[1], self.last_control[2], stamp - start))
+        self.integrated_until = stamp
+        self.lock.release()
+
+        pieces = np.array(pieces, dtype=np.float64).reshape((-1, 3))
+        return pieces[:, 0], pieces[:, 1], pieces[:, 2]
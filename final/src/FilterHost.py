@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import os
+from threading import Thread
+
+import rospy
+from nav_msgs.srv import GetMap
+
+from MapResources import MapResources
+from ParticleFilter import MAP_TOPIC, ParticleFilter, read_params
+
+'''
+  Hosts several independent particle filters in one process, for example one per car,
+  or parameter variants of the same filter run side by side on the same topics. The
+  filters share the map, its free space, the range method and the sensor model table,
+  which are built once, and each runs its own main loop in its own thread.
+
+  The ~filters parameter lists the names of the filters. Each filter reads its parameters
+  from ~<name>/, falling back to the private parameters of the node, so the shared ones
+  only need to be set once. Unless they are set for a filter, its topics are published
+  under /<name>, it listens to /<name>/initialpose, it does not broadcast a transform,
+  and its checkpoint file name gets _<name> appended.
+'''
+
+'''
+  Creates the filters of the ~filters parameter
+    resources: The MapResources shared by the filters
+    Returns a list of (name, ParticleFilter) pairs
+'''
+def create_filters(resources):
+  filters = []
+  for name in rospy.get_param("~filters"):
+    ns = "~" + name + "/"
+    params = read_params(ns, "~")
+    if not rospy.has_param(ns + "namespace"):
+      params["namespace"] = "/" + name
+    if not rospy.has_param(ns + "initialpose_topic"):
+      params["initialpose_topic"] = params["namespace"] + "/initialpose"
+    if not rospy.has_param(ns + "publish_tf"):
+      params["publish_tf"] = False
+    if params["checkpoint_path"] is not None and not rospy.has_param(ns + "checkpoint_path"):
+      root, ext = os.path.splitext(params["checkpoint_path"])
+      params["checkpoint_path"] = root + "_" + name + ext
+
+    print("Creating filter " + name + " publishing under " + params["namespace"])
+    filters.append((name, ParticleFilter(resources=resources, **params)))
+  return filters
+
+if __name__ == '__main__':
+  rospy.init_node("particle_filter_host", anonymous=True) # Initialize the node
+
+  # Get the map once for every filter
+  print("Getting map from service: ", MAP_TOPIC)
+  rospy.wait_for_service(MAP_TOPIC)
+  resources = MapResources(rospy.ServiceProxy(MAP_TOPIC, GetMap)().map)
+
+  threads = []
+  for name, pf in create_filters(resources):
+    thread = Thread(target=pf.run, name=name)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+
+  rospy.spin()
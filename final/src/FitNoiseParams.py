@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+
+import numpy as np
+import rosbag
+from sensor_msgs.msg import LaserScan
+
+from ControlHistory import ControlHistory
+from NoiseParams import SENSOR_NOISE_PARAMS, save_noise_params
+from RangeMethod import make_range_method
+from Replay import load_log, load_map
+from ScanProcessor import ScanProcessor
+import SensorModel as sm
+from SensorModel import SensorModel, THETA_DISCRETIZATION
+
+'''
+  Offline tool that fits the noise parameters of the sensor and motion models to a
+  recorded log, given reference poses of the car over the log, e.g. from motion capture,
+  the simulator, or a trajectory written by Replay.py --output with a well tuned filter.
+  Noise in the reference poses is absorbed by the fitted noise, so the better they are,
+  the tighter the fit. The result is a parameter file that the particle filter loads at
+  startup through its noise_params parameter, see NoiseParams.py.
+
+    Beam model: Every downsampled ray of every scan is paired with the range ray cast from
+      the reference pose of its scan. Z_HIT, Z_SHORT, Z_MAX, Z_RAND, SIGMA_HIT and
+      LAMDA_SHORT are fit to all pairs at once by expectation maximization, as in
+      CH 6.3 of Probabilistic Robotics.
+    INV_SQUASH_FACTOR: The beam model treats the rays as independent, which makes the
+      likelihood of a scan far too peaked. The reference pose of a sample of scans is
+      scored against poses perturbed around it, and the factor is the one of a grid whose
+      tempered likelihoods give the reference pose the highest average log probability.
+    Motion model: The controls between consecutive scans are split into the same pieces
+      as the filter integrates, and the reference motion is compared to the nominal one.
+      The residual along track, cross track and in heading of every interval is Gaussian
+      under a linearization of the per control noise, with a variance that is linear in
+      the squared KM_*_NOISE std devs. These are found by a refined grid search of the
+      likelihood of every interval, evaluated for a chunk of the grid at a time.
+
+  Usage:
+    python FitNoiseParams.py --map map.yaml --log run.bag --poses reference.csv --output noise.yaml
+    python FitNoiseParams.py --map map.yaml --log run.bag --poses run.bag --pose-topic /car/car_pose ...
+'''
+
+MAX_REFERENCE_GAP = 0.2  # Seconds between reference poses beyond which they are not interpolated
+EM_ITERATIONS = 100  # Maximum iterations of the beam model fit
+EM_TOLERANCE = 1e-7  # Change in the mean log likelihood of a ray at which the beam model fit stops
+MIN_SIGMA_HIT_PX = 0.5  # Lower bound of SIGMA_HIT, below which the table discretization dominates
+MIN_MIXTURE_WEIGHT = 1e-4  # Lower bound of the fitted Z_* weights and LAMDA_SHORT, which must be positive
+SQUASH_GRID = np.logspace(-3, 0, 31)  # Candidate INV_SQUASH_FACTOR values
+MAX_POSITION_RESIDUAL = 1.0  # Meters of motion residual beyond which an interval is an outlier
+MAX_HEADING_RESIDUAL = 0.5  # Radians of motion residual beyond which an interval is an outlier
+MOTION_GRID_SIZE = 10  # Values per noise parameter in each pass of the motion grid search
+MOTION_GRID_PASSES = 3  # Passes of the motion grid search, each zoomed in around the previous best
+MOTION_GRID_CHUNK = 512  # Grid points evaluated at a time
+MOTION_GRID_BOUNDS = np.array([[1e-3, 3.0],  # KM_V_NOISE (m/s)
+                               [1e-4, 0.3],  # KM_DELTA_NOISE (rad)
+                               [1e-4, 0.2],  # KM_X_FIX_NOISE and KM_Y_FIX_NOISE (m)
+                               [1e-4, 0.2]])  # KM_THETA_FIX_NOISE (rad)
+
+'''
+  Reads the reference poses of the car
+    path: A csv of (t, x, y, theta) rows with a header line, as written by Replay.py --output,
+          or a bag with geometry_msgs/PoseStamped messages on pose_topic
+    pose_topic: The topic of the poses in a bag
+    Returns an Nx4 array of (t, x, y, theta) rows sorted by time
+'''
+def read_reference_poses(path, pose_topic):
+    if path.endswith('.bag'):
+        rows = []
+        bag = rosbag.Bag(path)
+        for _, msg, _ in bag.read_messages(topics=[pose_topic]):
+            q = msg.pose.orientation
+            theta = np.arctan2(2 * (q.w * q.z + q.x * q.y), 1 - 2 * (q.y * q.y + q.z * q.z))
+            rows.append((msg.header.stamp.to_sec(), msg.pose.position.x, msg.pose.position.y, theta))
+        bag.close()
+        reference = np.array(rows, dtype=np.float64).reshape((-1, 4))
+    else:
+        reference = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+    if reference.shape[0] < 2:
+        raise ValueError('Need at least two reference poses in ' + path)
+    return reference[np.argsort(reference[:, 0], kind='mergesort')]
+
+'''
+  Interpolates the reference poses at a set of times
+    reference: Nx4 array of (t, x, y, theta) rows sorted by time
+    stamps: The times in seconds
+    Returns (poses, valid), the Mx3 interpolated poses and whether each of them lies
+    between two reference poses at most MAX_REFERENCE_GAP seconds apart
+'''
+def interpolate_poses(reference, stamps):
+    t = reference[:, 0]
+    theta = np.unwrap(reference[:, 3])
+    after = np.clip(np.searchsorted(t, stamps), 1, t.shape[0] - 1)
+    valid = (stamps >= t[0]) & (stamps <= t[-1]) & (t[after] - t[after - 1] <= MAX_REFERENCE_GAP)
+    poses = np.column_stack((np.interp(stamps, t, reference[:, 1]), np.interp(stamps, t, reference[:, 2]),
+                             np.interp(stamps, t, theta)))
+    poses[:, 2] = np.mod(poses[:, 2] + np.pi, 2 * np.pi) - np.pi
+    return poses, valid
+
+'''
+  Returns a LaserScan with the geometry of the scans of a log, whose ranges are set per scan
+    log: A dict of arrays, see Replay.save_log
+'''
+def scan_message(log):
+    msg = LaserScan()
+    msg.angle_min, msg.angle_max, msg.angle_increment, msg.range_max = log['scan_geometry']
+    return msg
+
+'''
+  Pairs every downsampled ray of the scans with the range expected from their reference pose
+    log: A dict of arrays, see Replay.save_log
+    poses: The reference pose of each scan
+    valid: Whether each scan has a reference pose
+    map_msg: The map
+    range_method: The ray casting backend, see RangeMethod.make_range_method
+    laser_ray_step, max_range_meters, scan_reduction: As given to the sensor model
+    Returns (measured, expected), the ranges of every ray in pixels. Invalid beams are
+    kept as max range readings, so that Z_MAX can be fit
+'''
+def beam_pairs(log, poses, valid, map_msg, range_method, laser_ray_step, max_range_meters, scan_reduction):
+    resolution = map_msg.info.resolution
+    max_range_px = int(max_range_meters / resolution)
+    method = make_range_method(map_msg, max_range_px, THETA_DISCRETIZATION, range_method)
+    processor = ScanProcessor(laser_ray_step, False, max_range_meters, scan_reduction)
+
+    msg = scan_message(log)
+    query = np.zeros((1, 3), dtype=np.float32)
+    measured, expected = [], []
+    for i in np.nonzero(valid)[0]:
+        msg.ranges = log['scan_ranges'][i]
+        obs_ranges, obs_angles = processor.process(msg)
+        ranges = np.zeros(obs_angles.shape[0], dtype=np.float32)
+        query[0] = poses[i]
+        method.calc_range_repeat_angles(query, obs_angles, ranges)
+        measured.append(obs_ranges)
+        expected.append(ranges)
+
+    measured = np.clip(np.concatenate(measured) / resolution, 0.0, max_range_px)
+    expected = np.clip(np.concatenate(expected) / resolution, 0.0, max_range_px)
+    return measured.astype(np.float64), expected.astype(np.float64)
+
+'''
+  Fits the beam model of SensorModel.precompute_sensor_model by expectation maximization
+    measured, expected: The measured and expected range of every ray in pixels
+    max_range_px: The max range of the laser in pixels
+    params: The starting values of the parameters, see NoiseParams.SENSOR_NOISE_PARAMS
+    Returns (params, mean log likelihood of a ray). Components the log gives no evidence for,
+    e.g. Z_MAX without max range readings, keep a weight of MIN_MIXTURE_WEIGHT so that the
+    parameter file stays loadable
+'''
+def fit_beam_model(measured, expected, max_range_px, params):
+    z, d = measured, expected
+    # Readings clamped to the last row of the table are max range readings, see ScanLikelihood
+    is_max = (z >= max_range_px).astype(np.float64)
+    shorter = z <= d
+    p_rand = 1.0 / (max_range_px + 1)
+    # Start from the table parameters, converted to a mixture with a proper Gaussian, see below
+    weights = np.array([params['Z_HIT'] / np.sqrt(2), params['Z_SHORT'], params['Z_MAX'], params['Z_RAND']])
+    weights /= weights.sum()
+    sigma = params['SIGMA_HIT'] / np.sqrt(2)
+    lamda = params['LAMDA_SHORT']
+
+    components = np.zeros((4, z.shape[0]))
+    previous = -np.inf
+    for _ in range(EM_ITERATIONS):
+        # E step: the responsibility of each component for each ray
+        components[0] = np.exp(-0.5 * np.square((z - d) / sigma)) / (sigma * np.sqrt(2 * np.pi))
+        components[1] = np.where(shorter, lamda * np.exp(-lamda * z), 0.0)
+        components[2] = is_max
+        components[3] = p_rand
+        components *= weights[:, np.newaxis]
+        total = components.sum(axis=0)
+        log_likelihood = np.mean(np.log(total))
+        components /= total
+
+        # M step
+        weights = components.mean(axis=1)
+        sigma = max(np.sqrt(np.sum(components[0] * np.square(z - d)) / np.sum(components[0])), MIN_SIGMA_HIT_PX)
+        lamda = np.sum(components[1]) / max(np.sum(components[1] * z), 1e-9)
+
+        if log_likelihood - previous < EM_TOLERANCE:
+            break
+        previous = log_likelihood
+
+    weights = np.maximum(weights, MIN_MIXTURE_WEIGHT)
+    weights /= weights.sum()
+    lamda = max(lamda, MIN_MIXTURE_WEIGHT)
+
+    # The hit term of the table is exp(-x^2/SIGMA_HIT^2)/(SIGMA_HIT*sqrt(2*pi)), see
+    # precompute_sensor_model, which is the Gaussian of std dev sigma scaled by 1/sqrt(2)
+    # when SIGMA_HIT = sqrt(2)*sigma. Z_HIT makes up for the scale
+    fitted = dict(params)
+    fitted.update(Z_HIT=np.sqrt(2) * weights[0], Z_SHORT=weights[1], Z_MAX=weights[2], Z_RAND=weights[3],
+                  SIGMA_HIT=np.sqrt(2) * sigma, LAMDA_SHORT=lamda)
+    return fitted, log_likelihood
+
+'''
+  Picks the INV_SQUASH_FACTOR whose tempered scan likelihoods are best calibrated
+    sensor_model: A SensorModel with the fitted beam model
+    log: A dict of arrays, see Replay.save_log
+    poses: The reference pose of each scan
+    valid: Whether each scan has a reference pose
+    num_scans: The number of scans, evenly spread over the log, to score
+    num_perturbations: The number of perturbed poses scored with each reference pose
+    position_std, theta_std: The std devs of the perturbations, similar to the spread of
+                             the particles around the true pose
+    Returns (factor, mean log probability of the reference pose for each SQUASH_GRID value)
+'''
+def fit_squash_factor(sensor_model, log, poses, valid, num_scans, num_perturbations, position_std, theta_std):
+    scans = np.nonzero(valid)[0]
+    scans = scans[np.linspace(0, scans.shape[0] - 1, min(num_scans, scans.shape[0])).astype(int)]
+
+    msg = scan_message(log)
+    scores = np.zeros((scans.shape[0], num_perturbations + 1))
+    candidates = np.zeros((num_perturbations + 1, 3))
+    std = np.array([position_std, position_std, theta_std])
+    for row, i in enumerate(scans):
+        msg.ranges = log['scan_ranges'][i]
+        obs = sensor_model.scan_processor.process(msg)
+        # The reference pose is candidate 0
+        candidates[:] = poses[i]
+        candidates[1:] += np.random.standard_normal((num_perturbations, 3)) * std
+        scores[row] = sensor_model.score_poses(candidates, obs)
+
+    # Log probability of the reference pose among the candidates, for every factor at once
+    tempered = SQUASH_GRID[:, np.newaxis, np.newaxis] * scores[np.newaxis, :, :]
+    peak = tempered.max(axis=2)
+    log_norm = peak + np.log(np.sum(np.exp(tempered - peak[:, :, np.newaxis]), axis=2))
+    calibration = np.mean(tempered[:, :, 0] - log_norm, axis=1)
+    return SQUASH_GRID[np.argmax(calibration)], calibration
+
+'''
+  Returns the speed and steering of every VESC state of a log, as the motion model computes them
+    log: A dict of arrays, see Replay.save_log
+    speed_to_erpm_offset, speed_to_erpm_gain: Conversion params from rpm to speed
+    steering_angle_to_servo_offset, steering_angle_to_servo_gain: Conversion params from
+                                                                  servo position to steering angle
+    Returns (receive times, stamps, speeds, steerings) of the states received after a servo command
+'''
+def log_controls(log, speed_to_erpm_offset, speed_to_erpm_gain,
+                 steering_angle_to_servo_offset, steering_angle_to_servo_gain):
+    # The motion model uses the latest servo command received before each state
+    servo = np.searchsorted(log['servo_t'], log['vesc_t'], side='right') - 1
+    known = servo >= 0
+    speeds = (log['vesc_speed'][known] - speed_to_erpm_offset) / speed_to_erpm_gain
+    steerings = (log['servo_data'][servo[known]] - steering_angle_to_servo_offset) / steering_angle_to_servo_gain
+    return log['vesc_t'][known], log['vesc_stamp'][known], speeds, steerings
+
+'''
+  Compares the reference motion between consecutive scans with the nominal motion of the controls
+    log: A dict of arrays, see Replay.save_log
+    controls: The output of log_controls
+    poses: The reference pose of each scan
+    valid: Whether each scan has a reference pose
+    car_length: The length of the car
+    Returns (residuals, coefficients). residuals is an Mx3 array of the along track, cross
+    track and heading error of each interval, and coefficients an Mx3x4 array such that the
+    variance of each error is coefficients.dot(square of the (KM_V_NOISE, KM_DELTA_NOISE,
+    KM_X_FIX_NOISE, KM_THETA_FIX_NOISE) std devs)
+'''
+def motion_residuals(log, controls, poses, valid, car_length):
+    receive_times, stamps, speeds, steerings = controls
+    history = ControlHistory(size=receive_times.shape[0] + 1)
+    scan_order = np.argsort(log['scan_t'], kind='mergesort')
+
+    residuals, coefficients = [], []
+    next_control = 0
+    previous = None  # Index of the previous scan
+    for i in scan_order:
+        # Controls are recorded in the order they were received, like the live filter does
+        while next_control < receive_times.shape[0] and receive_times[next_control] <= log['scan_t'][i]:
+            history.add(stamps[next_control], speeds[next_control], steerings[next_control])
+            next_control += 1
+        v, delta, dt = history.pieces_until(log['scan_stamp'][i])
+        if previous is None or not (valid[previous] and valid[i]) or dt.shape[0] == 0:
+            previous = i
+            continue
+        start = poses[previous]
+        previous = i
+
+        # Nominal motion of each piece, see KinematicMotionModel.propagate
+        beta = np.arctan(np.tan(delta) / 2)
+        sin_2beta = np.sin(2 * beta)
+        dtheta = v * sin_2beta * dt / car_length
+        half = 0.5 * dtheta
+        chord = np.ones_like(half)
+        curved = np.abs(half) >= 1e-6
+        chord[curved] = np.sin(half[curved]) / half[curved]
+        distance = v * dt * chord
+        heading = start[2] + np.cumsum(dtheta) - dtheta + half
+        end = start + np.array([np.sum(distance * np.cos(heading)), np.sum(distance * np.sin(heading)),
+                                np.sum(dtheta)])
+
+        error = poses[i] - end
+        cos_h, sin_h = np.cos(end[2]), np.sin(end[2])
+        residual = (cos_h * error[0] + sin_h * error[1], -sin_h * error[0] + cos_h * error[1],
+                    np.mod(error[2] + np.pi, 2 * np.pi) - np.pi)
+
+        # Sensitivity of each piece's heading change to its speed and steering noise, and the
+        # distance travelled after each piece, along which a heading error turns into cross track error
+        g_v = sin_2beta * dt / car_length
+        dbeta_ddelta = 0.5 / (np.cos(delta)**2 * (1.0 + 0.25 * np.tan(delta)**2))
+        g_delta = v * dt * 2 * np.cos(2 * beta) * dbeta_ddelta / car_length
+        after = np.sum(distance) - np.cumsum(distance)
+        lever = np.square(after + 0.5 * distance)
+        m = dt.shape[0]
+        coefficients.append([[np.sum(dt**2), 0.0, m, 0.0],
+                             [np.sum(lever * g_v**2), np.sum(lever * g_delta**2), m, np.sum(after**2)],
+                             [np.sum(g_v**2), np.sum(g_delta**2), 0.0, m]])
+        residuals.append(residual)
+
+    return np.array(residuals).reshape((-1, 3)), np.array(coefficients).reshape((-1, 3, 4))
+
+'''
+  Finds the motion noise std devs of highest likelihood by a grid search, refined around
+  the best point of each pass
+    residuals, coefficients: The output of motion_residuals
+    Returns (the std devs of (KM_V_NOISE, KM_DELTA_NOISE, KM_X_FIX_NOISE, KM_THETA_FIX_NOISE),
+    mean log likelihood of an interval)
+'''
+def fit_motion_noise(residuals, coefficients):
+    squared = np.square(residuals)
+    log_bounds = np.log(MOTION_GRID_BOUNDS)
+    best, best_ll = None, -np.inf
+    for _ in range(MOTION_GRID_PASSES):
+        axes = [np.exp(np.linspace(low, high, MOTION_GRID_SIZE)) for low, high in log_bounds]
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape((-1, 4))
+        for start in range(0, grid.shape[0], MOTION_GRID_CHUNK):
+            stds = grid[start:start + MOTION_GRID_CHUNK]
+            # Variance of every error of every interval, for each grid point of the chunk
+            variance = np.einsum('nkp,cp->cnk', coefficients, np.square(stds))
+            ll = -0.5 * np.mean(np.sum(np.log(2 * np.pi * variance) + squared / variance, axis=2), axis=1)
+            j = np.argmax(ll)
+            if ll[j] > best_ll:
+                best, best_ll = stds[j], ll[j]
+        # Zoom in to one step of this pass on either side of the best point
+        step = (log_bounds[:, 1] - log_bounds[:, 0]) / (MOTION_GRID_SIZE - 1)
+        log_bounds = np.column_stack((np.log(best) - step, np.log(best) + step))
+    return best, best_ll
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the sensor and motion noise of the particle filter to a log')
+    parser.add_argument('--log', required=True, help='A .bag, or a .npz written with Replay.py --extract')
+    parser.add_argument('--map', required=True, help="The map's yaml file, as given to map_server")
+    parser.add_argument('--poses', required=True,
+                        help='Reference poses, a (t, x, y, theta) csv like Replay.py --output writes, or a .bag')
+    parser.add_argument('--pose-topic', default='/car/car_pose', help='The PoseStamped topic of a --poses bag')
+    parser.add_argument('--output', required=True, help='The noise parameter file to write')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the perturbed poses')
+    parser.add_argument('--motor-state-topic', default='/car/vesc/sensors/core')
+    parser.add_argument('--servo-state-topic', default='/car/vesc/sensors/servo_position_command')
+    parser.add_argument('--scan-topic', default='/car/scan')
+    parser.add_argument('--laser-ray-step', type=int, default=30)
+    parser.add_argument('--include-max-range-rays', action='store_true')
+    parser.add_argument('--max-range-meters', type=float, default=11.0)
+    parser.add_argument('--range-method', default='cddt')
+    parser.add_argument('--scan-reduction', default='center')
+    parser.add_argument('--squash-scans', type=int, default=200, help='Scans scored to fit INV_SQUASH_FACTOR')
+    parser.add_argument('--squash-perturbations', type=int, default=100,
+                        help='Perturbed poses scored with the reference pose of each of these scans')
+    parser.add_argument('--squash-position-std', type=float, default=0.1)
+    parser.add_argument('--squash-theta-std', type=float, default=0.05)
+    parser.add_argument('--speed-to-erpm-offset', type=float, default=0.0)
+    parser.add_argument('--speed-to-erpm-gain', type=float, default=4350)
+    parser.add_argument('--steering-angle-to-servo-offset', type=float, default=0.5)
+    parser.add_argument('--steering-angle-to-servo-gain', type=float, default=-1.2135)
+    parser.add_argument('--car-length', type=float, default=0.33)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    log = load_log(args.log, args.motor_state_topic, args.servo_state_topic, args.scan_topic)
+    map_msg = load_map(args.map)
+    reference = read_reference_poses(args.poses, args.pose_topic)
+    poses, valid = interpolate_poses(reference, log['scan_stamp'])
+    print('%d of %d scans have a reference pose' % (np.count_nonzero(valid), valid.shape[0]))
+    max_range_px = int(args.max_range_meters / map_msg.info.resolution)
+
+    start = time.time()
+    measured, expected = beam_pairs(log, poses, valid, map_msg, args.range_method, args.laser_ray_step,
+                                    args.max_range_meters, args.scan_reduction)
+    # Start from the defaults of the sensor model
+    params = dict((name, getattr(sm, name)) for name in SENSOR_NOISE_PARAMS)
+    params, ray_ll = fit_beam_model(measured, expected, max_range_px, params)
+    print('Beam model fit to %d rays in %.1f s, mean log likelihood %.3f: '
+          'z_hit %.3f, z_short %.3f, z_max %.3f, z_rand %.3f, sigma_hit %.2f px, lamda_short %.4f /px'
+          % (measured.shape[0], time.time() - start, ray_ll, params['Z_HIT'], params['Z_SHORT'],
+             params['Z_MAX'], params['Z_RAND'], params['SIGMA_HIT'], params['LAMDA_SHORT']))
+
+    start = time.time()
+    sensor_model = SensorModel(None, args.laser_ray_step, not args.include_max_range_rays, args.max_range_meters,
+                               map_msg, np.zeros((1, 3), dtype=np.float32), np.ones(1), range_method=args.range_method,
+                               scan_reduction=args.scan_reduction,
+                               noise_params=params)
+    squash, calibration = fit_squash_factor(sensor_model, log, poses, valid, args.squash_scans,
+                                            args.squash_perturbations, args.squash_position_std,
+                                            args.squash_theta_std)
+    params['INV_SQUASH_FACTOR'] = squash
+    print('INV_SQUASH_FACTOR %.4f in %.1f s, mean log probability of the reference pose %.3f (%.3f uniform)'
+          % (squash, time.time() - start, calibration.max(), -np.log(args.squash_perturbations + 1)))
+
+    start = time.time()
+    controls = log_controls(log, args.speed_to_erpm_offset, args.speed_to_erpm_gain,
+                            args.steering_angle_to_servo_offset, args.steering_angle_to_servo_gain)
+    residuals, coefficients = motion_residuals(log, controls, poses, valid, args.car_length)
+    inliers = ((np.abs(residuals[:, :2]) <= MAX_POSITION_RESIDUAL).all(axis=1) &
+               (np.abs(residuals[:, 2]) <= MAX_HEADING_RESIDUAL))
+    if not inliers.any():
+        raise SystemExit('No interval between scans to fit the motion model to')
+    stds, interval_ll = fit_motion_noise(residuals[inliers], coefficients[inliers])
+    params.update(KM_V_NOISE=stds[0], KM_DELTA_NOISE=stds[1], KM_X_FIX_NOISE=stds[2],
+                  KM_Y_FIX_NOISE=stds[2], KM_THETA_FIX_NOISE=stds[3])
+    print('Motion model fit to %d intervals (%d outliers) in %.1f s, mean log likelihood %.3f: '
+          'v %.4f, delta %.4f, xy %.4f, theta %.4f'
+          % (np.count_nonzero(inliers), np.count_nonzero(~inliers), time.time() - start, interval_ll,
+             stds[0], stds[1], stds[2], stds[3]))
+
+    save_noise_params(args.output, params, ['Fit by FitNoiseParams.py to ' + args.log + ' and ' + args.poses,
+                                            'SIGMA_HIT is in pixels and LAMDA_SHORT per pixel of the map'])
+    print('Wrote ' + args.output)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+from threading import Lock
+
+import numpy as np
+
+from LikelihoodField import LikelihoodField
+from RangeMethod import make_range_method
+from ScanLikelihood import ScanLikelihood
+
+'''
+  The read-only structures derived from a map: its free space, and the range methods,
+  sensor model tables, likelihood fields and likelihood evaluators built on it. Filters
+  created with the same MapResources share one copy of each of them, see FilterHost.py
+'''
+
+
+class MapResources:
+
+    '''
+    Initializes the resources of a map. Every structure is built the first time it is asked for
+      map_msg: A nav_msgs/OccupancyGrid
+  '''
+
+    def __init__(self, map_msg):
+        self.map_msg = map_msg
+        self.map_info = map_msg.info
+        self.lock = Lock()  # Guards the lazily built structures
+        self.permissible_region = None  # True where the map is free, see free_space
+        self.free_cells = None  # The (x, y) pixel of every permissible cell
+        self.range_methods = {}  # Range methods keyed by (max_range_px, theta_discretization, range_method)
+        self.likelihoods = {}  # ScanLikelihoods keyed by the range method key and the table parameters
+        self.likelihood_fields = {}  # LikelihoodFields keyed by (max_range_px, z_hit, z_rand, sigma_hit)
+
+    '''
+    Returns the free space of the map
+      Returns (permissible_region, free_cells). permissible_region is a boolean array of
+      dimension (map_info.height, map_info.width) that is True where the map is free, and
+      free_cells the Nx2 (x, y) pixels of the free cells
+  '''
+
+    def free_space(self):
+        self.lock.acquire()
+        if self.permissible_region is None:
+            array_255 = np.array(self.map_msg.data).reshape((self.map_info.height, self.map_info.width))
+            self.permissible_region = array_255 == 0
+            free_y, free_x = np.nonzero(self.permissible_region)
+            self.free_cells = np.column_stack((free_x, free_y))
+        self.lock.release()
+        return self.permissible_region, self.free_cells
+
+    '''
+    Returns the range method and the log likelihood evaluator for a laser, building them
+    the first time they are asked for
+      max_range_px: The max range of the laser in pixels
+      theta_discretization: The angular discretization of the range method
+      range_method: The ray casting backend, see RangeMethod.make_range_method
+      load_table: Function of max_range_px returning the sensor model table, only called
+                  when the evaluator is built
+      table_params: The parameters the table depends on besides max_range_px. Sensor models
+                    with different parameters share the range method but not the evaluator
+      Returns (range method, ScanLikelihood)
+  '''
+
+    def scan_likelihood(self, max_range_px, theta_discretization, range_method, load_table, table_params=()):
+        method_key = (int(max_range_px), int(theta_discretization), range_method)
+        key = method_key + tuple(table_params)
+        self.lock.acquire()
+        try:
+            if method_key not in self.range_methods:
+                self.range_methods[method_key] = make_range_method(self.map_msg, max_range_px,
+                                                                   theta_discretization, range_method)
+            method = self.range_methods[method_key]
+            if key not in self.likelihoods:
+                table = load_table(max_range_px)
+                method.set_sensor_model(table)
+                self.likelihoods[key] = ScanLikelihood(method, table, max_range_px, self.map_info.resolution)
+            return method, self.likelihoods[key]
+        finally:
+            self.lock.release()
+
+    '''
+    Returns the likelihood field evaluator for a laser, building it the first time it is asked for
+      max_range_px: The max range of the laser in pixels
+      z_hit, z_rand, sigma_hit: The parameters of the field, see LikelihoodField
+      Returns the LikelihoodField
+  '''
+
+    def likelihood_field(self, max_range_px, z_hit, z_rand, sigma_hit):
+        key = (int(max_range_px), z_hit, z_rand, sigma_hit)
+        self.lock.acquire()
+        try:
+            if key not in self.likelihood_fields:
+                self.likelihood_fields[key] = LikelihoodField(self.map_msg, max_range_px, z_hit, z_rand, sigma_hit)
+            return self.likelihood_fields[key]
+        finally:
+            self.lock.release()
@@ -5,7 +5,9 @@ from threading import Lock
 import matplotlib.pyplot as plt
 import numpy as np
 import rospy
-import utils as Utils
+import Utils
+from ControlHistory import ControlHistory
+from PoseHistory import PoseHistory
 from nav_msgs.msg import Odometry
 from std_msgs.msg import Float64
 from vesc_msgs.msg import VescStateStamped
@@ -17,6 +19,18 @@ KM_X_FIX_NOISE = 0.01  # Kinematic car x position constant noise std dev
 KM_Y_FIX_NOISE = 0.01  # Kinematic car y position constant noise std dev
 KM_THETA_FIX_NOISE = 0.01  # Kinematic car theta constant noise std dev
 
+STRAIGHT_LINE_EPS = 1e-6  # Half heading changes (radians) below which a particle moves in a straight line
+
+'''
+  Returns the std devs of the (speed, steering, x, y, theta) noise
+    noise_params: Dict overriding the KM_*_NOISE constants, see NoiseParams.load_noise_params
+'''
+def noise_std(noise_params=None):
+    params = {} if noise_params is None else noise_params
+    return np.array([params.get('KM_V_NOISE', KM_V_NOISE), params.get('KM_DELTA_NOISE', KM_DELTA_NOISE),
+                     params.get('KM_X_FIX_NOISE', KM_X_FIX_NOISE), params.get('KM_Y_FIX_NOISE', KM_Y_FIX_NOISE),
+                     params.get('KM_THETA_FIX_NOISE', KM_THETA_FIX_NOISE)])
+
 '''
   Propagates the particles forward based on the velocity and steering angle of the car
 '''
@@ -28,6 +42,8 @@ class KinematicMotionModel:
       Initializes the kinematic motion model
         motor_state_topic: The topic containing motor state information
         servo_state_topic: The topic containing servo state information    
+          (None for either topic means it is not subscribed to, and the caller
+           passes its messages to servo_cb and motion_cb)
         speed_to_erpm_offset: Offset conversion param from rpm to speed
         speed_to_erpm_gain: Gain conversion param from rpm to speed
         steering_angle_to_servo_offset: Offset conversion param from servo position to steering angle
@@ -35,11 +51,18 @@ class KinematicMotionModel:
         car_length: The length of the car
         particles: The particles to propagate forward
         state_lock: Controls access to particles    
+        max_particles: The largest number of particles that will be propagated, used to size
+                       the scratch buffers. Defaults to the number of particles
+        batch: Whether motion_cb only records the controls in a ControlHistory, and the
+               particles are propagated by propagate_until once per scan
+        noise_params: Dict overriding the KM_*_NOISE constants of this module, e.g. as read
+                      by NoiseParams.load_noise_params. Other keys are ignored
     '''
 
     def __init__(self, motor_state_topic, servo_state_topic, speed_to_erpm_offset,
                  speed_to_erpm_gain, steering_to_servo_offset,
-                 steering_to_servo_gain, car_length, particles, state_lock=None):
+                 steering_to_servo_gain, car_length, particles, state_lock=None, max_particles=None,
+                 batch=False, noise_params=None):
         self.last_servo_cmd = None  # The most recent servo command
         self.last_vesc_stamp = None  # The time stamp from the previous vesc state msg
         self.particles = particles
@@ -52,6 +75,21 @@ class KinematicMotionModel:
         # Gain conversion param from servo position to steering angle
         self.STEERING_TO_SERVO_GAIN = steering_to_servo_gain
         self.CAR_LENGTH = car_length  # The length of the car
+        self.BATCH = batch  # Whether the particles are propagated once per scan
+        self.history = ControlHistory() if batch else None  # Controls that have not been applied yet
+        self.propagated_until = None  # The time in seconds up to which the particles have been propagated
+        self.pose_history = PoseHistory()  # The nominal motion applied to the particles, see motion_since
+        self.on_control = None  # If set, called with (stamp, speed, steering, dt) of every control, see PosePredictor
+
+        # Std devs of the (speed, steering, x, y, theta) noise, drawn together for all particles
+        self.NOISE_STD = noise_std(noise_params)
+        self.allocate_buffers(particles.shape[0] if max_particles is None else max_particles, particles.dtype)
+
+        # Numpy >= 1.17 generators can draw into a preallocated buffer. The generator is
+        # seeded from the global state, so np.random.seed still makes runs repeatable
+        self.rng = None
+        if hasattr(np.random, 'default_rng'):
+            self.rng = np.random.default_rng(np.random.randint(2**31 - 1))
 
         # This just ensures that two different threads are not changing the particles
         # array at the same time. You should not have to deal with this.
@@ -61,11 +99,15 @@ class KinematicMotionModel:
             self.state_lock = state_lock
 
         # This subscriber just caches the most recent servo position command
-        self.servo_pos_sub = rospy.Subscriber(servo_state_topic, Float64,
-                                              self.servo_cb, queue_size=1)
+        self.servo_pos_sub = None
+        if servo_state_topic is not None:
+            self.servo_pos_sub = rospy.Subscriber(servo_state_topic, Float64,
+                                                  self.servo_cb, queue_size=1)
         # Subscribe to the state of the vesc
-        self.motion_sub = rospy.Subscriber(
-            motor_state_topic, VescStateStamped, self.motion_cb, queue_size=1)
+        self.motion_sub = None
+        if motor_state_topic is not None:
+            self.motion_sub = rospy.Subscriber(
+                motor_state_topic, VescStateStamped, self.motion_cb, queue_size=1)
 
     '''
     Caches the most recent servo command
@@ -82,6 +124,19 @@ class KinematicMotionModel:
   '''
 
     def motion_cb(self, msg):
+        if self.BATCH:
+            # Only record the control, propagate_until applies it with the next scan
+            if self.last_servo_cmd is None:
+                return
+            stamp = msg.header.stamp.to_sec()
+            speed = (msg.state.speed - self.SPEED_TO_ERPM_OFFSET) / self.SPEED_TO_ERPM_GAIN
+            steering = (self.last_servo_cmd - self.STEERING_TO_SERVO_OFFSET) / self.STEERING_TO_SERVO_GAIN
+            self.history.add(stamp, speed, steering)
+            if self.on_control is not None and self.last_vesc_stamp is not None:
+                self.on_control(stamp, speed, steering, stamp - self.last_vesc_stamp.to_sec())
+            self.last_vesc_stamp = msg.header.stamp
+            return
+
         self.state_lock.acquire()
         if self.last_servo_cmd is None:
             self.state_lock.release()
@@ -98,6 +153,7 @@ class KinematicMotionModel:
         # YOUR CODE HERE
         curr_speed = (msg.state.speed - self.SPEED_TO_ERPM_OFFSET) / self.SPEED_TO_ERPM_GAIN
         curr_steering = (self.last_servo_cmd - self.STEERING_TO_SERVO_OFFSET) / self.STEERING_TO_SERVO_GAIN
+        dt = float((msg.header.stamp-self.last_vesc_stamp).to_sec())  # time difference
 
         # Propagate particles forward in place
         # Sample control noise and add to nominal control
@@ -108,23 +164,155 @@ class KinematicMotionModel:
         # Vectorize your computations as much as possible
         # All updates to self.particles should be in-place
         # YOUR CODE HERE
-        v = curr_speed + np.random.normal(0.0, KM_V_NOISE, len(self.particles))
-        delta = curr_steering + np.random.normal(0.0, KM_DELTA_NOISE, len(self.particles))
-        sin_2beta = np.sin(2 * np.arctan(np.tan(delta)/2))
-        car_length_div_sin_2beta = self.CAR_LENGTH / sin_2beta
-
-        d_theta = ((v/self.CAR_LENGTH)*sin_2beta) * float((msg.header.stamp-self.last_vesc_stamp).to_sec())  # time difference
-        d_x = car_length_div_sin_2beta * (np.sin(self.particles[:, 2]+d_theta)-np.sin(self.particles[:, 2]))
-        d_y = car_length_div_sin_2beta * (-np.cos(self.particles[:, 2]+d_theta)+np.cos(self.particles[:, 2]))
-
-        self.particles[:, 0] += d_x + np.random.normal(0.0, KM_X_FIX_NOISE, len(self.particles))
-        self.particles[:, 1] += d_y + np.random.normal(0.0, KM_Y_FIX_NOISE, len(self.particles))
-        self.particles[:, 2] += d_theta + np.random.normal(0.0, KM_THETA_FIX_NOISE, len(self.particles))
-        self.particles[:, 2] = np.mod(self.particles[:, 2] + np.pi, 2*np.pi) - np.pi
+        self.propagate(curr_speed, curr_steering, dt)
 
         self.last_vesc_stamp = msg.header.stamp
+        self.propagated_until = msg.header.stamp.to_sec()
+        self.pose_history.add(self.propagated_until, dt, curr_speed * dt,
+                              curr_speed * np.sin(2 * np.arctan(np.tan(curr_steering) / 2)) * dt / self.CAR_LENGTH)
         self.state_lock.release()
 
+        if self.on_control is not None:
+            self.on_control(self.propagated_until, curr_speed, curr_steering, dt)
+
+    '''
+    Applies every control recorded since the previous call, up to a time stamp. The caller
+    must hold state_lock
+    Each piece of constant control moves the particles along its own arc with its own noise,
+    exactly as if the particles had been propagated on every control message
+      stamp: The rospy.Time to bring the particles to, usually the stamp of a scan
+  '''
+
+    def propagate_until(self, stamp):
+        # A scan older than the particles does not move them back, see motion_since
+        if self.propagated_until is None or stamp.to_sec() > self.propagated_until:
+            self.propagated_until = stamp.to_sec()
+        speeds, steerings, durations = self.history.pieces_until(stamp.to_sec())
+        if durations.shape[0] == 0:
+            return
+
+        # Time at which each piece ends
+        ends = stamp.to_sec() - (np.sum(durations) - np.cumsum(durations))
+        sin_2beta = np.sin(2 * np.arctan(np.tan(steerings) / 2))
+        for speed, steering, dt, end, s in zip(speeds, steerings, durations, ends, sin_2beta):
+            if dt <= 0.0:
+                continue
+            self.propagate(speed, steering, dt)
+            self.pose_history.add(end, dt, speed * dt, speed * s * dt / self.CAR_LENGTH)
+
+    '''
+    Returns the nominal motion applied to the particles since a time, so that an observation
+    made at that time can be compared against the particles moved back by it
+    The caller must hold state_lock
+      stamp: The time in seconds
+      max_latency: The most seconds the particles may be ahead of stamp, None for no limit
+      Returns the (dx, dy, dtheta) displacement in the frame of the car at stamp, (0, 0, 0)
+      if the particles are not ahead of stamp, or None if they are more than max_latency
+      ahead. Without a max_latency, a scan older than the history is not compensated
+  '''
+
+    def motion_since(self, stamp, max_latency):
+        if self.propagated_until is None or self.propagated_until <= stamp:
+            return 0.0, 0.0, 0.0
+        if max_latency is None:
+            delta = self.pose_history.delta_since(stamp)
+            return (0.0, 0.0, 0.0) if delta is None else delta
+        if self.propagated_until - stamp > max_latency:
+            return None
+        return self.pose_history.delta_since(stamp)
+
+    '''
+    Allocates the scratch buffers used by propagate
+      n: The number of particles the buffers must hold
+      dtype: The dtype of the particles, so that propagate never converts between precisions
+  '''
+
+    def allocate_buffers(self, n, dtype=np.float64):
+        self.noise = np.zeros((n, 5), dtype=dtype)  # Noise of every particle, see NOISE_STD
+        self.dtheta = np.zeros(n, dtype=dtype)  # Heading change of every particle
+        self.half = np.zeros(n, dtype=dtype)  # Half of the heading change, then the mean heading along the arc
+        self.chord = np.zeros(n, dtype=dtype)  # Distance covered along x and y per meter travelled on the arc
+        self.tmp = np.zeros(n, dtype=dtype)
+        self.curved = np.zeros(n, dtype=bool)  # Whether a particle turns enough to follow an arc
+
+    '''
+    Propagates the particles through the kinematic car model with noisy controls, in place
+    and without allocating. The caller must hold state_lock
+    Using the mean heading along the arc, the displacement is
+      dx = v*dt*cos(theta + dtheta/2) * sin(dtheta/2)/(dtheta/2)
+      dy = v*dt*sin(theta + dtheta/2) * sin(dtheta/2)/(dtheta/2)
+    which equals the usual car_length/sin(2*beta)*(sin(theta+dtheta)-sin(theta)) form, but stays
+    well defined for centered steering. Particles whose half heading change is below
+    STRAIGHT_LINE_EPS take the straight line branch, where sin(x)/x is 1
+      speed: The nominal speed of the car
+      steering: The nominal steering angle of the car
+      dt: The time over which the controls are applied
+  '''
+
+    def propagate(self, speed, steering, dt):
+        particles = self.particles
+        n = particles.shape[0]
+        if self.noise.shape[0] < n or self.noise.dtype != particles.dtype:
+            self.allocate_buffers(n, particles.dtype)
+
+        # One draw for all five noise terms of every particle
+        noise = self.noise[:n]
+        if self.rng is not None:
+            self.rng.standard_normal(out=noise, dtype=noise.dtype)
+        else:
+            noise[:] = np.random.standard_normal((n, 5))
+        noise *= self.NOISE_STD
+
+        v = noise[:, 0]
+        v += speed
+        delta = noise[:, 1]
+        delta += steering
+
+        # dtheta = v/L*sin(2*beta)*dt, with beta = atan(tan(delta)/2)
+        dtheta = self.dtheta[:n]
+        np.tan(delta, out=dtheta)
+        dtheta *= 0.5
+        np.arctan(dtheta, out=dtheta)
+        dtheta *= 2.0
+        np.sin(dtheta, out=dtheta)
+        dtheta *= v
+        dtheta *= dt / self.CAR_LENGTH
+
+        # sin(dtheta/2)/(dtheta/2), which is 1 on the straight line branch
+        half = self.half[:n]
+        chord = self.chord[:n]
+        tmp = self.tmp[:n]
+        curved = self.curved[:n]
+        np.multiply(dtheta, 0.5, out=half)
+        np.abs(half, out=tmp)
+        np.greater_equal(tmp, STRAIGHT_LINE_EPS, out=curved)
+        chord.fill(1.0)
+        np.sin(half, out=tmp)
+        np.divide(tmp, half, out=chord, where=curved)
+
+        # Scale by the distance travelled, and turn half into the mean heading along the arc
+        v *= dt
+        chord *= v
+        half += particles[:, 2]
+
+        np.cos(half, out=tmp)
+        tmp *= chord
+        tmp += noise[:, 2]
+        particles[:, 0] += tmp
+
+        np.sin(half, out=tmp)
+        tmp *= chord
+        tmp += noise[:, 3]
+        particles[:, 1] += tmp
+
+        # Limit particle theta to be between -pi and pi
+        theta = particles[:, 2]
+        theta += dtheta
+        theta += noise[:, 4]
+        theta += np.pi
+        np.mod(theta, 2*np.pi, out=theta)
+        theta -= np.pi
+
 
 '''
   Code for testing motion model
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+
+import yaml
+
+SENSOR_NOISE_PARAMS = ('Z_HIT', 'Z_SHORT', 'Z_MAX', 'Z_RAND', 'LAMDA_SHORT', 'SIGMA_HIT',
+                       'INV_SQUASH_FACTOR')  # Parameters of SensorModel, in the units of its constants
+MOTION_NOISE_PARAMS = ('KM_V_NOISE', 'KM_DELTA_NOISE', 'KM_X_FIX_NOISE', 'KM_Y_FIX_NOISE',
+                       'KM_THETA_FIX_NOISE')  # Parameters of KinematicMotionModel
+
+'''
+  Reading and writing of the noise parameters of the sensor and motion models, as fitted
+  from recorded logs by FitNoiseParams.py. The file is a yaml dict named like the module
+  constants it overrides, e.g. {Z_HIT: 0.7, SIGMA_HIT: 2.1, KM_V_NOISE: 0.05}. Parameters
+  missing from the file keep the default of their constant
+'''
+
+'''
+  Reads a noise parameter file
+    path: The yaml file
+    Returns a dict of the parameters in the file, see SENSOR_NOISE_PARAMS and MOTION_NOISE_PARAMS
+'''
+def load_noise_params(path):
+    with open(path) as f:
+        desc = yaml.safe_load(f) or {}
+
+    unknown = set(desc) - set(SENSOR_NOISE_PARAMS + MOTION_NOISE_PARAMS)
+    if unknown:
+        raise ValueError('Unknown noise parameters in ' + path + ': ' + ', '.join(sorted(unknown)))
+    params = dict((name, float(value)) for name, value in desc.items())
+    for name, value in params.items():
+        if value <= 0.0:
+            raise ValueError('Noise parameter ' + name + ' in ' + path + ' must be positive')
+    return params
+
+'''
+  Writes a noise parameter file, under a temporary name that is renamed into place
+    path: The yaml file to write
+    params: Dict of parameter values, see load_noise_params
+    header: Optional comment lines written at the top of the file
+'''
+def save_noise_params(path, params, header=()):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_name = tempfile.mkstemp(suffix='.yaml', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for line in header:
+                f.write('# ' + line + '\n')
+            for name in SENSOR_NOISE_PARAMS + MOTION_NOISE_PARAMS:
+                if name in params:
+                    f.write('%s: %.6g\n' % (name, params[name]))
+        os.rename(tmp_name, path)
+    except Exception:
+        os.remove(tmp_name)
+        raise
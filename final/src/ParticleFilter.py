@@ -3,27 +3,40 @@
 import rospy 
 import numpy as np
 import time
-import utils as Utils
+import Utils
 import tf.transformations
 import tf
-from threading import Lock
 
 from nav_msgs.srv import GetMap
 from geometry_msgs.msg import PoseStamped, PoseArray, PoseWithCovarianceStamped, PointStamped
 from sensor_msgs.msg import LaserScan
 from nav_msgs.msg import Odometry
 
-from ReSample import ReSampler
+from ReSample import ReSampler, RESAMPLE_TYPES
 from SensorModel import SensorModel
 from MotionModel import KinematicMotionModel
+from StageTimer import StageTimer, TimedLock
+from ParticleSnapshot import ParticleSnapshots
+from VizPublisher import VizPublisher
+from PosePredictor import PosePredictor
+from Checkpoint import save_checkpoint, load_checkpoint
+from MapResources import MapResources
+from NoiseParams import load_noise_params
 
 MAP_TOPIC = "static_map"
-PUBLISH_PREFIX = '/pf/viz'
 PUBLISH_TF = True
+NAMESPACE = "/pf" # The state of the filter is published under NAMESPACE/viz
 
 CLICKED_POSE_STD  = 1.0
 CLICKED_ANGLE_STD = 0.1
 
+PARTICLE_DTYPE = np.float32 # Particles are contiguous float32 rows, the layout the range methods ray cast from
+
+UPDATE_WAIT_TIMEOUT = 0.5 # Seconds to wait for a sensor update before checking for shutdown
+STATS_PERIOD = 10.0 # Seconds between reports of the stage timings
+CHECKPOINT_PERIOD = 2.0 # Seconds between checkpoints of the particles
+CHECKPOINT_MAX_AGE = 300.0 # Seconds after which a checkpoint is too old to restore from
+
 '''
   Implements particle filtering for estimating the state of the robot car
 '''
@@ -32,87 +45,202 @@ class ParticleFilter():
 
   '''
   Initializes the particle filter
-    n_particles: The number of particles
+    n_particles: The number of particles (the initial number when adaptive sizing is enabled)
     n_viz_particles: The number of particles to visualize
     motor_state_topic: The topic containing motor state information
     servo_state_topic: The topic containing servo state information
     scan_topic: The topic containing laser scans
+      (None for any of the three topics means it is not subscribed to, and the messages
+       are fed to the motion and sensor model callbacks directly, see Replay.py)
     laser_ray_step: Step for downsampling laser scans
     exclude_max_range_rays: Whether to exclude rays that are beyond the max range
     max_range_meters: The max range of the laser
-    resample_type: Whether to use naiive or low variance sampling
+    resample_type: The resampling scheme, one of naiive (multinomial), low_variance, stratified or residual
     speed_to_erpm_offset: Offset conversion param from rpm to speed
     speed_to_erpm_gain: Gain conversion param from rpm to speed
     steering_angle_to_servo_offset: Offset conversion param from servo position to steering angle
     steering_angle_to_servo_gain: Gain conversion param from servo position to steering angle 
     car_length: The length of the car
+    range_method: The ray casting backend used by the sensor model ('cddt', 'rmgpu', 'numpy' or 'lut')
+    scan_reduction: How the sensor model reduces each bin of laser_ray_step beams ('center', 'min' or 'median')
+    min_particles: The minimum number of particles, defaults to n_particles
+    max_particles: The maximum number of particles, defaults to n_particles. If it is larger
+                   than min_particles, the number of particles is chosen by KLD-sampling
+    resample_ess_fraction: Resample only once the effective sample size of the weights drops
+                           below this fraction of the number of particles. 1.0 resamples on every scan
+    num_workers: The number of processes the sensor model shards the particles across
+    viz_rate: The maximum rate (Hz) at which the expected pose is published
+    viz_particle_rate: The maximum rate (Hz) at which the particles and laser scan are published
+    map_msg: The map to localize in, defaults to the map of the MAP_TOPIC service
+    live: Whether to publish the state of the filter and subscribe to /initialpose. The pose
+          predicted from the controls since the last scan is then published too, see PosePredictor
+    batch_motion: Whether the motion model buffers the controls and propagates the particles
+                  once per scan, up to the scan's stamp, instead of on every VESC state
+    max_scan_latency: Scans taken more than this many seconds before the latest motion update
+                      are dropped, None to keep every scan. The scans that are kept are evaluated
+                      against the particles moved back by the motion since they were taken
+    checkpoint_path: Where the particles are checkpointed every checkpoint_period seconds,
+                     None to not checkpoint them
+    checkpoint_period: The seconds between checkpoints
+    restore_checkpoint: Whether to start from the checkpoint at checkpoint_path, if it was saved
+                        with the same map less than checkpoint_max_age seconds ago, instead of
+                        initializing globally
+    checkpoint_max_age: The maximum age in seconds of a checkpoint that is restored
+    global_init_candidates: The number of poses that global initialization draws and scores
+                            against the next scan, keeping the MAX_PARTICLES most likely ones.
+                            0 (or at most MAX_PARTICLES) keeps the uniform samples instead
+    resources: The MapResources of map_msg. Filters created with the same resources share
+               the free space, range method and sensor model of the map, see FilterHost.py
+    namespace: The namespace of the published topics
+    initialpose_topic: The topic of the poses clicked in RViz
+    publish_tf: Whether to broadcast the transform from the map to the car
+    noise_params: Dict overriding the noise parameters of the sensor and motion models, as
+                  read by NoiseParams.load_noise_params. None keeps their defaults
+    sensor_model: How the sensor model weighs a scan, 'beam' (ray casting) or 'likelihood_field'
   '''
   def __init__(self, n_particles, n_viz_particles,
                motor_state_topic, servo_state_topic, scan_topic, laser_ray_step,
                exclude_max_range_rays, max_range_meters, resample_type,
                speed_to_erpm_offset, speed_to_erpm_gain, steering_angle_to_servo_offset,
-               steering_angle_to_servo_gain, car_length):
-    self.N_PARTICLES = n_particles # The number of particles
-                                   # In this implementation, the total number of 
-                                   # particles is constant
+               steering_angle_to_servo_gain, car_length, range_method='cddt', scan_reduction='center',
+               min_particles=None, max_particles=None, resample_ess_fraction=0.5,
+               num_workers=1, viz_rate=20.0, viz_particle_rate=2.0, map_msg=None, live=True,
+               batch_motion=False, global_init_candidates=0, max_scan_latency=None,
+               checkpoint_path=None, checkpoint_period=CHECKPOINT_PERIOD, restore_checkpoint=False,
+               checkpoint_max_age=CHECKPOINT_MAX_AGE, resources=None, namespace=NAMESPACE,
+               initialpose_topic="/initialpose", publish_tf=PUBLISH_TF, noise_params=None,
+               sensor_model='beam'):
+    if resample_type not in RESAMPLE_TYPES:
+      raise ValueError("Unrecognized resampling method: " + str(resample_type))
+    self.N_PARTICLES = n_particles # The number of particles currently in use
+    self.MIN_PARTICLES = n_particles if min_particles is None else min(min_particles, n_particles)
+    self.MAX_PARTICLES = n_particles if max_particles is None else max(max_particles, n_particles)
+    self.ADAPTIVE = self.MAX_PARTICLES > self.MIN_PARTICLES # Whether the number of particles changes on resample
     self.N_VIZ_PARTICLES = n_viz_particles # The number of particles to visualize
+    self.RESAMPLE_ESS_FRACTION = resample_ess_fraction # Fraction of N_PARTICLES below which the ESS triggers a resample
+    self.GLOBAL_INIT_CANDIDATES = global_init_candidates # Poses scored against the first scan by global initialization
+    self.CHECKPOINT_PATH = checkpoint_path # Where the particles are checkpointed, None to not checkpoint them
+    self.CHECKPOINT_PERIOD = checkpoint_period # Seconds between checkpoints
+    self.last_checkpoint_time = time.time() # When the particles were last checkpointed
 
-    self.particle_indices = np.arange(self.N_PARTICLES) # Cached list of particle indices
-    self.particles = np.zeros((self.N_PARTICLES,3)) # Numpy matrix of dimension N_PARTICLES x 3
-    self.weights = np.ones(self.N_PARTICLES) / float(self.N_PARTICLES) # Numpy matrix containig weight for each particle
+    # Buffers are allocated once for MAX_PARTICLES. The active particles and weights are
+    # always views of their first N_PARTICLES rows, see set_particle_count
+    # Every stage works on the same particle buffer in place. Resampling draws into the
+    # spare buffer, and the two are swapped, see resample
+    self.particle_index_buffer = np.arange(self.MAX_PARTICLES) # Cached list of particle indices
+    self.particle_buffer = np.zeros((self.MAX_PARTICLES,3), dtype=PARTICLE_DTYPE)
+    self.spare_particle_buffer = np.zeros((self.MAX_PARTICLES,3), dtype=PARTICLE_DTYPE)
+    self.weight_buffer = np.ones(self.MAX_PARTICLES) / float(self.N_PARTICLES)
+    self.log_weight_buffer = np.zeros(self.MAX_PARTICLES) # Log likelihood accumulated since the last resample
+    self.set_particle_count(self.N_PARTICLES)
 
-    self.state_lock = Lock() # A lock used to prevent concurrency issues. You do not need to worry about this
-    
-    self.tfl = tf.TransformListener() # Transforms points between coordinate frames
+    self.stage_timer = StageTimer() # Records how long each stage of the filter takes
+    self.state_lock = TimedLock(self.stage_timer) # A lock used to prevent concurrency issues. Also records how long each stage holds it
+    self.snapshots = ParticleSnapshots(self.MAX_PARTICLES, PARTICLE_DTYPE) # Copies of the particles that are published without holding state_lock
 
     # Get the map
-    print("Getting map from service: ", MAP_TOPIC)
-    rospy.wait_for_service(MAP_TOPIC)
-    map_msg = rospy.ServiceProxy(MAP_TOPIC, GetMap)().map # The map, will get passed to init of sensor model
+    if resources is not None:
+      map_msg = resources.map_msg
+    if map_msg is None:
+      print("Getting map from service: ", MAP_TOPIC)
+      rospy.wait_for_service(MAP_TOPIC)
+      map_msg = rospy.ServiceProxy(MAP_TOPIC, GetMap)().map # The map, will get passed to init of sensor model
+    if resources is None:
+      resources = MapResources(map_msg)
     self.map_info = map_msg.info # Save info about map for later use    
 
-    # Create numpy array representing map for later use
-    array_255 = np.array(map_msg.data).reshape((map_msg.info.height, map_msg.info.width))
-    self.permissible_region = np.zeros_like(array_255, dtype=bool)
-    self.permissible_region[array_255==0] = 1 # Numpy array of dimension (map_msg.info.height, map_msg.info.width),
-                                              # With values 0: not permissible, 1: permissible    
+    # Numpy array of dimension (map_msg.info.height, map_msg.info.width), with values 0: not permissible,
+    # 1: permissible, and the (x, y) pixel of every permissible cell, computed once
+    self.permissible_region, self.free_cells = resources.free_space()
 
     # Globally initialize the particles
     self.initialize_global()
    
-    # Publish particle filter state
-    self.pub_tf = tf.TransformBroadcaster() # Used to create a tf between the map and the laser for visualization    
-    self.pose_pub      = rospy.Publisher(PUBLISH_PREFIX + "/inferred_pose", PoseStamped, queue_size = 1) # Publishes the expected pose
-    self.particle_pub  = rospy.Publisher(PUBLISH_PREFIX + "/particles", PoseArray, queue_size = 1) # Publishes a subsample of the particles
-    self.pub_laser     = rospy.Publisher(PUBLISH_PREFIX + "/scan", LaserScan, queue_size = 1) # Publishes the most recent laser scan
-    self.pub_odom      = rospy.Publisher(PUBLISH_PREFIX + "/odom", Odometry, queue_size = 1) # Publishes the path of the car
+    # Publish particle filter state from a separate thread
+    self.viz_publisher = None
+    if live:
+      self.viz_publisher = VizPublisher(self.snapshots, self.expected_pose, self.N_VIZ_PARTICLES,
+                                        viz_rate, viz_particle_rate, publish_tf, namespace + "/viz")
     
-    self.RESAMPLE_TYPE = resample_type # Whether to use naiive or low variance sampling
-    self.resampler = ReSampler(self.particles, self.weights, self.state_lock)  # An object used for resampling
+    self.RESAMPLE_TYPE = resample_type # The resampling scheme, one of RESAMPLE_TYPES
+    self.resampler = ReSampler(self.particles, self.weights, self.state_lock,
+                               self.MAX_PARTICLES, self.log_weights)  # An object used for resampling
 
     # An object used for applying sensor model
     self.sensor_model = SensorModel(scan_topic, laser_ray_step, exclude_max_range_rays, 
                                     max_range_meters, map_msg, self.particles, self.weights, 
-                                    self.state_lock) 
+                                    self.state_lock, range_method, scan_reduction,
+                                    self.MAX_PARTICLES, self.log_weights, num_workers,
+                                    max_scan_latency, resources, noise_params, sensor_model)
 
     # An object used for applying kinematic motion model
     self.motion_model = KinematicMotionModel(motor_state_topic, servo_state_topic, 
                                              speed_to_erpm_offset, speed_to_erpm_gain, 
                                              steering_angle_to_servo_offset, steering_angle_to_servo_gain, 
-                                             car_length, self.particles, self.state_lock)     
+                                             car_length, self.particles, self.state_lock,
+                                             self.MAX_PARTICLES, batch_motion, noise_params)
+    if batch_motion:
+      self.sensor_model.propagate_until = self.motion_model.propagate_until
+    self.sensor_model.motion_since = self.motion_model.motion_since
+    if self.GLOBAL_INIT_CANDIDATES > self.MAX_PARTICLES:
+      self.sensor_model.initialize_with_scan = self.initialize_with_scan
+
+    # Warm restart from the state of a previous run
+    if restore_checkpoint and checkpoint_path is not None:
+      checkpoint = load_checkpoint(checkpoint_path, self.map_info, checkpoint_max_age)
+      if checkpoint is not None:
+        self.restore(checkpoint)
+
+    # Predicts the pose at the rate of the controls, between the scans
+    self.pose_predictor = None
+    if live:
+      self.pose_predictor = PosePredictor(car_length, prefix=namespace + "/viz", noise_params=noise_params)
+      self.motion_model.on_control = self.pose_predictor.predict
     
     # Subscribe to the '/initialpose' topic. Publised by RVIZ. See clicked_pose_cb function in this file for more info
-    self.pose_sub  = rospy.Subscriber("/initialpose", PoseWithCovarianceStamped, self.clicked_pose_cb, queue_size=1)
+    if live:
+      self.pose_sub  = rospy.Subscriber(initialpose_topic, PoseWithCovarianceStamped, self.clicked_pose_cb, queue_size=1)
     
     print('Initialization complete')
 
+  '''
+    Changes the number of particles in use. self.particles, self.weights and
+    self.particle_indices, and the particles and weights of every stage of the filter,
+    become views of the first n rows of the preallocated buffers.
+    Must be called while holding state_lock (or before the stages exist)
+      n: The new number of particles, at most MAX_PARTICLES
+  '''
+  def set_particle_count(self, n):
+    self.N_PARTICLES = n
+    self.particle_indices = self.particle_index_buffer[:n] # Cached list of particle indices
+    self.particles = self.particle_buffer[:n] # Numpy matrix of dimension N_PARTICLES x 3
+    self.weights = self.weight_buffer[:n] # Numpy matrix containig weight for each particle
+    self.log_weights = self.log_weight_buffer[:n] # Numpy matrix containing the log weight of each particle
+
+    if hasattr(self, 'resampler'):
+      self.resampler.particles = self.particles
+      self.resampler.weights = self.weights
+      self.resampler.log_weights = self.log_weights
+    if hasattr(self, 'sensor_model'):
+      self.sensor_model.particles = self.particles
+      self.sensor_model.weights = self.weights
+      self.sensor_model.log_weights = self.log_weights
+    if hasattr(self, 'motion_model'):
+      self.motion_model.particles = self.particles
+
   '''
     Initialize the particles as uniform samples across the in-bounds regions of
     the map
+    With GLOBAL_INIT_CANDIDATES set, the sensor model also replaces them with the
+    most likely of a larger set of candidates when the next scan arrives, see
+    initialize_with_scan
   '''
   def initialize_global(self):
     self.state_lock.acquire()
     
+    # Global localization needs as many particles as we can afford
+    self.set_particle_count(self.MAX_PARTICLES)
+    
     # Use self.permissible_region to get in-bounds states
     # Uniformally sample from in-bounds regions
     # Convert map samples (which are in pixels) to world samples (in meters/radians)
@@ -121,58 +249,151 @@ class ParticleFilter():
     # Update weights in place so that all particles have the same weight and the 
     # sum of the weights is one.
     # YOUR CODE HERE
-    new_particles = np.zeros(self.particles.shape)
-    x_valid, y_valid = np.where(self.permissible_region == 1)
-    samples = np.random.choice(len(x_valid), self.N_PARTICLES)
-    new_particles[:,0] = x_valid[samples]
-    new_particles[:,1] = y_valid[samples]
-    new_particles[:,2] = 2.0 * np.pi * np.random.random(self.N_PARTICLES)
-    Utils.map_to_world(new_particles, self.map_info)
-    self.particles[:] = new_particles[:]
+    self.particles[:] = self.sample_free_poses(self.N_PARTICLES)
     self.weights[:] = 1.0 / self.N_PARTICLES
+    self.log_weights[:] = 0.0
+
+    if hasattr(self, 'sensor_model') and self.GLOBAL_INIT_CANDIDATES > self.MAX_PARTICLES:
+      self.sensor_model.initialize_with_scan = self.initialize_with_scan
 
     self.state_lock.release()
-    
+
   '''
-    Publish a tf between the laser and the map
-    This is necessary in order to visualize the laser scan within the map
-      pose: The pose of the laser w.r.t the map
-      stamp: The time at which this pose was calculated, defaults to None - resulting
-             in using the time at which this function was called as the stamp
+    Draws poses uniformly over the permissible cells of the map and all headings
+      n: The number of poses
+      Returns an nx3 numpy array of poses in the world
   '''
-  def publish_tf(self,pose,stamp=None):
-    if stamp is None:
-        stamp = rospy.Time.now()
-    try:
-      # Lookup the offset between laser and odom  
-      delta_off, delta_rot = self.tfl.lookupTransform("/laser","/odom",rospy.Time(0))
-
-      # Transform offset to be w.r.t the map
-      off_x = delta_off[0]*np.cos(pose[2]) - delta_off[1]*np.sin(pose[2])
-      off_y = delta_off[0]*np.sin(pose[2]) + delta_off[1]*np.cos(pose[2])
-
-      # Broadcast the tf
-      self.pub_tf.sendTransform((pose[0]+off_x,pose[1]+off_y,0.0),tf.transformations.quaternion_from_euler(0,0,pose[2]+tf.transformations.euler_from_quaternion(delta_rot)[2]),stamp,"/odom","/map")
-
-    except (tf.LookupException): # Will occur if odom frame does not exist
-      self.pub_tf.sendTransform((pose[0],pose[1],0),tf.transformations.quaternion_from_euler(0,0,pose[2]), stamp , "/laser", "/map")
+  def sample_free_poses(self, n):
+    poses = np.zeros((n, 3))
+    samples = np.random.randint(0, self.free_cells.shape[0], n)
+    poses[:,:2] = self.free_cells[samples]
+    poses[:,2] = 2.0 * np.pi * np.random.random(n)
+    Utils.map_to_world(poses, self.map_info)
+    return poses
 
+  '''
+    Coarse-to-fine global initialization, called by the sensor model with the first
+    observation after initialize_global while holding state_lock
+    Draws GLOBAL_INIT_CANDIDATES poses over the free space, scores them against the
+    observation in chunks and keeps the MAX_PARTICLES most likely ones as the particles.
+    The sensor model then weighs the kept particles with the same observation
+      obs: The downsampled observation, see SensorModel.lidar_cb
+  '''
+  def initialize_with_scan(self, obs):
+    self.set_particle_count(self.MAX_PARTICLES)
+    candidates = self.sample_free_poses(self.GLOBAL_INIT_CANDIDATES)
+    scores = self.sensor_model.score_poses(candidates, obs)
+    best = np.argpartition(scores, -self.N_PARTICLES)[-self.N_PARTICLES:]
+    self.particles[:] = candidates[best]
+    self.weights[:] = 1.0 / self.N_PARTICLES
+    self.log_weights[:] = 0.0
+    
   '''
     Returns a 3 element numpy array representing the expected pose given the 
     current particles and weights
     Uses weighted cosine and sine averaging to more accurately compute average theta
       https://en.wikipedia.org/wiki/Mean_of_circular_quantities
+      particles, weights: The particles and weights to average, defaults to the current ones
   '''
-  def expected_pose(self):
+  def expected_pose(self, particles=None, weights=None):
     # YOUR CODE HERE
-    x = np.sum(self.particles[:,0]*self.weights[:])
-    y = np.sum(self.particles[:,1]*self.weights[:])
-    sin_avg = np.sum(np.sin(self.particles[:,2])*self.weights[:])
-    cos_avg = np.sum(np.cos(self.particles[:,2])*self.weights[:])
+    if particles is None:
+      particles = self.particles
+      weights = self.weights
+    x = np.sum(particles[:,0]*weights[:])
+    y = np.sum(particles[:,1]*weights[:])
+    sin_avg = np.sum(np.sin(particles[:,2])*weights[:])
+    cos_avg = np.sum(np.cos(particles[:,2])*weights[:])
     theta = np.arctan2(sin_avg, cos_avg)
     return np.array([x, y, theta])
+
+  '''
+    Returns the 3x3 weighted covariance of the particles around a pose, with the
+    differences in theta wrapped to [-pi, pi)
+      pose: The pose to compute the covariance around, usually the expected pose
+      particles, weights: The particles and weights, defaults to the current ones
+  '''
+  def pose_covariance(self, pose, particles=None, weights=None):
+    if particles is None:
+      particles = self.particles
+      weights = self.weights
+    diff = particles - pose
+    diff[:,2] = np.mod(diff[:,2] + np.pi, 2*np.pi) - np.pi
+    return np.dot(diff.T * weights, diff) / np.sum(weights)
+
+  '''
+    Resets the predicted pose to the expected pose and covariance of the particles,
+    as of the last control applied to them. The predictor then replays the controls
+    received since, see PosePredictor
+  '''
+  def correct_prediction(self):
+    if self.pose_predictor is None:
+      return
+    self.state_lock.acquire()
+    pose = self.expected_pose()
+    covariance = self.pose_covariance(pose)
+    stamp = self.motion_model.propagated_until
+    if stamp is None and self.sensor_model.last_laser is not None:
+      stamp = self.sensor_model.last_laser.header.stamp.to_sec()
+    self.state_lock.release()
+    if stamp is not None:
+      self.pose_predictor.correct(pose, covariance, stamp)
     
     
+  '''
+    Copies the particles, weights and expected pose out while holding state_lock, and
+    writes them to CHECKPOINT_PATH without holding it, at most every CHECKPOINT_PERIOD
+    seconds
+    Returns whether a checkpoint was written
+  '''
+  def checkpoint(self):
+    if self.CHECKPOINT_PATH is None or time.time() - self.last_checkpoint_time < self.CHECKPOINT_PERIOD:
+      return False
+    self.last_checkpoint_time = time.time()
+
+    self.state_lock.acquire()
+    particles = self.particles.copy()
+    weights = self.weights.copy()
+    log_weights = self.log_weights.copy()
+    pose = self.expected_pose()
+    stamp = self.motion_model.propagated_until
+    self.state_lock.release()
+
+    try:
+      save_checkpoint(self.CHECKPOINT_PATH, particles, weights, log_weights, pose,
+                      -1.0 if stamp is None else stamp, self.map_info)
+    except (IOError, OSError) as e:
+      print('Could not checkpoint the particles: ' + str(e))
+      return False
+    return True
+
+  '''
+    Replaces the particles with the ones of a checkpoint, see Checkpoint.load_checkpoint
+    A checkpoint with a number of particles this filter can use is restored with its
+    weights, otherwise N_PARTICLES particles are drawn from it by weight
+      checkpoint: The loaded checkpoint
+  '''
+  def restore(self, checkpoint):
+    particles = checkpoint['particles']
+    weights = checkpoint['weights'] / np.sum(checkpoint['weights'])
+    n = particles.shape[0]
+
+    self.state_lock.acquire()
+    if self.MIN_PARTICLES <= n <= self.MAX_PARTICLES:
+      self.set_particle_count(n)
+      self.particles[:] = particles
+      self.weights[:] = weights
+      self.log_weights[:] = checkpoint['log_weights']
+    else:
+      indices = np.random.choice(n, self.N_PARTICLES, p=weights)
+      self.particles[:] = particles[indices]
+      self.resampler.reset_weights()
+    self.sensor_model.initialize_with_scan = None # The checkpoint replaces a pending global initialization
+    self.state_lock.release()
+
+    pose = checkpoint['pose']
+    print('Restored %d particles around (%.2f, %.2f, %.2f) from checkpoint' % (n, pose[0], pose[1], pose[2]))
+
   '''
     Callback for '/initialpose' topic. RVIZ publishes a message to this topic when you specify an initial pose 
     using the '2D Pose Estimate' button
@@ -184,110 +405,161 @@ class ParticleFilter():
     # Updates the particles in place
     # Updates the weights to all be equal, and sum to one    
     # YOUR CODE HERE
+    self.set_particle_count(self.MAX_PARTICLES)
+    self.sensor_model.initialize_with_scan = None # The clicked pose replaces a pending global initialization
     pose = msg.pose.pose
     print("get initial pose:", pose.position.x, pose.position.y, Utils.quaternion_to_angle(pose.orientation))
     self.particles[:,0] = pose.position.x + np.random.normal(0.0, CLICKED_POSE_STD, self.N_PARTICLES)
     self.particles[:,1] = pose.position.y + np.random.normal(0.0, CLICKED_POSE_STD, self.N_PARTICLES)
     self.particles[:,2] = Utils.quaternion_to_angle(pose.orientation) + np.random.normal(0.0, CLICKED_ANGLE_STD, self.N_PARTICLES)
     self.weights[:] = 1.0 / self.N_PARTICLES
+    self.log_weights[:] = 0.0
  
     self.state_lock.release()
     
   '''
     Visualize the current state of the filter
-   (1) Publishes a tf between the map and the laser. Necessary for visualizing the laser scan in the map
-   (2) Publishes the most recent laser measurement. Note that the frame_id of this message should be '/laser'
-   (3) Publishes a PoseStamped message indicating the expected pose of the car
-   (4) Publishes a subsample of the particles (use self.N_VIZ_PARTICLES). 
-       Sample so that particles with higher weights are more likely to be sampled.
+    The particles are copied into a snapshot while holding state_lock, and the
+    VizPublisher thread publishes the tf, laser scan, expected pose and a subsample
+    of the particles from that snapshot, so the motion and sensor models are never
+    stalled by tf lookups, message construction or publishing
   '''
   def visualize(self):
     #print 'Visualizing...'
+    if self.viz_publisher is None:
+      return
+    self.state_lock.acquire()
+    self.snapshots.capture(self.particles, self.weights, self.sensor_model.last_laser)
+    self.state_lock.release()
+    self.viz_publisher.notify()
+
+  '''
+    Resamples the particles according to RESAMPLE_TYPE, once the effective sample size
+    of the weights has dropped below RESAMPLE_ESS_FRACTION of the number of particles.
+    With adaptive sizing, KLD-sampling picks how many particles to use until the next
+    resample, and that many are then drawn according to RESAMPLE_TYPE
+    The particles are drawn into the spare buffer, which then becomes the particle buffer
+    of every stage, so they are never copied back
+    Returns whether the particles were resampled
+  '''
+  def resample(self):
     self.state_lock.acquire()
-    self.inferred_pose = self.expected_pose()
-
-    if isinstance(self.inferred_pose, np.ndarray):
-      if PUBLISH_TF:
-        self.publish_tf(self.inferred_pose)
-      ps = PoseStamped()
-      ps.header = Utils.make_header("map")
-      ps.pose.position.x = self.inferred_pose[0]
-      ps.pose.position.y = self.inferred_pose[1]
-      ps.pose.orientation = Utils.angle_to_quaternion(self.inferred_pose[2])    
-      if(self.pose_pub.get_num_connections() > 0):
-        self.pose_pub.publish(ps)
-      if(self.pub_odom.get_num_connections() > 0):
-        odom = Odometry()
-        odom.header = ps.header
-        odom.pose.pose = ps.pose
-        self.pub_odom.publish(odom)
-
-    if self.particle_pub.get_num_connections() > 0:
-      if self.particles.shape[0] > self.N_VIZ_PARTICLES:
-        # randomly downsample particles
-        proposal_indices = np.random.choice(self.particle_indices, self.N_VIZ_PARTICLES, p=self.weights)
-        # proposal_indices = np.random.choice(self.particle_indices, self.N_VIZ_PARTICLES)
-        self.publish_particles(self.particles[proposal_indices,:])
-      else:
-        self.publish_particles(self.particles)
-        
-    if self.pub_laser.get_num_connections() > 0 and isinstance(self.sensor_model.last_laser, LaserScan):
-      self.sensor_model.last_laser.header.frame_id = "/laser"
-      self.sensor_model.last_laser.header.stamp = rospy.Time.now()
-      self.pub_laser.publish(self.sensor_model.last_laser)
+    # Keep accumulating evidence while the weights are still well spread
+    if self.resampler.effective_sample_size() >= self.RESAMPLE_ESS_FRACTION * self.N_PARTICLES:
+      self.state_lock.release()
+      return False
+
+    if self.ADAPTIVE:
+      n = self.resampler.resample_kld(self.spare_particle_buffer, self.MIN_PARTICLES, self.RESAMPLE_TYPE)
+    else:
+      n = self.resampler.resample_into(self.RESAMPLE_TYPE, self.spare_particle_buffer)
+    self.particle_buffer, self.spare_particle_buffer = self.spare_particle_buffer, self.particle_buffer
+    self.set_particle_count(n)
+    self.resampler.reset_weights()
     self.state_lock.release()
+    return True
 
   '''
-  Helper function for publishing a pose array of particles
-    particles: To particles to publish
+    Runs the filter until shutdown. The callbacks weigh and propagate the particles in
+    their own threads, and this loop resamples, publishes and checkpoints after every
+    sensor update, and reports the stage timings every STATS_PERIOD seconds
   '''
-  def publish_particles(self, particles):
-    pa = PoseArray()
-    pa.header = Utils.make_header("map")
-    pa.poses = Utils.particles_to_poses(particles)
-    self.particle_pub.publish(pa)
+  def run(self):
+    last_report = time.time()
+    reported_drops = 0 # The number of late scans dropped as of the last report
+    reported_control_drops = 0 # The number of controls dropped as of the last report
+    while not rospy.is_shutdown(): # Keep going until we kill it
+      # Callbacks are running in separate threads
+      # Sleep until the sensor model says it's time to resample, instead of spinning
+      handoff = self.sensor_model.wait_for_update(UPDATE_WAIT_TIMEOUT)
+      if handoff is not None:
+        self.stage_timer.record('handoff', handoff)
+        start = time.time()
+
+        if self.resample():
+          start = self.stage_timer.record_since('resample', start)
+
+        self.correct_prediction() # Restart the high rate pose prediction from the corrected particles
+        start = self.stage_timer.record_since('predict', start)
+
+        self.visualize() # Perform visualization
+        start = self.stage_timer.record_since('visualize', start)
+
+        if self.checkpoint():
+          self.stage_timer.record_since('checkpoint', start)
+
+      if time.time() - last_report > STATS_PERIOD:
+        report = self.stage_timer.report()
+        if report:
+          print('Stage timings: ' + report)
+        dropped_scans = self.sensor_model.dropped_scans
+        if dropped_scans > reported_drops:
+          print('Dropped %d scans taken more than %.2f s before the particles'
+                % (dropped_scans - reported_drops, self.sensor_model.MAX_SCAN_LATENCY))
+          reported_drops = dropped_scans
+        history = self.motion_model.history
+        if history is not None and history.dropped_controls > reported_control_drops:
+          print('Dropped %d controls that were not integrated before the control history filled up'
+                % (history.dropped_controls - reported_control_drops))
+          reported_control_drops = history.dropped_controls
+        self.stage_timer.reset()
+        last_report = time.time()
+
+'''
+  Reads the arguments of a ParticleFilter from the parameter server
+    ns: The namespace of the parameters, '~' for the private parameters of the node
+    fallback_ns: The namespace the parameters that are not in ns are read from, if any
+    Returns a dict of keyword arguments of ParticleFilter
+'''
+def read_params(ns="~", fallback_ns=None):
+  def get(name, *default):
+    if fallback_ns is not None and not rospy.has_param(ns + name):
+      return rospy.get_param(fallback_ns + name, *default)
+    return rospy.get_param(ns + name, *default)
+
+  n_particles = int(get("n_particles")) # The number of particles
+  noise_params_path = get("noise_params", "") # A file written by FitNoiseParams.py, empty for the defaults
+  return dict(
+    n_particles = n_particles,
+    min_particles = int(get("min_particles", n_particles)), # The minimum number of particles
+    max_particles = int(get("max_particles", n_particles)), # The maximum number of particles
+    resample_ess_fraction = float(get("resample_ess_fraction", 0.5)), # Resample when the ESS drops below this fraction
+    n_viz_particles = int(get("n_viz_particles")), # The number of particles to visualize
+    motor_state_topic = get("motor_state_topic", "/car/vesc/sensors/core"), # The topic containing motor state information
+    servo_state_topic = get("servo_state_topic", "/car/vesc/sensors/servo_position_command"), # The topic containing servo state information
+    scan_topic = get("scan_topic", "/car/scan"), # The topic containing laser scans
+    laser_ray_step = int(get("laser_ray_step")), # Step for downsampling laser scans
+    exclude_max_range_rays = bool(get("exclude_max_range_rays")), # Whether to exclude rays that are beyond the max range
+    max_range_meters = float(get("max_range_meters")), # The max range of the laser
+    resample_type = get("resample_type", "naiive"), # naiive (multinomial), low_variance, stratified or residual
+    range_method = get("range_method", "cddt"), # The ray casting backend: cddt, rmgpu, numpy or lut
+    sensor_model = get("sensor_model", "beam"), # How scans are weighed: beam or likelihood_field
+    scan_reduction = get("scan_reduction", "center"), # How bins of laser beams are reduced: center, min or median
+    num_workers = int(get("num_workers", 1)), # The number of processes evaluating the sensor model
+    viz_rate = float(get("viz_rate", 20.0)), # Max rate (Hz) of the published pose
+    viz_particle_rate = float(get("viz_particle_rate", 2.0)), # Max rate (Hz) of the published particles and scan
+    batch_motion = bool(get("batch_motion", False)), # Whether to propagate the particles once per scan
+    global_init_candidates = int(get("global_init_candidates", 0)), # Poses scored against the first scan to initialize
+    max_scan_latency = float(get("max_scan_latency", 0.0)) or None, # Seconds the particles may be ahead of a scan before it is dropped, 0 to never drop
+    checkpoint_path = get("checkpoint_path", "") or None, # Where to checkpoint the particles, empty to not checkpoint
+    checkpoint_period = float(get("checkpoint_period", CHECKPOINT_PERIOD)), # Seconds between checkpoints
+    restore_checkpoint = bool(get("restore_checkpoint", False)), # Whether to start from the last checkpoint
+    checkpoint_max_age = float(get("checkpoint_max_age", CHECKPOINT_MAX_AGE)), # Max age (s) of a restored checkpoint
+    namespace = get("namespace", NAMESPACE), # The namespace of the published topics
+    initialpose_topic = get("initialpose_topic", "/initialpose"), # The topic of the poses clicked in RViz
+    publish_tf = bool(get("publish_tf", PUBLISH_TF)), # Whether to broadcast the transform from the map to the car
+    noise_params = load_noise_params(noise_params_path) if noise_params_path else None, # Fitted sensor and motion noise
+
+    speed_to_erpm_offset = float(rospy.get_param("/car/vesc/speed_to_erpm_offset", 0.0)), # Offset conversion param from rpm to speed
+    speed_to_erpm_gain = float(rospy.get_param("/car/vesc/speed_to_erpm_gain", 4350)),   # Gain conversion param from rpm to speed
+    steering_angle_to_servo_offset = float(rospy.get_param("/car/vesc/steering_angle_to_servo_offset", 0.5)), # Offset conversion param from servo position to steering angle
+    steering_angle_to_servo_gain = float(rospy.get_param("/car/vesc/steering_angle_to_servo_gain", -1.2135)), # Gain conversion param from servo position to steering angle
+    car_length = float(rospy.get_param("/car/vesc/chassis_length", 0.33))) # The length of the car
 
 # Suggested main 
 if __name__ == '__main__':
   rospy.init_node("particle_filter", anonymous=True) # Initialize the node
   
-  n_particles = int(rospy.get_param("~n_particles")) # The number of particles
-  n_viz_particles = int(rospy.get_param("~n_viz_particles")) # The number of particles to visualize
-  motor_state_topic = rospy.get_param("~motor_state_topic", "/car/vesc/sensors/core") # The topic containing motor state information
-  servo_state_topic = rospy.get_param("~servo_state_topic", "/car/vesc/sensors/servo_position_command") # The topic containing servo state information
-  scan_topic = rospy.get_param("~scan_topic", "/car/scan") # The topic containing laser scans
-  laser_ray_step = int(rospy.get_param("~laser_ray_step")) # Step for downsampling laser scans
-  exclude_max_range_rays = bool(rospy.get_param("~exclude_max_range_rays")) # Whether to exclude rays that are beyond the max range
-  max_range_meters = float(rospy.get_param("~max_range_meters")) # The max range of the laser
-  resample_type = rospy.get_param("~resample_type", "naiive") # Whether to use naiive or low variance sampling
-
-  speed_to_erpm_offset = float(rospy.get_param("/car/vesc/speed_to_erpm_offset", 0.0)) # Offset conversion param from rpm to speed
-  speed_to_erpm_gain = float(rospy.get_param("/car/vesc/speed_to_erpm_gain", 4350))   # Gain conversion param from rpm to speed
-  steering_angle_to_servo_offset = float(rospy.get_param("/car/vesc/steering_angle_to_servo_offset", 0.5)) # Offset conversion param from servo position to steering angle
-  steering_angle_to_servo_gain = float(rospy.get_param("/car/vesc/steering_angle_to_servo_gain", -1.2135)) # Gain conversion param from servo position to steering angle    
-  car_length = float(rospy.get_param("/car/vesc/chassis_length", 0.33)) # The length of the car
-  
   # Create the particle filter  
-  pf = ParticleFilter(n_particles, n_viz_particles,
-                      motor_state_topic, servo_state_topic, scan_topic, laser_ray_step,
-                      exclude_max_range_rays, max_range_meters, resample_type,
-                      speed_to_erpm_offset, speed_to_erpm_gain, steering_angle_to_servo_offset,
-                      steering_angle_to_servo_gain, car_length)
-
-  while not rospy.is_shutdown(): # Keep going until we kill it
-    # Callbacks are running in separate threads
-    if pf.sensor_model.do_resample: # Check if the sensor model says it's time to resample
-      pf.sensor_model.do_resample = False # Reset so that we don't keep resampling
-      
-      # Resample
-      if pf.RESAMPLE_TYPE == "naiive":
-        pf.resampler.resample_naiive()
-      elif pf.RESAMPLE_TYPE == "low_variance":
-        pf.resampler.resample_low_variance()
-      else:
-        print "Unrecognized resampling method: "+ pf.RESAMPLE_TYPE      
-      
-      pf.visualize() # Perform visualization
-
-
-
+  pf = ParticleFilter(**read_params())
+  pf.run()
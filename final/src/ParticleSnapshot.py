@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import numpy as np
+from threading import Lock
+
+NUM_SNAPSHOT_BUFFERS = 3  # The latest snapshot, one being read and one being written
+
+'''
+  A consistent copy of the particles and weights at one point in time
+'''
+
+
+class Snapshot:
+
+    '''
+    Initializes an empty snapshot backed by preallocated buffers
+      max_particles: The largest number of particles the snapshot can hold
+      dtype: The dtype of the particles
+  '''
+
+    def __init__(self, max_particles, dtype=np.float64):
+        self.particle_buffer = np.zeros((max_particles, 3), dtype=dtype)
+        self.weight_buffer = np.zeros(max_particles)
+        self.particles = self.particle_buffer[:0]  # View of the captured particles
+        self.weights = self.weight_buffer[:0]  # View of the captured weights
+        self.laser = None  # The laser scan that was last applied to the particles
+        self.version = 0  # Increases by one with every capture
+        self.readers = 0  # Number of readers that have acquired this snapshot
+
+
+'''
+  Multi-buffered snapshots of the filter state, so that visualization and pose publication
+  can read a consistent copy of the particles without holding the filter's state lock.
+  The filter copies its state in with capture (a memory copy, done while holding the state
+  lock), and readers pin the latest copy with acquire until they release it. Capture never
+  writes into the latest or a pinned buffer.
+'''
+
+
+class ParticleSnapshots:
+
+    '''
+    Preallocates the snapshot buffers
+      max_particles: The largest number of particles a snapshot can hold
+      dtype: The dtype of the particles, captures of the same dtype are plain memory copies
+  '''
+
+    def __init__(self, max_particles, dtype=np.float64):
+        self.lock = Lock()  # Guards the bookkeeping below, never held while copying
+        self.snapshots = [Snapshot(max_particles, dtype) for _ in range(NUM_SNAPSHOT_BUFFERS)]
+        self.latest = None  # The most recently captured snapshot
+        self.version = 0  # The version of the most recent capture
+
+    '''
+    Copies the state of the filter into a free snapshot and makes it the latest one
+    The caller must hold the filter's state lock
+      particles: The particles
+      weights: The weights of the particles
+      laser: The laser scan that was last applied to the particles
+      Returns False if every buffer was in use and nothing was captured
+  '''
+
+    def capture(self, particles, weights, laser=None):
+        self.lock.acquire()
+        free = [s for s in self.snapshots if s is not self.latest and s.readers == 0]
+        self.lock.release()
+        if len(free) == 0:
+            return False
+
+        snapshot = free[0]
+        n = particles.shape[0]
+        snapshot.particles = snapshot.particle_buffer[:n]
+        snapshot.weights = snapshot.weight_buffer[:n]
+        snapshot.particles[:] = particles
+        snapshot.weights[:] = weights
+        snapshot.laser = laser
+
+        self.lock.acquire()
+        self.version += 1
+        snapshot.version = self.version
+        self.latest = snapshot
+        self.lock.release()
+        return True
+
+    '''
+    Pins the latest snapshot so that it is not overwritten while it is read
+      Returns the snapshot, or None if nothing has been captured yet. A returned
+      snapshot must be handed back to release
+  '''
+
+    def acquire(self):
+        self.lock.acquire()
+        snapshot = self.latest
+        if snapshot is not None:
+            snapshot.readers += 1
+        self.lock.release()
+        return snapshot
+
+    '''
+    Unpins a snapshot returned by acquire
+      snapshot: The snapshot
+  '''
+
+    def release(self, snapshot):
+        self.lock.acquire()
+        snapshot.readers -= 1
+        self.lock.release()
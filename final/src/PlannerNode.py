@@ -134,16 +134,7 @@ class PlannerNode(object):
         self.target_lock.release()
 
     def publish_plan(self, plan):
-        pa = PoseArray()
-        pa.header.frame_id = "/map"
-        for i in xrange(len(plan)):
-            config = plan[i]
-            pose = Pose()
-            pose.position.x = config[0]
-            pose.position.y = config[1]
-            pose.position.z = 0.0
-            pose.orientation = Putils.angle_to_quaternion(config[2])
-            pa.poses.append(pose)
+        pa = Putils.poses_to_pose_array(plan, "/map")
         self.plan_pub.publish(pa)
 
     def add_orientation(self, plan):
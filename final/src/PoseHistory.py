@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+from collections import deque
+from threading import Lock
+
+import numpy as np
+
+POSE_HISTORY_SIZE = 1000  # Motions kept before the oldest ones are dropped
+
+'''
+  Time-indexed ring buffer of the nominal motion applied to the particles, so that a
+  scan taken before the latest motion update can be evaluated against the particles as
+  they were when it was taken. Each motion is an arc, recorded with the time at which it
+  ends and its duration, as the distance travelled along it and its heading change.
+'''
+
+
+class PoseHistory:
+
+    '''
+    Initializes an empty history
+      size: The number of motions kept before the oldest ones are dropped
+  '''
+
+    def __init__(self, size=POSE_HISTORY_SIZE):
+        self.lock = Lock()
+        self.motions = deque(maxlen=size)  # (end stamp, duration, distance, dtheta) tuples, oldest first
+        self.forgotten_until = None  # End stamp of the latest motion that has been dropped
+
+    '''
+    Records a motion
+      stamp: The time in seconds at which the motion ends
+      duration: The time in seconds over which the motion was applied
+      distance: The distance travelled along the arc
+      dtheta: The heading change along the arc
+  '''
+
+    def add(self, stamp, duration, distance, dtheta):
+        self.lock.acquire()
+        if len(self.motions) == self.motions.maxlen:
+            self.forgotten_until = self.motions[0][0]
+        self.motions.append((stamp, duration, distance, dtheta))
+        self.lock.release()
+
+    '''
+    Composes the motion recorded after a time into a single displacement. A motion that
+    straddles the time contributes the fraction of its arc after it
+      stamp: The time in seconds
+      Returns the (dx, dy, dtheta) displacement, in the frame of the pose at stamp,
+      or None if part of the motion after stamp has been dropped
+  '''
+
+    def delta_since(self, stamp):
+        self.lock.acquire()
+        if self.forgotten_until is not None and stamp < self.forgotten_until:
+            self.lock.release()
+            return None
+        motions = [m for m in self.motions if m[0] > stamp]
+        self.lock.release()
+
+        x, y, theta = 0.0, 0.0, 0.0
+        for end, duration, distance, dtheta in motions:
+            if duration > 0 and end - duration < stamp:
+                fraction = (end - stamp) / duration
+                distance *= fraction
+                dtheta *= fraction
+            half = 0.5 * dtheta
+            chord = np.sinc(half / np.pi)  # sin(half)/half, 1 on a straight line
+            x += distance * chord * np.cos(theta + half)
+            y += distance * chord * np.sin(theta + half)
+            theta += dtheta
+        return x, y, theta
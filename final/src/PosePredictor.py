@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+from collections import deque
+from threading import Lock
+
+import numpy as np
+import rospy
+from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped
+
+import Utils
+from MotionModel import STRAIGHT_LINE_EPS, noise_std
+
+PUBLISH_PREFIX = '/pf/viz'  # Namespace of the published topics
+PREDICTION_HISTORY_SIZE = 200  # Controls kept to be replayed after a correction
+
+'''
+  Predicts the pose of the car at the rate of the control stream, between the corrections
+  made by the particle filter. Every control moves a single Gaussian pose estimate through
+  the kinematic car model, as in the prediction step of an EKF, and the estimate is
+  published right away. After every scan the filter resets the estimate to the mean and
+  covariance of its particles, and the controls received after the particles' stamp are
+  replayed on top of it.
+'''
+
+
+class PosePredictor:
+
+    '''
+    Initializes the predictor
+      car_length: The length of the car
+      publish: Whether to publish the predicted pose
+      history_size: The number of controls kept to be replayed after a correction
+      prefix: The namespace of the published topics
+      noise_params: Dict overriding the noise of the motion model, see MotionModel.noise_std
+  '''
+
+    def __init__(self, car_length, publish=True, history_size=PREDICTION_HISTORY_SIZE, prefix=PUBLISH_PREFIX,
+                 noise_params=None):
+        self.CAR_LENGTH = car_length
+        std = noise_std(noise_params)
+        self.CONTROL_COV = np.diag(np.square(std[:2]))  # Covariance of the (speed, steering) noise
+        self.FIX_COV = np.diag(np.square(std[2:]))  # Covariance of the model noise
+
+        self.lock = Lock()
+        self.controls = deque(maxlen=history_size)  # (stamp, speed, steering, dt) of the latest controls
+        self.pose = None  # The predicted [x, y, theta], None until the first correction
+        self.covariance = None  # The 3x3 covariance of the predicted pose
+        self.stamp = None  # The time in seconds of the predicted pose
+
+        self.pose_pub = None
+        self.pose_cov_pub = None
+        if publish:
+            self.pose_pub = rospy.Publisher(prefix + "/predicted_pose", PoseStamped, queue_size=1)
+            self.pose_cov_pub = rospy.Publisher(prefix + "/predicted_pose_with_covariance",
+                                                PoseWithCovarianceStamped, queue_size=1)
+
+    '''
+    Resets the prediction to an estimate of the filter, and replays the controls received
+    after that estimate
+      pose: The [x, y, theta] estimate
+      covariance: The 3x3 covariance of the estimate
+      stamp: The time in seconds of the estimate
+  '''
+
+    def correct(self, pose, covariance, stamp):
+        self.lock.acquire()
+        self.pose = np.array(pose, dtype=np.float64)
+        self.covariance = np.array(covariance, dtype=np.float64)
+        self.stamp = stamp
+        for control_stamp, speed, steering, dt in self.controls:
+            if control_stamp > stamp:
+                # The control covers (control_stamp - dt, control_stamp], only part of it is new
+                self.apply(speed, steering, min(dt, control_stamp - stamp))
+                self.stamp = control_stamp
+        self.lock.release()
+        self.publish()
+
+    '''
+    Records a control and moves the prediction by it. Meant to be called by the motion
+    model for every control, see KinematicMotionModel.on_control
+      stamp: The time in seconds of the control
+      speed: The speed of the car
+      steering: The steering angle of the car
+      dt: The time over which the control was applied
+  '''
+
+    def predict(self, stamp, speed, steering, dt):
+        self.lock.acquire()
+        self.controls.append((stamp, speed, steering, dt))
+        if self.pose is None or stamp <= self.stamp:
+            self.lock.release()
+            return
+        self.apply(speed, steering, min(dt, stamp - self.stamp))
+        self.stamp = stamp
+        self.lock.release()
+        self.publish()
+
+    '''
+    Moves the pose along the arc of the nominal controls, and the covariance through the
+    linearized model: P = F P F^T + G M G^T + R. The controls move the pose through the
+    distance travelled, including the chord of the arc, and through the heading change.
+    The caller must hold lock
+      speed: The speed of the car
+      steering: The steering angle of the car
+      dt: The time over which the control is applied
+  '''
+
+    def apply(self, speed, steering, dt):
+        beta = np.arctan(np.tan(steering) / 2)
+        sin_2beta = np.sin(2 * beta)
+        dtheta = speed * sin_2beta * dt / self.CAR_LENGTH
+
+        half = 0.5 * dtheta
+        chord = 1.0 if abs(half) < STRAIGHT_LINE_EPS else np.sin(half) / half
+        dchord = -half / 3.0 if abs(half) < STRAIGHT_LINE_EPS else (np.cos(half) - chord) / half  # d(chord)/d(half)
+        heading = self.pose[2] + half
+        distance = speed * dt * chord
+        cos_h, sin_h = np.cos(heading), np.sin(heading)
+
+        # Jacobians with respect to the pose and to the (speed, steering) controls
+        F = np.array([[1.0, 0.0, -distance * sin_h],
+                      [0.0, 1.0, distance * cos_h],
+                      [0.0, 0.0, 1.0]])
+        dbeta_dsteering = 0.5 / (np.cos(steering)**2 * (1.0 + 0.25 * np.tan(steering)**2))
+        ddtheta = np.array([sin_2beta * dt, speed * dt * 2 * np.cos(2 * beta) * dbeta_dsteering]) / self.CAR_LENGTH
+        ddistance = 0.5 * speed * dt * dchord * ddtheta  # The chord shrinks as the arc bends
+        ddistance[0] += dt * chord
+        G = np.zeros((3, 2))
+        G[:2, :] = np.outer([cos_h, sin_h], ddistance) - 0.5 * distance * np.outer([sin_h, -cos_h], ddtheta)
+        G[2, :] = ddtheta
+
+        self.pose[0] += distance * cos_h
+        self.pose[1] += distance * sin_h
+        self.pose[2] = np.mod(self.pose[2] + dtheta + np.pi, 2 * np.pi) - np.pi
+        self.covariance = F.dot(self.covariance).dot(F.T) + G.dot(self.CONTROL_COV).dot(G.T) + self.FIX_COV
+
+    '''
+    Publishes the predicted pose, with and without its covariance, to the topics that
+    have subscribers
+  '''
+
+    def publish(self):
+        if self.pose_pub is None:
+            return
+        self.lock.acquire()
+        if self.pose is None:
+            self.lock.release()
+            return
+        pose = self.pose.copy()
+        covariance = self.covariance.copy()
+        stamp = self.stamp
+        self.lock.release()
+
+        ps = PoseStamped()
+        ps.header = Utils.make_header("map", rospy.Time.from_sec(stamp))
+        ps.pose.position.x = pose[0]
+        ps.pose.position.y = pose[1]
+        ps.pose.orientation = Utils.angle_to_quaternion(pose[2])
+        if self.pose_pub.get_num_connections() > 0:
+            self.pose_pub.publish(ps)
+
+        if self.pose_cov_pub.get_num_connections() > 0:
+            pwc = PoseWithCovarianceStamped()
+            pwc.header = ps.header
+            pwc.pose.pose = ps.pose
+            # Row major 6x6 over (x, y, z, roll, pitch, yaw)
+            cov = np.zeros((6, 6))
+            cov[np.ix_([0, 1, 5], [0, 1, 5])] = covariance
+            pwc.pose.covariance = cov.ravel().tolist()
+            self.pose_cov_pub.publish(pwc)
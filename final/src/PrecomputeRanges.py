@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+import time
+
+import rospy
+from nav_msgs.srv import GetMap
+
+from RangeMethod import precompute_range_table
+from SensorModel import THETA_DISCRETIZATION
+
+'''
+  Offline tool that precomputes the expected range of every free cell and heading bin
+  of the map served on MAP_TOPIC. The sensor model memory maps the result when it is
+  launched with range_method set to 'lut', so every filter on the host shares one copy.
+  Usage: rosrun final PrecomputeRanges.py _max_range_meters:=11.0
+'''
+
+MAP_TOPIC = 'static_map'
+
+if __name__ == '__main__':
+    rospy.init_node("precompute_ranges", anonymous=True)  # Initialize the node
+
+    max_range_meters = float(rospy.get_param("~max_range_meters", 11.0))  # The max range of the laser
+    theta_discretization = int(rospy.get_param("~theta_discretization", THETA_DISCRETIZATION))  # Number of heading bins
+    range_method = rospy.get_param("~range_method", "cddt")  # The backend used to cast the rays
+
+    print("Getting map from service: ", MAP_TOPIC)
+    rospy.wait_for_service(MAP_TOPIC)
+    map_msg = rospy.ServiceProxy(MAP_TOPIC, GetMap)().map
+
+    max_range_px = int(max_range_meters / map_msg.info.resolution)  # The max range in pixels of the laser
+
+    start = time.time()
+    table_dir = precompute_range_table(map_msg, max_range_px, theta_discretization, range_method)
+    print('Wrote range table to %s in %.1f seconds' % (table_dir, time.time() - start))
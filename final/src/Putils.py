@@ -11,6 +11,9 @@ from geometry_msgs.msg import (Point, Point32, PointStamped, Polygon,
 from std_msgs.msg import Header
 from visualization_msgs.msg import Marker
 
+# Batched conversions shared with the particle filter nodes
+from Utils import angles_to_quaternions, quaternions_to_angles, poses_to_pose_array
+
 
 def angle_to_quaternion(angle):
     """Convert an angle in radians into a quaternion _message_."""
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy import ndimage
+
+import Utils
+
+try:
+    import range_libc
+except ImportError:
+    range_libc = None  # Only the numpy backend is available without the compiled extension
+
+STEP_COEFF = 0.999  # Fraction of the distance transform value advanced per marching step
+MIN_STEP_PX = 1.0  # Smallest step (in pixels) taken by a marching ray
+
+RANGE_TABLE_DIR = os.path.expanduser('~/.ros/range_tables')  # Where precomputed range tables are stored
+RANGE_TABLE_SCALE = 1000.0  # Range table units per meter (uint16 millimeters cover up to 65m)
+
+'''
+  Ray casting backends used by the sensor model
+
+  Every backend exposes the same three methods as the range_libc classes:
+    set_sensor_model(table): Loads the [max_range_px+1, max_range_px+1] sensor model table
+    calc_range_repeat_angles(queries, angles, ranges): Casts len(angles) rays from each
+        query pose. queries is an Nx3 float32 array of world poses, angles is a float32 array
+        of ray angles relative to the pose and ranges is a float32 array with at least
+        N*len(angles) elements. Element i*len(angles)+j of ranges is set to the range (in meters)
+        of ray j cast from query i
+    eval_sensor_model(obs, ranges, weights, num_rays, num_particles): Sets weights[i] to the
+        product over the num_rays rays of the table entry for the observed range obs[j] and the
+        expected range ranges[i*num_rays+j]
+'''
+
+'''
+  Builds the requested ray casting backend
+    map_msg: A nav_msgs/OccupancyGrid containing the map to cast against
+    max_range_px: The max range of the laser in pixels
+    theta_discretization: Number of heading bins used by the CDDT backend
+    range_method: One of 'cddt', 'rmgpu', 'numpy' or 'lut'. If range_libc is not installed,
+                  the numpy backend is used instead of the compiled ones. If no precomputed
+                  range table exists for this map, 'lut' falls back to 'cddt'
+    Returns the backend
+'''
+def make_range_method(map_msg, max_range_px, theta_discretization, range_method='cddt'):
+    if range_method == 'numpy':
+        return NumpyRayMarching(map_msg, max_range_px)
+
+    if range_method == 'lut':
+        table_dir = range_table_dir(map_msg, max_range_px, theta_discretization)
+        if os.path.isdir(table_dir):
+            return LookupTableCast(map_msg, max_range_px, table_dir)
+        print('No precomputed range table in ' + table_dir + ', run PrecomputeRanges.py to create it')
+        range_method = 'cddt'
+
+    if range_libc is None:
+        print('range_libc is not available, falling back to the numpy range method')
+        return NumpyRayMarching(map_msg, max_range_px)
+
+    oMap = range_libc.PyOMap(map_msg)  # A version of the map that range_libc can understand
+    if range_method == 'cddt':
+        return range_libc.PyCDDTCast(oMap, max_range_px, theta_discretization)
+    elif range_method == 'rmgpu':
+        return range_libc.PyRayMarchingGPU(oMap, max_range_px)
+    else:
+        raise ValueError('Unrecognized range method: ' + str(range_method))
+
+'''
+  Returns a boolean array of dimension (map_msg.info.height, map_msg.info.width)
+  that is True where the map is occupied (or unknown), matching range_libc's PyOMap
+    map_msg: A nav_msgs/OccupancyGrid
+'''
+def occupancy_grid(map_msg):
+    array_255 = np.array(map_msg.data).reshape((map_msg.info.height, map_msg.info.width))
+    return (array_255 > 10) | (array_255 < 0)
+
+'''
+  Returns a hex digest of the map contents and geometry, used to key files derived from the map
+    map_msg: A nav_msgs/OccupancyGrid
+'''
+def map_hash(map_msg):
+    info = map_msg.info
+    h = hashlib.sha1()
+    h.update(np.array(map_msg.data, dtype=np.int8).tobytes())
+    h.update(np.array([info.width, info.height], dtype=np.int64).tobytes())
+    h.update(np.array([info.resolution,
+                       info.origin.position.x, info.origin.position.y, info.origin.position.z,
+                       info.origin.orientation.x, info.origin.orientation.y,
+                       info.origin.orientation.z, info.origin.orientation.w], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+'''
+  Returns the directory holding the precomputed range table for a map
+    map_msg: A nav_msgs/OccupancyGrid
+    max_range_px: The max range of the laser in pixels
+    theta_discretization: The number of heading bins
+'''
+def range_table_dir(map_msg, max_range_px, theta_discretization):
+    return RANGE_TABLE_DIR + '/' + "_".join((map_hash(map_msg), str(int(max_range_px)),
+                                             str(int(theta_discretization))))
+
+'''
+  Precomputes the expected range for every free cell of the map and every heading bin,
+  and writes the result to range_table_dir(map_msg, max_range_px, theta_discretization)
+  The directory contains two arrays:
+    cells.npy: int32 array of dimension (map height, map width) holding the row of ranges.npy
+               for each free cell, and -1 for all other cells
+    ranges.npy: uint16 array of dimension (number of free cells, theta_discretization) holding
+                ranges in 1/RANGE_TABLE_SCALE meters. Heading bin k points at
+                k*2*pi/theta_discretization radians in the map frame
+    map_msg: A nav_msgs/OccupancyGrid
+    max_range_px: The max range of the laser in pixels
+    theta_discretization: The number of heading bins
+    range_method: The backend used to cast the rays
+    chunk_size: The number of cells cast per backend call
+    Returns the directory the table was written to
+'''
+def precompute_range_table(map_msg, max_range_px, theta_discretization, range_method='cddt',
+                           chunk_size=2000):
+    caster = make_range_method(map_msg, max_range_px, theta_discretization, range_method)
+    info = map_msg.info
+
+    array_255 = np.array(map_msg.data).reshape((info.height, info.width))
+    free_y, free_x = np.where(array_255 == 0)
+    cells = np.full((info.height, info.width), -1, dtype=np.int32)
+    cells[free_y, free_x] = np.arange(free_x.shape[0], dtype=np.int32)
+
+    # Cast from the center of every cell. map_to_world turns the zero heading of the
+    # queries into the heading of the map's x axis, so bins are relative to the map frame
+    angles = (np.arange(theta_discretization) * (2*np.pi / theta_discretization)).astype(np.float32)
+    ranges = np.zeros((free_x.shape[0], theta_discretization), dtype=np.uint16)
+    queries = np.zeros((chunk_size, 3), dtype=np.float32)
+    out = np.zeros(chunk_size*theta_discretization, dtype=np.float32)
+    max_units = np.iinfo(np.uint16).max
+    for start in range(0, free_x.shape[0], chunk_size):
+        end = min(start + chunk_size, free_x.shape[0])
+        n = end - start
+        poses = np.zeros((n, 3))
+        poses[:, 0] = free_x[start:end] + 0.5
+        poses[:, 1] = free_y[start:end] + 0.5
+        Utils.map_to_world(poses, info)
+        queries[:n] = poses
+        caster.calc_range_repeat_angles(queries[:n], angles, out)
+        ranges[start:end] = np.clip(np.rint(out[:n*theta_discretization] * RANGE_TABLE_SCALE),
+                                    0, max_units).reshape((n, theta_discretization))
+
+    table_dir = range_table_dir(map_msg, max_range_px, theta_discretization)
+    if not os.path.isdir(RANGE_TABLE_DIR):
+        os.makedirs(RANGE_TABLE_DIR)
+
+    # Assemble the table next to its final location and move it into place in one step
+    tmp_dir = tempfile.mkdtemp(dir=RANGE_TABLE_DIR)
+    np.save(tmp_dir + '/cells.npy', cells)
+    np.save(tmp_dir + '/ranges.npy', ranges)
+    try:
+        os.rename(tmp_dir, table_dir)
+    except OSError:
+        # A table is already there, left by an earlier (possibly interrupted) run or just
+        # written by another node. Move it aside so that the new table replaces it
+        old_dir = tempfile.mkdtemp(dir=RANGE_TABLE_DIR)
+        try:
+            os.rename(table_dir, old_dir + '/table')
+            os.rename(tmp_dir, table_dir)
+        except OSError:
+            # Another node moved its own copy of the same table into place first, keep it
+            if not os.path.isdir(table_dir):
+                raise
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return table_dir
+
+'''
+  Functionality shared by the numpy backends: map geometry and sensor model evaluation
+'''
+class NumpyRangeMethod:
+
+    '''
+      Stores the geometry of the map
+        map_msg: A nav_msgs/OccupancyGrid containing the map to cast against
+        max_range_px: The max range of the laser in pixels
+    '''
+    def __init__(self, map_msg, max_range_px):
+        self.max_range_px = int(max_range_px)
+        self.resolution = float(map_msg.info.resolution)
+        self.origin_x = map_msg.info.origin.position.x
+        self.origin_y = map_msg.info.origin.position.y
+        self.origin_angle = Utils.quaternion_to_angle(map_msg.info.origin.orientation)
+        self.height = map_msg.info.height
+        self.width = map_msg.info.width
+        self.sensor_model_table = None
+
+    '''
+      Loads the sensor model table used by eval_sensor_model
+        table: The [max_range_px+1, max_range_px+1] sensor model table
+    '''
+    def set_sensor_model(self, table):
+        self.sensor_model_table = np.array(table, dtype=np.float64)
+
+    '''
+      Converts world poses into (x, y, theta) in map pixels
+        queries: An Nx3 array of world poses
+        Returns three arrays of length N
+    '''
+    def world_to_map(self, queries):
+        c, s = np.cos(-self.origin_angle), np.sin(-self.origin_angle)
+        x = queries[:, 0] - self.origin_x
+        y = queries[:, 1] - self.origin_y
+        map_x = (c*x - s*y) / self.resolution
+        map_y = (s*x + c*y) / self.resolution
+        map_theta = queries[:, 2] - self.origin_angle
+        return map_x, map_y, map_theta
+
+    '''
+      Evaluates the sensor model table for every particle, see the module description
+    '''
+    def eval_sensor_model(self, obs, ranges, weights, num_rays, num_particles):
+        inv_scale = 1.0 / self.resolution
+        max_idx = self.max_range_px
+
+        # Same discretization as range_libc
+        r = np.clip(np.asarray(obs[:num_rays]) * inv_scale, 0.0, max_idx).astype(np.intp)
+        d = np.clip(ranges[:num_particles*num_rays] * inv_scale, 0.0, max_idx).astype(np.intp)
+        d = d.reshape((num_particles, num_rays))
+
+        weights[:num_particles] = np.prod(self.sensor_model_table[r[np.newaxis, :], d], axis=1)
+
+'''
+  Answers ray queries from a table precomputed by precompute_range_table. The table
+  is memory mapped, so every process using the same map shares a single copy of it,
+  and a query costs one gather.
+'''
+class LookupTableCast(NumpyRangeMethod):
+
+    '''
+      Maps the precomputed table
+        map_msg: A nav_msgs/OccupancyGrid containing the map to cast against
+        max_range_px: The max range of the laser in pixels
+        table_dir: The directory written by precompute_range_table
+    '''
+    def __init__(self, map_msg, max_range_px, table_dir):
+        NumpyRangeMethod.__init__(self, map_msg, max_range_px)
+        self.cells = np.load(table_dir + '/cells.npy', mmap_mode='r')
+        self.table = np.load(table_dir + '/ranges.npy', mmap_mode='r')
+        self.theta_discretization = self.table.shape[1]
+
+        # Flat views let a query be answered with a single take
+        self.flat_cells = self.cells.reshape(-1)
+        self.flat_table = self.table.reshape(-1)
+
+    '''
+      Looks up len(angles) rays for each query, see the module description
+      Queries outside of the free space of the map get a range of zero
+    '''
+    def calc_range_repeat_angles(self, queries, angles, ranges):
+        num_queries = queries.shape[0]
+        num_rays = angles.shape[0]
+
+        map_x, map_y, map_theta = self.world_to_map(queries)
+        col = np.floor(map_x).astype(np.intp)
+        row = np.floor(map_y).astype(np.intp)
+        inside = (col >= 0) & (col < self.width) & (row >= 0) & (row < self.height)
+        cell = np.full(num_queries, -1, dtype=np.intp)
+        cell[inside] = self.flat_cells[row[inside]*self.width + col[inside]]
+
+        bin_width = 2*np.pi / self.theta_discretization
+        theta = map_theta[:, np.newaxis] + angles[np.newaxis, :]
+        theta_bin = np.rint(theta / bin_width).astype(np.intp) % self.theta_discretization
+
+        idx = cell[:, np.newaxis]*self.theta_discretization + theta_bin
+        out = np.take(self.flat_table, np.maximum(idx, 0)).astype(np.float32)
+        out *= 1.0 / RANGE_TABLE_SCALE
+        out[cell < 0, :] = 0.0
+        ranges[:num_queries*num_rays] = out.ravel()
+
+'''
+  Pure numpy ray marching over a precomputed distance transform of the map.
+  All rays of a query are marched together, so the cost per iteration is a handful
+  of vectorized operations over the rays that have not terminated yet.
+'''
+class NumpyRayMarching(NumpyRangeMethod):
+
+    '''
+      Initializes the ray marcher
+        map_msg: A nav_msgs/OccupancyGrid containing the map to cast against
+        max_range_px: The max range of the laser in pixels
+    '''
+    def __init__(self, map_msg, max_range_px):
+        NumpyRangeMethod.__init__(self, map_msg, max_range_px)
+
+        # Distance (in pixels) from every cell to the closest occupied cell.
+        # Values beyond the max range never change the outcome of a march, so clip them.
+        occupied = occupancy_grid(map_msg)
+        self.dist = ndimage.distance_transform_edt(~occupied).astype(np.float32)
+        np.minimum(self.dist, self.max_range_px, self.dist)
+
+    '''
+      Casts the rays defined by their origins and headings in map pixels
+        x, y, theta: Arrays with the origin and heading of each ray
+        Returns the range of each ray in pixels
+    '''
+    def march(self, x, y, theta):
+        dx = np.cos(theta)
+        dy = np.sin(theta)
+        t = np.zeros(x.shape[0], dtype=np.float32)
+
+        # Rays still being marched. Each step advances a ray by at least
+        # MIN_STEP_PX, so no ray needs more than max_range_px steps
+        active = np.arange(x.shape[0])
+        for _ in range(self.max_range_px + 1):
+            if active.shape[0] == 0:
+                break
+            ta = t[active]
+            px = x[active] + dx[active]*ta
+            py = y[active] + dy[active]*ta
+
+            # Rays that leave the map see nothing
+            inside = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+            t[active[~inside]] = self.max_range_px
+            active = active[inside]
+            ta = ta[inside]
+
+            # Rays that landed on an occupied cell have hit something
+            d = self.dist[py[inside].astype(np.intp), px[inside].astype(np.intp)]
+            moving = d > 0.0
+            active = active[moving]
+
+            ta = ta[moving] + np.maximum(d[moving]*STEP_COEFF, MIN_STEP_PX)
+            np.minimum(ta, self.max_range_px, ta)
+            t[active] = ta
+            active = active[ta < self.max_range_px]
+
+        return t
+
+    '''
+      Casts len(angles) rays from each query, see the module description
+    '''
+    def calc_range_repeat_angles(self, queries, angles, ranges):
+        num_queries = queries.shape[0]
+        num_rays = angles.shape[0]
+
+        map_x, map_y, map_theta = self.world_to_map(queries)
+        theta = (map_theta[:, np.newaxis] + angles[np.newaxis, :]).ravel()
+        x = np.repeat(map_x, num_rays)
+        y = np.repeat(map_y, num_rays)
+
+        ranges[:num_queries*num_rays] = self.march(x, y, theta) * self.resolution
+
@@ -5,6 +5,13 @@ import rospy
 import numpy as np
 from threading import Lock
 
+RESAMPLE_TYPES = ('naiive', 'multinomial', 'low_variance', 'stratified', 'residual')
+
+KLD_EPSILON = 0.05  # Maximum KL divergence between the sample based and true posterior
+KLD_Z = 2.326  # Upper 1 - delta quantile of the standard normal, for delta = 0.01
+KLD_XY_BIN = 0.25  # Size of the histogram bins in x and y (meters)
+KLD_THETA_BIN = np.pi / 18  # Size of the histogram bins in theta (radians), divides 2*pi
+
 '''
   Provides methods for re-sampling from a distribution represented by weighted samples
 '''
@@ -17,15 +24,25 @@ class ReSampler:
       particles: The particles to sample from
       weights: The weights of each particle
       state_lock: Controls access to particles and weights
+      max_particles: The largest number of particles that will be resampled, used to size
+                     the buffers. Defaults to the number of particles
+      log_weights: The accumulated log likelihood of each particle, reset on resample if given
+    The particles may be of any dtype. Resampling into a buffer of the same dtype and layout
+    (resample_into, resample_kld) never converts or copies them back
     '''
 
-    def __init__(self, particles, weights, state_lock=None):
+    def __init__(self, particles, weights, state_lock=None, max_particles=None, log_weights=None):
         self.particles = particles
         self.weights = weights
+        self.log_weights = log_weights
 
-        # For speed purposes, you may wish to add additional member variable(s) that
-        # cache computations that will be reused in the re-sampling functions
-        # YOUR CODE HERE?
+        # Scratch buffers, allocated once for the largest number of particles
+        capacity = particles.shape[0] if max_particles is None else max(max_particles, particles.shape[0])
+        self.cdf = np.zeros(capacity)  # Cumulative sum of the weights
+        self.positions = np.zeros(capacity)  # Points in [0, 1) at which the cdf is inverted
+        self.steps = np.arange(capacity, dtype=np.float64)  # Cached 0, 1, ..., capacity - 1
+        self.capacity = capacity
+        self.particles_tmp = None  # Scratch particles of resample, allocated on first use
 
         if state_lock is None:
             self.state_lock = Lock()
@@ -33,43 +50,187 @@ class ReSampler:
             self.state_lock = state_lock
 
     '''
-    Performs independently, identically distributed in-place sampling of particles
+    Returns the effective sample size of the weighted particles, 1 / sum(w^2) for normalized
+    weights. It is the number of particles when the weights are uniform, and 1 when a single
+    particle holds all the weight
+    The caller must hold state_lock, so that the weights do not change between computing
+    it and acting on it
   '''
 
-    def resample_naiive(self):
+    def effective_sample_size(self):
+        total = np.sum(self.weights)
+        return total * total / np.dot(self.weights, self.weights)
+
+    '''
+    Performs in-place resampling of the particles with the given method, and resets the weights
+    to be uniform
+      method: One of RESAMPLE_TYPES
+  '''
+
+    def resample(self, method):
         self.state_lock.acquire()
 
-        # YOUR CODE HERE
-        Indices = np.random.choice(self.weights.shape[0], self.weights.shape[0], p=self.weights)
-        self.particles[:] = self.particles[Indices][:]
+        if self.particles_tmp is None:
+            self.particles_tmp = np.zeros((self.capacity,) + self.particles.shape[1:],
+                                          dtype=self.particles.dtype)
+        M = self.resample_into(method, self.particles_tmp)
+        self.particles[:] = self.particles_tmp[:M]
+        self.reset_weights()
 
         self.state_lock.release()
 
+    '''
+    Draws as many particles as there are now with the given method, directly into another
+    buffer, so that the owner of the buffers can swap them instead of copying the particles
+    back. The caller must hold state_lock, must make the first rows of out the particles,
+    and must then reset the weights
+      method: One of RESAMPLE_TYPES
+      out: A particle buffer with at least as many rows as self.particles, that does not
+           overlap them
+      Returns the number of particles written to the start of out
+  '''
+
+    def resample_into(self, method, out):
+        M = self.weights.shape[0]
+        indices = self.draw_indices(M, method)
+        np.take(self.particles, indices, axis=0, out=out[:M])
+        return M
+
+    '''
+    Sets the weights to be uniform and clears the accumulated log weights
+    The caller must hold state_lock
+  '''
+
+    def reset_weights(self):
+        self.weights[:] = 1.0 / self.weights.shape[0]
+        if self.log_weights is not None:
+            self.log_weights[:] = 0.0
+
+    '''
+    Performs independently, identically distributed in-place sampling of particles
+  '''
+
+    def resample_naiive(self):
+        self.resample('multinomial')
+
     '''
     Performs in-place, lower variance sampling of particles
     (As discussed on pg 110 of Probabilistic Robotics)
   '''
 
     def resample_low_variance(self):
-        self.state_lock.acquire()
+        self.resample('low_variance')
+
+    '''
+    Draws indices of particles in proportion to their weights. Every method inverts the
+    cumulative sum of the weights at n points in [0, 1) with a single searchsorted:
+      multinomial: n independent uniform points
+      low_variance: n evenly spaced points with a single random offset (systematic)
+      stratified: one independent uniform point in each of n equal strata
+      residual: floor(n*w) deterministic copies of each particle, and the remaining
+                draws are multinomial on the residual weights
+    The caller must hold state_lock
+      n: The number of indices to draw, at most the capacity of the buffers
+      method: One of RESAMPLE_TYPES ('naiive' is an alias for 'multinomial')
+      Returns an array of n indices into self.particles
+  '''
 
-        # YOUR CODE HERE
-        self.weights /= np.sum(self.weights)
-        particles_tmp = np.zeros_like(self.particles)
-
-        M = len(self.weights)
-        r = (1.0/M) * np.random.rand(1)
-        c = self.weights[0]
-        i = 0
-        for m in range(M):
-            U = r + float(m)/M
-            while U > c:
-                i += 1
-                c = c+self.weights[i]
-            particles_tmp[m] = self.particles[i]
-        self.particles[:] = particles_tmp[:]
+    def draw_indices(self, n, method):
+        M = self.weights.shape[0]
 
-        self.state_lock.release()
+        if method == 'residual':
+            scaled = n * self.weights / np.sum(self.weights)
+            copies = np.floor(scaled).astype(np.intp)
+            deterministic = np.repeat(np.arange(M), copies)
+            n_rest = n - deterministic.shape[0]
+            if n_rest == 0:
+                return deterministic
+            cdf = self.cdf[:M]
+            np.cumsum(scaled - copies, out=cdf)
+            positions = self.positions[:n_rest]
+            positions[:] = np.random.random(n_rest)
+            return np.concatenate((deterministic, self.invert_cdf(cdf, positions)))
+
+        cdf = self.cdf[:M]
+        np.cumsum(self.weights, out=cdf)
+        positions = self.positions[:n]
+        if method in ('naiive', 'multinomial'):
+            positions[:] = np.random.random(n)
+        elif method == 'low_variance':
+            np.add(self.steps[:n], np.random.random(), out=positions)
+            positions *= 1.0 / n
+        elif method == 'stratified':
+            np.add(self.steps[:n], np.random.random(n), out=positions)
+            positions *= 1.0 / n
+        else:
+            raise ValueError('Unrecognized resampling method: ' + str(method))
+        return self.invert_cdf(cdf, positions)
+
+    '''
+    Returns the indices at which the cumulative weights first exceed each position
+      cdf: The unnormalized cumulative sum of the weights
+      positions: Points in [0, 1)
+  '''
+
+    def invert_cdf(self, cdf, positions):
+        positions *= cdf[-1]
+        indices = np.searchsorted(cdf, positions, side='right')
+        np.minimum(indices, cdf.shape[0] - 1, indices)  # Guard against round off at the end of the cdf
+        return indices
+
+    '''
+    Performs KLD-sampling (Fox, 2003): the number of particles drawn is the smallest
+    number for which the KL divergence between the sampled and the true posterior stays
+    below KLD_EPSILON with probability 1 - delta, given the number of histogram bins that
+    the samples occupy.
+    The count is picked on a multinomial draw of out.shape[0] indices, every prefix of
+    which is itself a sample, so each resample costs a draw of the maximum number of
+    indices (but only a gather of the chosen number of particles). The particles are then
+    drawn with method, reusing that prefix for multinomial.
+    The caller must hold state_lock, must make the first rows of out the particles, with
+    the returned count, and must then reset the weights.
+      out: A preallocated particle buffer that does not overlap self.particles. Its length
+           is the maximum number of particles
+      min_particles: The minimum number of particles to draw
+      method: One of RESAMPLE_TYPES, the scheme the chosen number of particles is drawn with
+      Returns the number of particles written to the start of out
+  '''
+
+    def resample_kld(self, out, min_particles, method='multinomial'):
+        max_particles = out.shape[0]
+
+        # Histogram bin of every particle, as a single integer key. A sample falls in the
+        # bin of the particle it copies, so only the current particles are binned
+        bins = np.floor(self.particles / np.array([KLD_XY_BIN, KLD_XY_BIN, KLD_THETA_BIN])).astype(np.int64)
+        # Headings are not wrapped, so theta and theta + 2*pi must share a bin
+        bins[:, 2] %= int(round(2 * np.pi / KLD_THETA_BIN))
+        bins -= bins.min(axis=0)
+        dims = bins.max(axis=0) + 1
+        particle_keys = (bins[:, 0] * dims[1] + bins[:, 1]) * dims[2] + bins[:, 2]
+
+        # Draw the largest sample that could be needed, in random order, so that
+        # every prefix of it is itself a sample from the weighted particles
+        indices = self.draw_indices(max_particles, 'multinomial')
+        keys = particle_keys[indices]
+
+        # k[n-1] is the number of bins occupied by the first n samples
+        _, first = np.unique(keys, return_index=True)
+        counts = np.arange(1, max_particles + 1)
+        k = np.searchsorted(np.sort(first), counts)
+
+        # Wilson-Hilferty approximation of the chi-square quantile
+        k1 = np.maximum(k - 1, 1).astype(np.float64)
+        a = 2.0 / (9.0 * k1)
+        bound = k1 / (2.0 * KLD_EPSILON) * np.power(1.0 - a + np.sqrt(a) * KLD_Z, 3)
+        bound[k <= 1] = 0.0
+
+        enough = np.flatnonzero(counts >= np.maximum(bound, min_particles))
+        n = counts[enough[0]] if enough.shape[0] > 0 else max_particles
+
+        if method not in ('naiive', 'multinomial'):
+            indices = self.draw_indices(n, method)
+        np.take(self.particles, indices[:n], axis=0, out=out[:n])
+        return n
 
 
 if __name__ == '__main__':
@@ -96,10 +257,8 @@ if __name__ == '__main__':
         rs = ReSampler(particles, weights)  # Create the Resampler
 
         # Resample
-        if resample_type == "naiive":
-            rs.resample_naiive()
-        elif resample_type == "low_variance":
-            rs.resample_low_variance()
+        if resample_type in RESAMPLE_TYPES:
+            rs.resample(resample_type)
         else:
             print "Unrecognized resampling method: " + resample_type
 
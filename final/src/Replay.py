@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+import rosbag
+import rospy
+import yaml
+from geometry_msgs.msg import PoseWithCovarianceStamped
+from nav_msgs.msg import OccupancyGrid
+from sensor_msgs.msg import LaserScan
+from std_msgs.msg import Float64
+from vesc_msgs.msg import VescStateStamped
+
+import Utils
+from NoiseParams import load_noise_params
+from ParticleFilter import ParticleFilter
+
+'''
+  Replays logged VESC, servo and laser scan streams through the particle filter without
+  a ROS master. Messages are fed to the motion and sensor model callbacks in the order
+  they were logged, as fast as they can be processed, and the particles are resampled
+  after every scan exactly like the live filter does. The filter only sees the logged
+  stamps, so the replay runs on the log's clock rather than the wall clock.
+
+  Usage:
+    python Replay.py --map map.yaml --log run.bag [--output trajectory.csv] [--seed 0]
+    python Replay.py --log run.bag --extract run.npz  (extract the streams once, for faster replays)
+    python Replay.py --map map.yaml --log run.npz
+'''
+
+SERVO, VESC, SCAN = 0, 1, 2  # The kinds of replayed events
+
+'''
+  Reads a PGM image (binary P5 or ascii P2)
+    path: The path to the image
+    Returns a 2D numpy array of the pixel values
+'''
+def read_pgm(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    # The header is four whitespace separated tokens, with '#' comments in between
+    tokens = []
+    pos = 0
+    while len(tokens) < 4:
+        while data[pos:pos+1].isspace():
+            pos += 1
+        if data[pos:pos+1] == b'#':
+            pos = data.index(b'\n', pos)
+            continue
+        end = pos
+        while not data[end:end+1].isspace():
+            end += 1
+        tokens.append(data[pos:end])
+        pos = end
+    magic, width, height, max_value = tokens[0], int(tokens[1]), int(tokens[2]), int(tokens[3])
+
+    if magic == b'P5':
+        dtype = np.uint8 if max_value < 256 else np.dtype('>u2')
+        return np.frombuffer(data, dtype=dtype, count=width*height, offset=pos+1).reshape((height, width))
+    elif magic == b'P2':
+        return np.array(data[pos:].split()[:width*height], dtype=np.int64).reshape((height, width))
+    raise ValueError('Unsupported PGM format in ' + path)
+
+'''
+  Loads a map the way map_server does, from its yaml description
+    yaml_path: The path to the map's yaml file
+    Returns the equivalent nav_msgs/OccupancyGrid
+'''
+def load_map(yaml_path):
+    with open(yaml_path) as f:
+        desc = yaml.safe_load(f)
+
+    image_path = desc['image']
+    if not os.path.isabs(image_path):
+        image_path = os.path.join(os.path.dirname(os.path.abspath(yaml_path)), image_path)
+    if image_path.endswith('.pgm'):
+        image = read_pgm(image_path).astype(np.float64)
+        image /= image.max() if image.max() > 255 else 255.0
+    else:
+        image = plt.imread(image_path).astype(np.float64)
+        if image.max() > 1.0:
+            image /= 255.0
+        if image.ndim == 3:
+            image = image[:, :, :3].mean(axis=2)
+
+    # Occupancy probability of every pixel, with the first row of the grid at the bottom of the image
+    occ = image if desc.get('negate', 0) else 1.0 - image
+    occ = np.flipud(occ)
+    grid = np.full(occ.shape, -1, dtype=np.int8)
+    grid[occ > desc['occupied_thresh']] = 100
+    grid[occ < desc['free_thresh']] = 0
+
+    map_msg = OccupancyGrid()
+    map_msg.header.frame_id = 'map'
+    map_msg.info.resolution = desc['resolution']
+    map_msg.info.width = grid.shape[1]
+    map_msg.info.height = grid.shape[0]
+    map_msg.info.origin.position.x = desc['origin'][0]
+    map_msg.info.origin.position.y = desc['origin'][1]
+    map_msg.info.origin.orientation = Utils.angle_to_quaternion(desc['origin'][2])
+    map_msg.data = grid.ravel().tolist()
+    return map_msg
+
+'''
+  Reads the streams the filter consumes from a bag
+    bag_path: The path to the bag
+    motor_state_topic, servo_state_topic, scan_topic: The topics of the streams
+    Returns a dict of arrays, see save_log
+'''
+def read_bag(bag_path, motor_state_topic, servo_state_topic, scan_topic):
+    servo_t, servo_data = [], []
+    vesc_t, vesc_stamp, vesc_speed = [], [], []
+    scan_t, scan_stamp, scan_ranges = [], [], []
+    scan_geometry = None
+    bag = rosbag.Bag(bag_path)
+    for topic, msg, t in bag.read_messages(topics=[motor_state_topic, servo_state_topic, scan_topic]):
+        if topic == servo_state_topic:
+            servo_t.append(t.to_sec())
+            servo_data.append(msg.data)
+        elif topic == motor_state_topic:
+            vesc_t.append(t.to_sec())
+            vesc_stamp.append(msg.header.stamp.to_sec())
+            vesc_speed.append(msg.state.speed)
+        else:
+            geometry = (msg.angle_min, msg.angle_max, msg.angle_increment, msg.range_max, len(msg.ranges))
+            if scan_geometry is None:
+                scan_geometry = geometry
+            elif geometry != scan_geometry:
+                raise ValueError('The scans in ' + bag_path + ' do not all have the same geometry')
+            scan_t.append(t.to_sec())
+            scan_stamp.append(msg.header.stamp.to_sec())
+            scan_ranges.append(np.array(msg.ranges, dtype=np.float32))
+    bag.close()
+
+    if scan_geometry is None:
+        raise ValueError('No scans on ' + scan_topic + ' in ' + bag_path)
+    return {'servo_t': np.array(servo_t), 'servo_data': np.array(servo_data),
+            'vesc_t': np.array(vesc_t), 'vesc_stamp': np.array(vesc_stamp),
+            'vesc_speed': np.array(vesc_speed),
+            'scan_t': np.array(scan_t), 'scan_stamp': np.array(scan_stamp),
+            'scan_ranges': np.array(scan_ranges, dtype=np.float32),
+            'scan_geometry': np.array(scan_geometry[:4])}
+
+'''
+  Saves streams read by read_bag, so that later replays can skip decoding the bag
+    path: The .npz file to write
+    log: A dict with the arrays
+      servo_t, servo_data: Receive time and value of each servo command
+      vesc_t, vesc_stamp, vesc_speed: Receive time, header stamp and speed of each VESC state
+      scan_t, scan_stamp: Receive time and header stamp of each scan
+      scan_ranges: float32 array with the ranges of one scan per row
+      scan_geometry: [angle_min, angle_max, angle_increment, range_max] of the scans
+'''
+def save_log(path, log):
+    np.savez(path, **log)
+
+'''
+  Loads streams from a bag or from a file written by save_log
+    path: The path to the .bag or .npz file
+    motor_state_topic, servo_state_topic, scan_topic: The topics to read from a bag
+    Returns a dict of arrays, see save_log
+'''
+def load_log(path, motor_state_topic, servo_state_topic, scan_topic):
+    if path.endswith('.npz'):
+        data = np.load(path)
+        return dict((key, data[key]) for key in data.files)
+    return read_bag(path, motor_state_topic, servo_state_topic, scan_topic)
+
+'''
+  Drives a particle filter with logged messages
+'''
+
+
+class Replay:
+
+    '''
+    Initializes the replay
+      pf: A ParticleFilter created with live=False and no topics
+      log: A dict of arrays, see save_log
+  '''
+
+    def __init__(self, pf, log):
+        self.pf = pf
+        self.log = log
+
+        # Merge the streams into one sequence of events ordered by receive time
+        times = np.concatenate((log['servo_t'], log['vesc_t'], log['scan_t']))
+        kinds = np.concatenate((np.full(len(log['servo_t']), SERVO), np.full(len(log['vesc_t']), VESC),
+                                np.full(len(log['scan_t']), SCAN)))
+        indices = np.concatenate((np.arange(len(log['servo_t'])), np.arange(len(log['vesc_t'])),
+                                  np.arange(len(log['scan_t']))))
+        order = np.argsort(times, kind='mergesort')
+        self.times = times[order]
+        self.kinds = kinds[order]
+        self.indices = indices[order]
+
+    '''
+    Feeds every event of the log to the filter
+      Returns an Mx4 array with the stamp and expected pose (t, x, y, theta) after each scan
+  '''
+
+    def run(self):
+        pf = self.pf
+        log = self.log
+        timer = pf.stage_timer
+
+        servo_msg = Float64()
+        vesc_msg = VescStateStamped()
+        scan_msg = LaserScan()
+        angle_min, angle_max, angle_increment, range_max = log['scan_geometry']
+        scan_msg.angle_min = angle_min
+        scan_msg.angle_max = angle_max
+        scan_msg.angle_increment = angle_increment
+        scan_msg.range_max = range_max
+
+        trajectory = []
+        for kind, i in zip(self.kinds.tolist(), self.indices.tolist()):
+            if kind == SERVO:
+                servo_msg.data = float(log['servo_data'][i])
+                pf.motion_model.servo_cb(servo_msg)
+
+            elif kind == VESC:
+                vesc_msg.header.stamp = rospy.Time.from_sec(float(log['vesc_stamp'][i]))
+                vesc_msg.state.speed = float(log['vesc_speed'][i])
+                start = time.time()
+                pf.motion_model.motion_cb(vesc_msg)
+                timer.record_since('motion', start)
+
+            else:
+                stamp = float(log['scan_stamp'][i])
+                scan_msg.header.stamp = rospy.Time.from_sec(stamp)
+                scan_msg.ranges = log['scan_ranges'][i]
+                start = time.time()
+                pf.sensor_model.lidar_cb(scan_msg)
+                start = timer.record_since('sensor', start)
+
+                # Same hand-off as the main loop of the live filter
+                if pf.sensor_model.wait_for_update(0.0) is None:
+                    continue
+                if pf.resample():
+                    timer.record_since('resample', start)
+                pose = pf.expected_pose()
+                trajectory.append((stamp, pose[0], pose[1], pose[2]))
+
+        return np.array(trajectory).reshape((-1, 4))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay logged sensor streams through the particle filter')
+    parser.add_argument('--log', required=True, help='A .bag, or a .npz written with --extract')
+    parser.add_argument('--map', help="The map's yaml file, as given to map_server")
+    parser.add_argument('--extract', help='Write the streams of the bag to this .npz and exit')
+    parser.add_argument('--output', help='Write the trajectory (t, x, y, theta) to this csv')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the filter randomness')
+    parser.add_argument('--initial-pose', type=float, nargs=3, metavar=('X', 'Y', 'THETA'),
+                        help='Start around this pose instead of globally')
+    parser.add_argument('--motor-state-topic', default='/car/vesc/sensors/core')
+    parser.add_argument('--servo-state-topic', default='/car/vesc/sensors/servo_position_command')
+    parser.add_argument('--scan-topic', default='/car/scan')
+    parser.add_argument('--n-particles', type=int, default=500)
+    parser.add_argument('--min-particles', type=int)
+    parser.add_argument('--max-particles', type=int)
+    parser.add_argument('--laser-ray-step', type=int, default=30)
+    parser.add_argument('--include-max-range-rays', action='store_true')
+    parser.add_argument('--max-range-meters', type=float, default=11.0)
+    parser.add_argument('--resample-type', default='low_variance')
+    parser.add_argument('--resample-ess-fraction', type=float, default=0.5)
+    parser.add_argument('--range-method', default='cddt')
+    parser.add_argument('--scan-reduction', default='center')
+    parser.add_argument('--sensor-model', default='beam', help='beam (ray casting) or likelihood_field')
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--batch-motion', action='store_true',
+                        help='Buffer the VESC states and propagate the particles up to the stamp of each scan')
+    parser.add_argument('--global-init-candidates', type=int, default=0,
+                        help='Initialize globally from the best of this many poses scored against the first scan')
+    parser.add_argument('--max-scan-latency', type=float,
+                        help='Drop scans taken more than this many seconds before the latest motion update, '
+                             'by default every scan is kept')
+    parser.add_argument('--noise-params', help='A noise parameter file written by FitNoiseParams.py')
+    parser.add_argument('--speed-to-erpm-offset', type=float, default=0.0)
+    parser.add_argument('--speed-to-erpm-gain', type=float, default=4350)
+    parser.add_argument('--steering-angle-to-servo-offset', type=float, default=0.5)
+    parser.add_argument('--steering-angle-to-servo-gain', type=float, default=-1.2135)
+    parser.add_argument('--car-length', type=float, default=0.33)
+    args = parser.parse_args()
+
+    log = load_log(args.log, args.motor_state_topic, args.servo_state_topic, args.scan_topic)
+    if args.extract:
+        save_log(args.extract, log)
+        print('Wrote ' + args.extract)
+        raise SystemExit(0)
+    if not args.map:
+        parser.error('--map is required to replay')
+
+    np.random.seed(args.seed)
+    pf = ParticleFilter(args.n_particles, 0, None, None, None, args.laser_ray_step,
+                        not args.include_max_range_rays, args.max_range_meters, args.resample_type,
+                        args.speed_to_erpm_offset, args.speed_to_erpm_gain,
+                        args.steering_angle_to_servo_offset, args.steering_angle_to_servo_gain,
+                        args.car_length, args.range_method, args.scan_reduction,
+                        args.min_particles, args.max_particles, args.resample_ess_fraction,
+                        args.num_workers, map_msg=load_map(args.map), live=False,
+                        batch_motion=args.batch_motion,
+                        global_init_candidates=args.global_init_candidates,
+                        max_scan_latency=args.max_scan_latency,
+                        noise_params=load_noise_params(args.noise_params) if args.noise_params else None,
+                        sensor_model=args.sensor_model)
+
+    if args.initial_pose is not None:
+        msg = PoseWithCovarianceStamped()
+        msg.pose.pose.position.x = args.initial_pose[0]
+        msg.pose.pose.position.y = args.initial_pose[1]
+        msg.pose.pose.orientation = Utils.angle_to_quaternion(args.initial_pose[2])
+        pf.clicked_pose_cb(msg)
+    pf.stage_timer.reset()
+
+    start = time.time()
+    trajectory = Replay(pf, log).run()
+    elapsed = time.time() - start
+
+    times = np.concatenate((log['servo_t'], log['vesc_t'], log['scan_t']))
+    duration = times.max() - times.min() if times.shape[0] > 0 else 0.0
+    print('Replayed %.1f s of log in %.1f s (%.1fx real time), %d poses'
+          % (duration, elapsed, duration / max(elapsed, 1e-9), trajectory.shape[0]))
+    print('Stage timings: ' + pf.stage_timer.report())
+
+    if args.output:
+        np.savetxt(args.output, trajectory, delimiter=',', header='t,x,y,theta', comments='')
+        print('Wrote ' + args.output)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import ctypes
+import multiprocessing
+import signal
+import time
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+MAX_SHARDED_RAYS = 4096  # Scans with more rays than this are evaluated serially
+
+'''
+  Evaluates the log likelihood of a downsampled scan for a set of particles
+'''
+
+
+class ScanLikelihood:
+
+    '''
+    Initializes the evaluator
+      range_method: The ray casting backend, see RangeMethod
+      sensor_model_table: The [max_range_px+1, max_range_px+1] sensor model table
+      max_range_px: The max range of the laser in pixels
+      map_resolution: The size of a map pixel in meters
+  '''
+
+    def __init__(self, range_method, sensor_model_table, max_range_px, map_resolution):
+        self.range_method = range_method
+        self.log_sensor_model_table = np.log(sensor_model_table)
+        self.MAX_RANGE_PX = max_range_px
+        self.INV_SCALE = 1.0 / map_resolution
+
+    '''
+    Casts the rays of every query and sums the log of the sensor model over the rays
+    The table is indexed with the same discretization as range_libc's eval_sensor_model
+      queries: Nx3 float32 array of particle poses
+      obs_ranges: float32 array of observed ranges
+      obs_angles: float32 array of the angles of the observed rays
+      ranges: float32 buffer of N*len(obs_angles) elements, filled with the expected ranges
+      out: Array of N elements, set to the log likelihood of each query
+  '''
+
+    def evaluate(self, queries, obs_ranges, obs_angles, ranges, out):
+        num_particles = queries.shape[0]
+        num_rays = obs_angles.shape[0]
+
+        self.range_method.calc_range_repeat_angles(queries, obs_angles, ranges)
+
+        r = np.clip(obs_ranges * self.INV_SCALE, 0.0, self.MAX_RANGE_PX).astype(np.intp)
+        d = np.clip(ranges * self.INV_SCALE, 0.0, self.MAX_RANGE_PX).astype(np.intp)
+        np.sum(self.log_sensor_model_table[r[np.newaxis, :], d.reshape((num_particles, num_rays))],
+               axis=1, out=out)
+
+
+'''
+  Returns a numpy array of the given shape and dtype backed by shared memory, so that
+  processes forked after its creation read and write the same elements
+'''
+def shared_array(shape, dtype):
+    dtype = np.dtype(dtype)
+    raw = RawArray(ctypes.c_byte, int(np.prod(shape)) * dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+'''
+  Main loop of a worker process of ShardedScanLikelihood
+  Each job is a (start, end, num_rays) tuple, answered with None on success or a
+  description of the error. A None job stops the worker
+'''
+def shard_worker(likelihood, conn, queries, obs_ranges, obs_angles, log_likelihood):
+    # Interrupts are handled by the parent, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    ranges = np.zeros(0, dtype=np.float32)  # Private buffer of expected ranges, grown on demand
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        start, end, num_rays = job
+        try:
+            size = (end - start) * num_rays
+            if ranges.shape[0] < size:
+                ranges = np.zeros(size, dtype=np.float32)
+            likelihood.evaluate(queries[start:end], obs_ranges[:num_rays], obs_angles[:num_rays],
+                                ranges[:size], log_likelihood[start:end])
+            conn.send(None)
+        except Exception as e:
+            conn.send(repr(e))
+
+'''
+  Evaluates a ScanLikelihood over contiguous shards of the particles in parallel
+  Range casting holds the GIL, so the shards are handed to forked worker processes.
+  Queries, observations and results live in shared memory, and only the shard bounds
+  are sent to the workers. Each worker inherits a copy of the range method when it is
+  forked, so backends that own a GPU context (rmgpu) must not be sharded.
+'''
+
+
+class ShardedScanLikelihood:
+
+    '''
+    Forks the worker processes
+      likelihood: The ScanLikelihood to evaluate, or a LikelihoodField
+      num_workers: The number of worker processes
+      max_particles: The largest number of particles that will be evaluated
+      max_rays: The largest number of rays that will be evaluated
+  '''
+
+    def __init__(self, likelihood, num_workers, max_particles, max_rays=MAX_SHARDED_RAYS):
+        self.likelihood = likelihood
+        self.NUM_WORKERS = num_workers
+        self.MAX_PARTICLES = max_particles
+        self.MAX_RAYS = max_rays
+
+        self.queries = shared_array((max_particles, 3), np.float32)
+        self.obs_ranges = shared_array((max_rays,), np.float32)
+        self.obs_angles = shared_array((max_rays,), np.float32)
+        self.log_likelihood = shared_array((max_particles,), np.float64)
+        self.serial_ranges = None  # Expected ranges of the serial path, see measure_speedup
+
+        self.conns = []
+        self.workers = []
+        for _ in range(num_workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=shard_worker,
+                                             args=(likelihood, child_conn, self.queries, self.obs_ranges,
+                                                   self.obs_angles, self.log_likelihood))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+    '''
+    Returns whether a scan with num_rays rays for num_particles particles fits the shared buffers
+  '''
+
+    def fits(self, num_particles, num_rays):
+        return num_particles <= self.MAX_PARTICLES and num_rays <= self.MAX_RAYS
+
+    '''
+    Same as ScanLikelihood.evaluate, split across the workers. The expected ranges
+    stay in the workers, and the log likelihoods are written into shared memory
+    before being copied to out
+      queries: Nx3 array of particle poses, with N at most max_particles
+      obs_ranges: float32 array of observed ranges
+      obs_angles: float32 array of at most max_rays angles
+      out: Array of N elements, set to the log likelihood of each query
+  '''
+
+    def evaluate(self, queries, obs_ranges, obs_angles, out):
+        num_particles = queries.shape[0]
+        num_rays = obs_angles.shape[0]
+
+        self.queries[:num_particles] = queries
+        self.obs_ranges[:num_rays] = obs_ranges
+        self.obs_angles[:num_rays] = obs_angles
+
+        bounds = np.linspace(0, num_particles, self.NUM_WORKERS + 1).astype(int)
+        for i, conn in enumerate(self.conns):
+            conn.send((bounds[i], bounds[i+1], num_rays))
+
+        errors = [conn.recv() for conn in self.conns]
+        errors = [e for e in errors if e is not None]
+        if len(errors) > 0:
+            raise RuntimeError('Sensor model worker failed: ' + errors[0])
+
+        out[:] = self.log_likelihood[:num_particles]
+
+    '''
+    Times the sharded evaluation against the serial one on the same inputs
+      queries, obs_ranges, obs_angles: See evaluate
+      trials: The number of evaluations timed for each path
+      Returns the mean seconds per evaluation of the (serial, sharded) paths
+  '''
+
+    def measure_speedup(self, queries, obs_ranges, obs_angles, trials=5):
+        num_particles = queries.shape[0]
+        num_rays = obs_angles.shape[0]
+        out = np.zeros(num_particles)
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if self.serial_ranges is None or self.serial_ranges.shape[0] < num_particles*num_rays:
+            self.serial_ranges = np.zeros(num_particles*num_rays, dtype=np.float32)
+
+        start = time.time()
+        for _ in range(trials):
+            self.likelihood.evaluate(queries, obs_ranges, obs_angles,
+                                     self.serial_ranges[:num_particles*num_rays], out)
+        serial = (time.time() - start) / trials
+
+        start = time.time()
+        for _ in range(trials):
+            self.evaluate(queries, obs_ranges, obs_angles, out)
+        sharded = (time.time() - start) / trials
+
+        return serial, sharded
+
+    '''
+    Stops the worker processes
+  '''
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join(1.0)
+        self.conns = []
+        self.workers = []
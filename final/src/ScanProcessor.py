@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+SCAN_REDUCTIONS = ('center', 'min', 'median')  # Supported ways of reducing a bin of beams to one ray
+
+'''
+  Turns laser scans into the downsampled observations used by the sensor model
+'''
+
+
+class ScanProcessor:
+
+    '''
+    Initializes the scan processor
+      laser_ray_step: Number of consecutive beams reduced to a single ray
+      exclude_max_range_rays: Whether to exclude rays that are beyond the max range
+      max_range_meters: The max range of the laser
+      reduction: How the valid beams of a bin are reduced to one ray
+        'center': Keep the valid beam closest to the center of the bin
+        'min': Keep the valid beam with the shortest range
+        'median': Use the median range of the valid beams, at the center angle of the bin
+  '''
+
+    def __init__(self, laser_ray_step, exclude_max_range_rays, max_range_meters, reduction='center'):
+        if reduction not in SCAN_REDUCTIONS:
+            raise ValueError('Unrecognized scan reduction: ' + str(reduction))
+
+        self.LASER_RAY_STEP = laser_ray_step
+        self.EXCLUDE_MAX_RANGE_RAYS = exclude_max_range_rays
+        self.MAX_RANGE_METERS = max_range_meters
+        self.REDUCTION = reduction
+
+        self.geometry = None  # (angle_min, angle_max, number of beams) of the cached buffers
+        self.angles = None  # The angle of each beam
+        self.ranges = None  # Preallocated float32 buffer of n_bins*LASER_RAY_STEP ranges
+        self.bins = None  # View of self.ranges with one row per bin
+        self.scratch = None  # Preallocated copy of self.bins used by the reductions
+        self.bin_angles = None  # The angle of each beam, padded and laid out like self.bins
+        self.center_angles = None  # The center angle of each bin
+        self.center_order = None  # Column order of each bin, from closest to furthest from its center
+        self.rows = None  # Cached row indices of self.bins
+
+    '''
+    Rebuilds the cached angles and buffers for a new scan geometry
+      angle_min: The angle of the first beam
+      angle_max: The angle of the last beam
+      num_beams: The number of beams in the scan
+  '''
+
+    def set_geometry(self, angle_min, angle_max, num_beams):
+        step = self.LASER_RAY_STEP
+        n_bins = (num_beams + step - 1) // step
+
+        self.geometry = (angle_min, angle_max, num_beams)
+        self.angles = np.array(np.linspace(angle_min, angle_max, num_beams), dtype=np.float32)
+
+        # The last bin is padded with invalid beams
+        self.ranges = np.full(n_bins*step, np.nan, dtype=np.float32)
+        self.bins = self.ranges.reshape((n_bins, step))
+        self.scratch = np.zeros_like(self.bins)
+        self.bin_angles = np.zeros(n_bins*step, dtype=np.float32)
+        self.bin_angles[:num_beams] = self.angles
+        self.bin_angles = self.bin_angles.reshape((n_bins, step))
+
+        # Center of each bin, ignoring the padding
+        first = np.arange(n_bins) * step
+        last = np.minimum(first + step, num_beams) - 1
+        self.center_angles = ((self.angles[first] + self.angles[last]) / 2).astype(np.float32)
+
+        self.center_order = np.argsort(np.abs(np.arange(step) - 0.5*(step - 1)), kind='mergesort')
+        self.rows = np.arange(n_bins)
+
+    '''
+    Downsamples a laser scan
+    A beam is invalid if its range is NAN or 0.0, or if it is at or beyond the max range and
+    self.EXCLUDE_MAX_RANGE_RAYS is set. Otherwise, invalid beams are kept with their range
+    set to self.MAX_RANGE_METERS. Bins without a valid beam are dropped, so the number of
+    rays varies from scan to scan.
+      msg: A sensor_msgs/LaserScan
+      Returns the observation, a tuple of float32 numpy arrays (ranges, angles)
+  '''
+
+    def process(self, msg):
+        num_beams = len(msg.ranges)
+        if self.geometry != (msg.angle_min, msg.angle_max, num_beams):
+            self.set_geometry(msg.angle_min, msg.angle_max, num_beams)
+
+        ranges = self.ranges[:num_beams]
+        ranges[:] = msg.ranges
+
+        # Mark invalid beams as NAN (or clamp them to the max range)
+        invalid = np.isnan(ranges) | (ranges <= 0.0)
+        if self.EXCLUDE_MAX_RANGE_RAYS:
+            invalid |= ranges >= self.MAX_RANGE_METERS
+            ranges[invalid] = np.nan
+        else:
+            ranges[invalid] = self.MAX_RANGE_METERS
+
+        if self.REDUCTION == 'center':
+            # First valid beam in order of distance to the bin center
+            valid = ~np.isnan(self.bins[:, self.center_order])
+            col = self.center_order[np.argmax(valid, axis=1)]
+            keep = valid.any(axis=1)
+            return (self.bins[self.rows, col][keep], self.bin_angles[self.rows, col][keep])
+
+        elif self.REDUCTION == 'min':
+            scratch = self.scratch
+            np.copyto(scratch, self.bins)
+            scratch[np.isnan(scratch)] = np.inf
+            col = np.argmin(scratch, axis=1)
+            obs_ranges = scratch[self.rows, col]
+            keep = np.isfinite(obs_ranges)
+            return (obs_ranges[keep], self.bin_angles[self.rows, col][keep])
+
+        else:
+            # Sorting moves the NANs to the end of each row, so the median of the
+            # count valid entries sits at columns (count-1)//2 and count//2
+            scratch = self.scratch
+            np.copyto(scratch, self.bins)
+            scratch.sort(axis=1)
+            count = self.LASER_RAY_STEP - np.isnan(scratch).sum(axis=1)
+            keep = count > 0
+            rows = self.rows[keep]
+            count = count[keep]
+            obs_ranges = 0.5*(scratch[rows, (count - 1) // 2] + scratch[rows, count // 2])
+            return (obs_ranges.astype(np.float32), self.center_angles[keep])
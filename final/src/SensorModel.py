@@ -2,15 +2,19 @@
 
 import numpy as np
 import math
+import os
+import tempfile
 import rospy
-import range_libc
 import time
-from threading import Lock
+from threading import Condition, Lock
 from nav_msgs.srv import GetMap
 import rosbag
 import matplotlib.pyplot as plt
-import utils as Utils
+import Utils
 from sensor_msgs.msg import LaserScan
+from MapResources import MapResources
+from ScanProcessor import ScanProcessor
+from ScanLikelihood import ShardedScanLikelihood
 
 THETA_DISCRETIZATION = 112  # Discretization of scanning angle
 INV_SQUASH_FACTOR = 0.2    # Factor for helping the weight distribution to be less peaked
@@ -31,6 +35,12 @@ Z_HIT = 1.5  # Weight for hit reading
 LAMDA_SHORT = 0.01  # Lamda for unexpected obstacles
 SIGMA_HIT = 1.0  # Noise value for hit reading
 
+SENSOR_MODEL_CACHE_DIR = os.path.expanduser('~/.ros/sensor_model_tables')  # Where precomputed tables are cached
+SENSOR_MODEL_VERSION = 2  # Bumped whenever precompute_sensor_model changes, so stale cached tables are not loaded
+SCORE_CHUNK_SIZE = 4096  # Poses ray cast at a time by score_poses
+MAX_SCAN_LATENCY = None  # Seconds the particles may be ahead of a scan before it is dropped, None to never drop
+SENSOR_MODELS = ('beam', 'likelihood_field')  # Supported ways of weighing a scan, see the sensor_model argument
+
 ''' 
   Weights particles according to their agreement with the observed data
 '''
@@ -40,7 +50,8 @@ class SensorModel:
 
     '''
     Initializes the sensor model
-      scan_topic: The topic containing laser scans
+      scan_topic: The topic containing laser scans, None to not subscribe and have
+                  the caller pass scans to lidar_cb
       laser_ray_step: Step for downsampling laser scans
       exclude_max_range_rays: Whether to exclude rays that are beyond the max range
       max_range_meters: The max range of the laser
@@ -48,10 +59,36 @@ class SensorModel:
       particles: The particles to be weighted
       weights: The weights of the particles
       state_lock: Used to control access to particles and weights
+      range_method: The ray casting backend to use, one of 'cddt', 'rmgpu', 'numpy' or 'lut'
+      scan_reduction: How each bin of laser_ray_step beams is reduced to one ray, one of
+                      'center', 'min' or 'median' (see ScanProcessor)
+      max_particles: The largest number of particles that will be weighted, used to size
+                     the buffers. Defaults to the number of particles
+      log_weights: The accumulated log likelihood of each particle. The weights are kept equal
+                   to the normalized exponential of these. Allocated here if not given
+      num_workers: The number of processes that evaluate shards of the particles in parallel.
+                   1 evaluates every particle in this process
+      max_scan_latency: Scans taken more than this many seconds before the latest motion
+                        update of the particles are dropped, see motion_since. None keeps
+                        every scan, only compensating for the motion since it was taken
+      resources: The MapResources of map_msg, whose range method and sensor model are shared
+                 with the other sensor models created with it. Private ones by default
+      noise_params: Dict overriding the sensor model constants of this module, e.g. as read
+                    by NoiseParams.load_noise_params. Other keys are ignored
+      sensor_model: How a scan is weighed, one of SENSOR_MODELS
+        'beam': Cast every ray and look the cast and observed ranges up in the beam model table
+        'likelihood_field': Look the end point of every ray up in a likelihood field of the map,
+                            without casting rays, see LikelihoodField. Z_HIT, Z_RAND and SIGMA_HIT
+                            are its parameters, and range_method is not used
     '''
 
     def __init__(self, scan_topic, laser_ray_step, exclude_max_range_rays,
-                 max_range_meters, map_msg, particles, weights, state_lock=None):
+                 max_range_meters, map_msg, particles, weights, state_lock=None,
+                 range_method='cddt', scan_reduction='center', max_particles=None,
+                 log_weights=None, num_workers=1, max_scan_latency=MAX_SCAN_LATENCY, resources=None,
+                 noise_params=None, sensor_model='beam'):
+        if sensor_model not in SENSOR_MODELS:
+            raise ValueError('Unrecognized sensor model: ' + str(sensor_model))
         if state_lock is None:
             self.state_lock = Lock()
         else:
@@ -59,24 +96,61 @@ class SensorModel:
 
         self.particles = particles
         self.weights = weights
+        self.MAX_PARTICLES = particles.shape[0] if max_particles is None else max_particles
+        self.log_weights = np.zeros(weights.shape[0]) if log_weights is None else log_weights
 
         self.LASER_RAY_STEP = laser_ray_step  # Step for downsampling laser scans
         self.EXCLUDE_MAX_RANGE_RAYS = exclude_max_range_rays  # Whether to exclude rays that are beyond the max range
         self.MAX_RANGE_METERS = max_range_meters  # The max range of the laser
+        self.MAX_SCAN_LATENCY = max_scan_latency  # Seconds the particles may be ahead of a scan
+
+        # Parameters of the beam model, defaulting to the constants of this module
+        params = {} if noise_params is None else noise_params
+        self.Z_HIT = params.get('Z_HIT', Z_HIT)
+        self.Z_SHORT = params.get('Z_SHORT', Z_SHORT)
+        self.Z_MAX = params.get('Z_MAX', Z_MAX)
+        self.Z_RAND = params.get('Z_RAND', Z_RAND)
+        self.LAMDA_SHORT = params.get('LAMDA_SHORT', LAMDA_SHORT)
+        self.SIGMA_HIT = params.get('SIGMA_HIT', SIGMA_HIT)
+        self.INV_SQUASH_FACTOR = params.get('INV_SQUASH_FACTOR', INV_SQUASH_FACTOR)
+        self.scan_processor = ScanProcessor(laser_ray_step, exclude_max_range_rays,
+                                            max_range_meters, scan_reduction)  # Downsamples the laser scans
 
-        oMap = range_libc.PyOMap(map_msg)  # A version of the map that range_libc can understand
         max_range_px = int(self.MAX_RANGE_METERS / map_msg.info.resolution)  # The max range in pixels of the laser
-        self.range_method = range_libc.PyCDDTCast(oMap, max_range_px, THETA_DISCRETIZATION)  # The range method that will be used for ray casting
-        # self.range_method = range_libc.PyRayMarchingGPU(oMap, max_range_px) # The range method that will be used for ray casting
-        self.range_method.set_sensor_model(self.precompute_sensor_model(max_range_px))  # Load the sensor model expressed as a table
+        if resources is None:
+            resources = MapResources(map_msg)
+        # The range method that will be used for ray casting, loaded with the sensor model table,
+        # and the evaluator that weighs particles with them in the log domain
+        self.SENSOR_MODEL = sensor_model
+        if sensor_model == 'likelihood_field':
+            self.range_method = None
+            self.likelihood = resources.likelihood_field(max_range_px, self.Z_HIT, self.Z_RAND, self.SIGMA_HIT)
+        else:
+            self.range_method, self.likelihood = resources.scan_likelihood(max_range_px, THETA_DISCRETIZATION,
+                                                                           range_method, self.load_sensor_model,
+                                                                           self.table_params())
+        self.sharded_likelihood = None  # Parallel evaluation of self.likelihood, if num_workers > 1
+        if num_workers > 1:
+            self.sharded_likelihood = ShardedScanLikelihood(self.likelihood, num_workers, self.MAX_PARTICLES)
+        self.log_likelihood = None  # Per particle log likelihood of the latest scan
         self.queries = None  # Do not modify this variable
         self.ranges = None  # Do not modify this variable
         self.laser_angles = None  # The angles of each ray
         self.downsampled_angles = None  # The angles of the downsampled rays
         self.do_resample = False  # Set so that outside code can know that it's time to resample
+        self.update_cond = Condition()  # Signaled whenever do_resample is set, see wait_for_update
+        self.update_time = None  # Time at which do_resample was last set
+        self.last_laser = None  # The laser scan that was last applied to the particles
+        self.propagate_until = None  # If set, called with the scan stamp to bring the particles to it first
+        self.initialize_with_scan = None  # If set, called once with the next observation before it is applied
+        self.motion_since = None  # If set, called with (scan stamp, MAX_SCAN_LATENCY) for the motion applied since the scan
+        self.compensated = None  # The particles moved back to the time of a late scan
+        self.dropped_scans = 0  # The number of scans dropped for being too late
 
         # Subscribe to laser scans
-        self.laser_sub = rospy.Subscriber(scan_topic, LaserScan, self.lidar_cb, queue_size=1)
+        self.laser_sub = None
+        if scan_topic is not None:
+            self.laser_sub = rospy.Subscriber(scan_topic, LaserScan, self.lidar_cb, queue_size=1)
 
     '''
     Downsamples laser measurements and applies sensor model
@@ -85,6 +159,17 @@ class SensorModel:
 
     def lidar_cb(self, msg):
         self.state_lock.acquire()
+        if self.propagate_until is not None:
+            self.propagate_until(msg.header.stamp)
+
+        # The motion applied to the particles after the scan was taken
+        delta = (0.0, 0.0, 0.0)
+        if self.motion_since is not None:
+            delta = self.motion_since(msg.header.stamp.to_sec(), self.MAX_SCAN_LATENCY)
+            if delta is None:
+                self.dropped_scans += 1  # Reported with the stage timings, see ParticleFilter.run
+                self.state_lock.release()
+                return
 
         # Compute the observation obs
         #   obs is a a two element tuple
@@ -99,20 +184,92 @@ class SensorModel:
         #   You may choose to use self.laser_angles and self.downsampled_angles here
         # YOUR CODE HERE
 
-        self.downsampled_angles = np.array(np.linspace(msg.angle_min, msg.angle_max, len(msg.ranges))[::self.LASER_RAY_STEP], dtype=np.float32)
-
-        self.laser_angles = np.array(msg.ranges[::self.LASER_RAY_STEP], dtype=np.float32)
-        self.laser_angles[(np.isnan(self.laser_angles)) | (self.laser_angles == 0.0)] = self.MAX_RANGE_METERS
+        obs = self.scan_processor.process(msg)  # range, angles
+        self.laser_angles = self.scan_processor.angles
+        self.downsampled_angles = obs[1]
+        if obs[0].shape[0] == 0:
+            # Nothing informative in this scan, keep the current weights
+            self.state_lock.release()
+            return
 
-        obs = (self.laser_angles, self.downsampled_angles)  # range, angles
+        if self.initialize_with_scan is not None:
+            initialize_with_scan = self.initialize_with_scan
+            self.initialize_with_scan = None
+            initialize_with_scan(obs)
 
-        self.apply_sensor_model(self.particles, obs, self.weights)
-        self.weights /= np.sum(self.weights)
+        proposal_dist = self.particles
+        if delta != (0.0, 0.0, 0.0):
+            proposal_dist = self.move_back(self.particles, delta)
+        self.apply_sensor_model(proposal_dist, obs, self.weights)
 
         self.last_laser = msg
+        self.update_cond.acquire()
         self.do_resample = True
+        self.update_time = time.time()
+        self.update_cond.notify()
+        self.update_cond.release()
         self.state_lock.release()
 
+    '''
+    Blocks until the sensor model has applied a new scan, then clears do_resample
+      timeout: The maximum number of seconds to wait
+      Returns the number of seconds between the scan being applied and this call
+      returning, or None if no new scan was applied before the timeout
+  '''
+
+    def wait_for_update(self, timeout):
+        self.update_cond.acquire()
+        if not self.do_resample:
+            self.update_cond.wait(timeout)
+        if not self.do_resample:
+            self.update_cond.release()
+            return None
+        self.do_resample = False
+        latency = time.time() - self.update_time
+        self.update_cond.release()
+        return latency
+
+    '''
+    Returns the parameters the sensor model table depends on, besides the max range
+  '''
+
+    def table_params(self):
+        return (self.Z_HIT, self.Z_SHORT, self.Z_MAX, self.Z_RAND, self.LAMDA_SHORT, self.SIGMA_HIT)
+
+    '''
+    Load the sensor model table from the on-disk cache, computing and caching it
+    if it has not been built for these parameters before
+    max_range_px: The maximum range in pixels
+    Returns the table (which is a numpy array with dimensions [max_range_px+1, max_range_px+1])
+  '''
+
+    def load_sensor_model(self, max_range_px):
+        # The cache key covers every parameter that the table depends on
+        file_name = "_".join(str(x) for x in (SENSOR_MODEL_VERSION, int(max_range_px)) + self.table_params()) + '.npy'
+        file_name = SENSOR_MODEL_CACHE_DIR + '/' + file_name
+
+        if os.path.exists(file_name):
+            try:
+                return np.load(file_name)
+            except (IOError, ValueError):
+                print('Discarding unreadable sensor model cache: ' + file_name)
+
+        sensor_model_table = self.precompute_sensor_model(max_range_px)
+
+        # Write to a temporary file first so that a concurrent or interrupted
+        # start never sees a partially written table
+        try:
+            if not os.path.isdir(SENSOR_MODEL_CACHE_DIR):
+                os.makedirs(SENSOR_MODEL_CACHE_DIR)
+            fd, tmp_name = tempfile.mkstemp(suffix='.npy', dir=SENSOR_MODEL_CACHE_DIR)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, sensor_model_table)
+            os.rename(tmp_name, file_name)
+        except (IOError, OSError) as e:
+            print('Could not cache sensor model table: ' + str(e))
+
+        return sensor_model_table
+
     '''
     Compute table enumerating the probability of observing a measurement 
     given the expected measurement
@@ -125,51 +282,94 @@ class SensorModel:
     def precompute_sensor_model(self, max_range_px):
 
         table_width = int(max_range_px) + 1
-        sensor_model_table = np.zeros((table_width, table_width))
 
         # Populate sensor_model_table according to the laser beam model specified
         # in CH 6.3 of Probabilistic Robotics
-        # Note: no need to use any functions from utils.py to compute between world
-        #       and map coordinates here
-        # YOUR CODE HERE
-        # Pseudo-code
-        # for d in xrange(table_width):
-        #   possibly some stuff here
-        #   for r in xrange(table_width):
-        #     Populate the sensor model table at (r,d) with the probability of
-        #     observing measurement r (in pixels)
-        #     when the expected measurement is d (in pixels)
-        # Note that the 'self' parameter is completely unused in this function
-
-        # random posibility
-
-        random_p = np.full(sensor_model_table.shape, 1.0/table_width)
-
-        # Max range possibility :uniform distribution
-        max_range = np.zeros(sensor_model_table.shape)
-        max_range[-1, :] = 1
-
-        # Measure noise :Gaussian
-        # unexpected obstacles :
-        noise = np.zeros(sensor_model_table.shape)
-        obstacle = np.zeros(sensor_model_table.shape)
-
-        for i in range(table_width):
-            for j in range(table_width):
-                noise[i, j] = (1 / (SIGMA_HIT * np.sqrt(2*math.pi))) * np.exp((-1/2)*np.square((i-j)/SIGMA_HIT))
-                if (i <= j):
-                    obstacle[i, j] = LAMDA_SHORT * np.exp(-LAMDA_SHORT*i)
-                else:
-                    obstacle[i, j] = 0
-
-        # Total possibility
-        sensor_model_table = Z_RAND * random_p + Z_HIT * noise + Z_MAX * max_range + Z_SHORT * obstacle
-        sensor_model_table = (sensor_model_table.transpose()/sensor_model_table.transpose().sum(axis=1)[:, None]).transpose()
+        # The whole table is evaluated in a single broadcast over
+        # r (rows, measured range) and d (columns, expected range)
+        r = np.arange(table_width, dtype=np.float64)[:, np.newaxis]
+        d = np.arange(table_width, dtype=np.float64)[np.newaxis, :]
+
+        # Random possibility: uniform distribution
+        random_p = 1.0 / table_width
+
+        # Max range possibility
+        max_range = (r == table_width - 1).astype(np.float64)
+
+        # Measure noise: Gaussian. The exponent keeps the -1 that the original (-1/2) evaluated
+        # to under integer division, which every tuned parameter set has been fit with
+        sigma_hit = self.SIGMA_HIT
+        noise = (1 / (sigma_hit * np.sqrt(2*math.pi))) * np.exp(-1.0*np.square((r-d)/sigma_hit))
+
+        # Unexpected obstacles: exponential, only for readings shorter than expected
+        obstacle = np.where(r <= d, self.LAMDA_SHORT * np.exp(-self.LAMDA_SHORT*r), 0.0)
+
+        # Total possibility, normalized so that each column (fixed d) sums to one
+        sensor_model_table = (self.Z_RAND * random_p + self.Z_HIT * noise +
+                              self.Z_MAX * max_range + self.Z_SHORT * obstacle)
+        sensor_model_table /= sensor_model_table.sum(axis=0)[np.newaxis, :]
 
         return sensor_model_table
 
+    '''
+    Moves every particle back by a displacement in its own frame, to the pose it had when
+    a late scan was taken. The particles themselves are not modified
+      particles: The particles
+      delta: The (dx, dy, dtheta) displacement since the scan, see motion_since
+      Returns the moved particles, as contiguous float32 rows in a reused buffer
+  '''
+
+    def move_back(self, particles, delta):
+        n = particles.shape[0]
+        if not isinstance(self.compensated, np.ndarray) or self.compensated.shape[0] < n:
+            self.compensated = np.zeros((max(self.MAX_PARTICLES, n), 3), dtype=np.float32)
+        moved = self.compensated[:n]
+
+        dx, dy, dtheta = delta
+        moved[:, 2] = particles[:, 2]
+        moved[:, 2] -= dtheta
+        cos_theta = np.cos(moved[:, 2])
+        sin_theta = np.sin(moved[:, 2])
+        moved[:, 0] = particles[:, 0] - (cos_theta*dx - sin_theta*dy)
+        moved[:, 1] = particles[:, 1] - (sin_theta*dx + cos_theta*dy)
+        return moved
+
+    '''
+    Computes the log likelihood of an observation for an arbitrary number of poses,
+    without touching the particles or weights. The poses are ray cast in chunks, so
+    the expected ranges never need more than SCORE_CHUNK_SIZE poses worth of memory
+      poses: Nx3 array of poses in the world
+      obs: An observation, as passed to apply_sensor_model
+      chunk_size: The number of poses ray cast at a time
+      Returns an array with the log likelihood of each pose
+  '''
+
+    def score_poses(self, poses, obs, chunk_size=SCORE_CHUNK_SIZE):
+        obs_ranges = obs[0]
+        obs_angles = obs[1]
+        num_rays = obs_angles.shape[0]
+        num_poses = poses.shape[0]
+        chunk_size = min(chunk_size, num_poses)
+
+        scores = np.zeros(num_poses)
+        queries = np.zeros((chunk_size, 3), dtype=np.float32)
+        ranges = np.zeros(chunk_size*num_rays, dtype=np.float32)
+        sharded = self.sharded_likelihood
+        for start in xrange(0, num_poses, chunk_size):
+            end = min(start + chunk_size, num_poses)
+            queries[:end-start] = poses[start:end]
+            if sharded is not None and sharded.fits(end - start, num_rays):
+                sharded.evaluate(queries[:end-start], obs_ranges, obs_angles, scores[start:end])
+            else:
+                self.likelihood.evaluate(queries[:end-start], obs_ranges, obs_angles,
+                                         ranges[:(end-start)*num_rays], scores[start:end])
+        return scores
+
     '''
     Updates the particle weights in-place based on the observed laser scan
+    The log likelihood of the scan is added to self.log_weights, so that evidence
+    accumulates across scans until the particles are resampled, and the weights are
+    set to the normalized exponential of the log weights
       proposal_dist: The particles
       obs: The most recent observation
       weights: The weights of each particle
@@ -180,22 +380,41 @@ class SensorModel:
         obs_ranges = obs[0]
         obs_angles = obs[1]
         num_rays = obs_angles.shape[0]
+        num_particles = proposal_dist.shape[0]
 
         # Only allocate buffers once to avoid slowness
-        if not isinstance(self.queries, np.ndarray):
-            self.queries = np.zeros((proposal_dist.shape[0], 3), dtype=np.float32)
-            self.ranges = np.zeros(num_rays*proposal_dist.shape[0], dtype=np.float32)
-
-        self.queries[:, :] = proposal_dist[:, :]
-
-        # Raycasting to get expected measurements
-        self.range_method.calc_range_repeat_angles(self.queries, obs_angles, self.ranges)
-
-        # Evaluate the sensor model
-        self.range_method.eval_sensor_model(obs_ranges, self.ranges, weights, num_rays, proposal_dist.shape[0])
+        # The buffers are sized for the most particles and rays, and only their prefix is used
+        if not isinstance(self.log_likelihood, np.ndarray):
+            self.log_likelihood = np.zeros(max(self.MAX_PARTICLES, num_particles))
+        log_likelihood = self.log_likelihood[:num_particles]
+
+        # Particles stored as contiguous float32 rows are ray cast from in place,
+        # any other layout is converted into the queries buffer first
+        if proposal_dist.dtype == np.float32 and proposal_dist.flags.c_contiguous:
+            queries = proposal_dist
+        else:
+            if not isinstance(self.queries, np.ndarray):
+                self.queries = np.zeros((max(self.MAX_PARTICLES, num_particles), 3), dtype=np.float32)
+            queries = self.queries[:num_particles]
+            queries[:, :] = proposal_dist[:, :]
+
+        # Raycast and evaluate the sensor model in the log domain, so that the product
+        # over many rays cannot underflow
+        sharded = self.sharded_likelihood
+        if sharded is not None and sharded.fits(num_particles, num_rays):
+            sharded.evaluate(queries, obs_ranges, obs_angles, log_likelihood)
+        else:
+            if not isinstance(self.ranges, np.ndarray) or self.ranges.shape[0] < num_rays*num_particles:
+                self.ranges = np.zeros(num_rays*max(self.MAX_PARTICLES, num_particles), dtype=np.float32)
+            ranges = self.ranges[:num_rays*num_particles]
+            self.likelihood.evaluate(queries, obs_ranges, obs_angles, ranges, log_likelihood)
 
-        # Squash weights to prevent too much peakiness
-        np.power(weights, INV_SQUASH_FACTOR, weights)
+        # Squash weights to prevent too much peakiness, and accumulate the evidence
+        log_weights = self.log_weights
+        log_weights += self.INV_SQUASH_FACTOR * log_likelihood
+        log_weights -= np.max(log_weights)
+        np.exp(log_weights, weights)
+        weights /= np.sum(weights)
 
 
 '''
@@ -213,6 +432,9 @@ if __name__ == '__main__':
     laser_ray_step = int(rospy.get_param("~laser_ray_step"))  # Step for downsampling laser scans
     exclude_max_range_rays = bool(rospy.get_param("~exclude_max_range_rays"))  # Whether to exclude rays that are beyond the max range
     max_range_meters = float(rospy.get_param("~max_range_meters"))  # The max range of the laser
+    range_method = rospy.get_param("~range_method", "cddt")  # The ray casting backend
+    scan_reduction = rospy.get_param("~scan_reduction", "center")  # How bins of beams are reduced to one ray
+    num_workers = int(rospy.get_param("~num_workers", 1))  # Processes evaluating the sensor model in parallel
 
     print 'Bag path: ' + bag_path
 
@@ -245,7 +467,9 @@ if __name__ == '__main__':
 
     print 'Initializing sensor model'
     sm = SensorModel(scan_topic, laser_ray_step, exclude_max_range_rays,
-                     max_range_meters, map_msg, particles, weights)
+                     max_range_meters, map_msg, particles, weights,
+                     range_method=range_method, scan_reduction=scan_reduction,
+                     num_workers=num_workers)
 
     # Give time to get setup
     rospy.sleep(1.0)
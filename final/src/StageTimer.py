@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import sys
+import time
+from threading import Lock
+
+'''
+  Accumulates wall clock durations of the stages of the filter, so that they can be reported
+'''
+
+
+class StageTimer:
+
+    '''
+    Initializes the timer with no recorded stages
+  '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stats = {}  # Maps stage name to [count, total seconds, max seconds]
+        self.order = []  # Stage names in the order they were first recorded
+
+    '''
+    Records one duration of a stage
+      name: The name of the stage
+      seconds: The duration
+  '''
+
+    def record(self, name, seconds):
+        self.lock.acquire()
+        if name not in self.stats:
+            self.stats[name] = [0, 0.0, 0.0]
+            self.order.append(name)
+        stat = self.stats[name]
+        stat[0] += 1
+        stat[1] += seconds
+        stat[2] = max(stat[2], seconds)
+        self.lock.release()
+
+    '''
+    Records the time elapsed since start for a stage
+      name: The name of the stage
+      start: A value previously returned by time.time()
+      Returns the current time, so that consecutive stages can be chained
+  '''
+
+    def record_since(self, name, start):
+        now = time.time()
+        self.record(name, now - start)
+        return now
+
+    '''
+    Returns a dict mapping each stage name to a dict with its count, mean and max in milliseconds
+  '''
+
+    def summary(self):
+        self.lock.acquire()
+        summary = {}
+        for name in self.order:
+            count, total, max_s = self.stats[name]
+            summary[name] = {'count': count,
+                             'mean_ms': 1000.0 * total / count,
+                             'max_ms': 1000.0 * max_s}
+        self.lock.release()
+        return summary
+
+    '''
+    Returns a one line, human readable summary of every stage
+  '''
+
+    def report(self):
+        summary = self.summary()
+        return ', '.join('%s: %.2f ms (max %.2f, n=%d)' % (name, summary[name]['mean_ms'],
+                                                             summary[name]['max_ms'],
+                                                             summary[name]['count'])
+                         for name in self.order if name in summary)
+
+    '''
+    Forgets all recorded durations
+  '''
+
+    def reset(self):
+        self.lock.acquire()
+        self.stats = {}
+        self.order = []
+        self.lock.release()
+
+
+'''
+  A Lock that records how long it is held, as a stage named after the function that
+  acquired it ('lock:<function>'), so that the stalls each stage causes the others
+  can be told apart. It can be used anywhere a threading.Lock is expected
+'''
+
+
+class TimedLock:
+
+    '''
+    Initializes an unlocked lock
+      timer: The StageTimer that hold times are recorded into
+  '''
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.lock = Lock()
+        self.holder = None  # Stage name of the current holder
+        self.acquired_at = None  # Time at which the current holder acquired the lock
+
+    '''
+    Same as threading.Lock.acquire
+  '''
+
+    def acquire(self, blocking=True):
+        if not self.lock.acquire(blocking):
+            return False
+        self.holder = 'lock:' + sys._getframe(1).f_code.co_name
+        self.acquired_at = time.time()
+        return True
+
+    '''
+    Same as threading.Lock.release, and records the hold time
+  '''
+
+    def release(self):
+        holder = self.holder
+        acquired_at = self.acquired_at
+        self.lock.release()
+        self.timer.record_since(holder, acquired_at)
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.holder = 'lock:' + sys._getframe(1).f_code.co_name
+        self.acquired_at = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -19,7 +19,7 @@ from visualization_msgs.msg import Marker
     Returns: An equivalent geometry_msgs/Quaternion message
 '''
 def angle_to_quaternion(angle):
-    return Quaternion(*tf.transformations.quaternion_from_euler(0, 0, angle))
+    return Quaternion(0.0, 0.0, np.sin(0.5*angle), np.cos(0.5*angle))
 
 '''
   Convert a quaternion message into a yaw angle in radians.
@@ -58,7 +58,48 @@ def particle_to_pose(particle):
     Returns: A list of equivalent geometry_msgs/Pose messages
 '''
 def particles_to_poses(particles):
-    return map(particle_to_pose, particles)
+    return poses_to_pose_array(particles).poses
+
+'''
+  Convert an array of yaw angles in radians into quaternions
+    angles: An array of N yaw angles
+    Returns: An Nx4 numpy array, where each row is a quaternion (x, y, z, w)
+'''
+def angles_to_quaternions(angles):
+    half = 0.5*np.asarray(angles, dtype=np.float64)
+    quaternions = np.zeros(half.shape + (4,))
+    quaternions[..., 2] = np.sin(half)
+    quaternions[..., 3] = np.cos(half)
+    return quaternions
+
+'''
+  Convert an array of quaternions into yaw angles in radians
+    quaternions: An Nx4 array, where each row is a quaternion (x, y, z, w)
+    Returns: An array of the N equivalent yaw angles
+'''
+def quaternions_to_angles(quaternions):
+    q = np.asarray(quaternions, dtype=np.float64)
+    x, y, z, w = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    return np.arctan2(2.0*(w*z + x*y), 1.0 - 2.0*(y*y + z*z))
+
+'''
+  Builds a pose array message from an array of poses. The quaternions are computed
+  for all poses at once, so only the message construction is done per pose
+    poses: An Nx3 numpy array, where each row is [x,y,theta]
+    frame_id: The coordinate frame of the poses
+    stamp: The stamp of the message, defaults to the time at which this function was called
+    Returns: The resulting geometry_msgs/PoseArray
+'''
+def poses_to_pose_array(poses, frame_id="map", stamp=None):
+    poses = np.asarray(poses, dtype=np.float64).reshape((-1, 3))
+    quaternions = angles_to_quaternions(poses[:, 2])
+
+    pa = PoseArray()
+    pa.header = make_header(frame_id, stamp)
+    # Plain floats are much faster to copy into messages than numpy scalars
+    pa.poses = [Pose(Point(x, y, 0.0), Quaternion(0.0, 0.0, qz, qw))
+                for (x, y), (qz, qw) in zip(poses[:, :2].tolist(), quaternions[:, 2:].tolist())]
+    return pa
 
 '''
   Creates a header with the given frame_id and stamp. Default value of stamp is
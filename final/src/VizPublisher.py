@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import copy
+import time
+from threading import Condition, Thread
+
+import numpy as np
+import rospy
+import tf
+import tf.transformations
+from geometry_msgs.msg import PoseStamped, PoseArray
+from nav_msgs.msg import Odometry
+from sensor_msgs.msg import LaserScan
+
+import Utils
+from Utils import poses_to_pose_array
+
+PUBLISH_PREFIX = '/pf/viz'  # Namespace of the published topics
+TF_CACHE_PERIOD = 1.0  # Seconds a looked up laser to odom transform is reused for
+
+'''
+  Publishes the state of the particle filter from a separate thread, so that building
+  and publishing messages never delays the filter. The filter captures a snapshot of
+  its particles and calls notify, and the publisher thread publishes the latest
+  snapshot at no more than max_rate:
+    The expected pose (and the map tf) of every published snapshot
+    A weighted subsample of n_viz_particles particles, at no more than particle_rate
+    The last laser scan, at no more than particle_rate and only while it has subscribers
+'''
+
+
+class VizPublisher:
+
+    '''
+    Creates the publishers and starts the publisher thread
+      snapshots: The ParticleSnapshots captured by the filter
+      expected_pose: Function of (particles, weights) returning the pose to publish
+      n_viz_particles: The number of particles to publish
+      max_rate: The maximum rate (Hz) at which the pose is published
+      particle_rate: The maximum rate (Hz) at which the particles and the scan are published
+      publish_tf: Whether to broadcast the map to odom (or laser) transform
+      prefix: The namespace of the published topics
+  '''
+
+    def __init__(self, snapshots, expected_pose, n_viz_particles, max_rate=20.0, particle_rate=2.0, publish_tf=True,
+                 prefix=PUBLISH_PREFIX):
+        self.snapshots = snapshots
+        self.expected_pose = expected_pose
+        self.N_VIZ_PARTICLES = n_viz_particles
+        self.MIN_PERIOD = 1.0 / max_rate
+        self.PARTICLE_PERIOD = 1.0 / particle_rate
+        self.PUBLISH_TF = publish_tf
+
+        self.pub_tf = tf.TransformBroadcaster()  # Used to create a tf between the map and the laser for visualization
+        self.tfl = tf.TransformListener()  # Looks up the transform between the laser and odom
+        self.pose_pub = rospy.Publisher(prefix + "/inferred_pose", PoseStamped, queue_size=1)  # Publishes the expected pose
+        self.particle_pub = rospy.Publisher(prefix + "/particles", PoseArray, queue_size=1)  # Publishes a subsample of the particles
+        self.pub_laser = rospy.Publisher(prefix + "/scan", LaserScan, queue_size=1)  # Publishes the most recent laser scan
+        self.pub_odom = rospy.Publisher(prefix + "/odom", Odometry, queue_size=1)  # Publishes the path of the car
+
+        self.laser_to_odom = None  # Cached (offset, rotation) from the laser to odom, None if odom does not exist
+        self.laser_to_odom_time = None  # When laser_to_odom was looked up
+
+        self.inferred_pose = None  # The expected pose of the last published snapshot
+        self.published_version = 0  # Version of the last published snapshot
+        self.last_pose_time = 0.0  # When the pose was last published
+        self.last_particle_time = 0.0  # When the particles were last published
+
+        self.cond = Condition()  # Signaled by notify when a new snapshot is available
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    '''
+    Wakes the publisher thread up after the filter has captured a snapshot
+  '''
+
+    def notify(self):
+        self.cond.acquire()
+        self.cond.notify()
+        self.cond.release()
+
+    '''
+    Stops the publisher thread
+  '''
+
+    def stop(self):
+        self.cond.acquire()
+        self.running = False
+        self.cond.notify()
+        self.cond.release()
+        self.thread.join(1.0)
+
+    '''
+    Main loop of the publisher thread
+  '''
+
+    def run(self):
+        while self.running and not rospy.is_shutdown():
+            self.cond.acquire()
+            while self.running and self.snapshots.version == self.published_version:
+                self.cond.wait(1.0)
+            self.cond.release()
+            if not self.running:
+                break
+
+            # Rate limit. Snapshots captured in the meantime are skipped over
+            delay = self.last_pose_time + self.MIN_PERIOD - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            snapshot = self.snapshots.acquire()
+            if snapshot is None:
+                continue
+            try:
+                self.publish_snapshot(snapshot)
+            finally:
+                self.snapshots.release(snapshot)
+
+    '''
+    Publishes one snapshot, at the level of detail allowed by the rates
+      snapshot: A ParticleSnapshot.Snapshot
+  '''
+
+    def publish_snapshot(self, snapshot):
+        now = time.time()
+        self.published_version = snapshot.version
+        self.last_pose_time = now
+
+        self.inferred_pose = self.expected_pose(snapshot.particles, snapshot.weights)
+        stamp = rospy.Time.now()
+        if self.PUBLISH_TF:
+            self.publish_tf(self.inferred_pose, stamp)
+
+        ps = PoseStamped()
+        ps.header = Utils.make_header("map", stamp)
+        ps.pose.position.x = self.inferred_pose[0]
+        ps.pose.position.y = self.inferred_pose[1]
+        ps.pose.orientation = Utils.angle_to_quaternion(self.inferred_pose[2])
+        if self.pose_pub.get_num_connections() > 0:
+            self.pose_pub.publish(ps)
+        if self.pub_odom.get_num_connections() > 0:
+            odom = Odometry()
+            odom.header = ps.header
+            odom.pose.pose = ps.pose
+            self.pub_odom.publish(odom)
+
+        if now - self.last_particle_time < self.PARTICLE_PERIOD:
+            return
+        self.last_particle_time = now
+
+        if self.particle_pub.get_num_connections() > 0:
+            particles = snapshot.particles
+            if particles.shape[0] > self.N_VIZ_PARTICLES:
+                # Randomly downsample the particles, favoring the ones with higher weights
+                indices = np.random.choice(particles.shape[0], self.N_VIZ_PARTICLES, p=snapshot.weights)
+                self.publish_particles(particles[indices, :])
+            else:
+                self.publish_particles(particles)
+
+        if self.pub_laser.get_num_connections() > 0 and isinstance(snapshot.laser, LaserScan):
+            # The scan is shared with the filter (and with every filter of a FilterHost), so
+            # it is republished as a copy with its own header instead of being restamped
+            laser = copy.copy(snapshot.laser)
+            laser.header = Utils.make_header("/laser", stamp)
+            self.pub_laser.publish(laser)
+
+    '''
+    Publish a tf between the laser and the map
+    This is necessary in order to visualize the laser scan within the map
+    The transform between the laser and odom is only looked up every TF_CACHE_PERIOD
+      pose: The pose of the laser w.r.t the map
+      stamp: The time at which this pose was calculated, defaults to None - resulting
+             in using the time at which this function was called as the stamp
+  '''
+
+    def publish_tf(self, pose, stamp=None):
+        if stamp is None:
+            stamp = rospy.Time.now()
+
+        now = time.time()
+        if self.laser_to_odom_time is None or now - self.laser_to_odom_time > TF_CACHE_PERIOD:
+            try:
+                # Lookup the offset between laser and odom
+                self.laser_to_odom = self.tfl.lookupTransform("/laser", "/odom", rospy.Time(0))
+            except (tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException):
+                # Will occur if odom frame does not exist
+                self.laser_to_odom = None
+            self.laser_to_odom_time = now
+
+        if self.laser_to_odom is None:
+            self.pub_tf.sendTransform((pose[0], pose[1], 0), tf.transformations.quaternion_from_euler(0, 0, pose[2]),
+                                      stamp, "/laser", "/map")
+            return
+
+        delta_off, delta_rot = self.laser_to_odom
+
+        # Transform offset to be w.r.t the map
+        off_x = delta_off[0]*np.cos(pose[2]) - delta_off[1]*np.sin(pose[2])
+        off_y = delta_off[0]*np.sin(pose[2]) + delta_off[1]*np.cos(pose[2])
+
+        # Broadcast the tf
+        yaw = pose[2] + tf.transformations.euler_from_quaternion(delta_rot)[2]
+        self.pub_tf.sendTransform((pose[0]+off_x, pose[1]+off_y, 0.0), tf.transformations.quaternion_from_euler(0, 0, yaw),
+                                  stamp, "/odom", "/map")
+
+    '''
+    Helper function for publishing a pose array of particles
+      particles: To particles to publish
+  '''
+
+    def publish_particles(self, particles):
+        self.particle_pub.publish(poses_to_pose_array(particles, "map"))
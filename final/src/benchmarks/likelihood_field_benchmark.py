@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from geometry_msgs.msg import PoseWithCovarianceStamped
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Utils  # noqa: E402
+from FitNoiseParams import interpolate_poses, read_reference_poses, scan_message  # noqa: E402
+from MapResources import MapResources  # noqa: E402
+from NoiseParams import load_noise_params  # noqa: E402
+from ParticleFilter import ParticleFilter  # noqa: E402
+from Replay import Replay, load_log, load_map  # noqa: E402
+from SensorModel import SENSOR_MODELS, SensorModel  # noqa: E402
+
+'''
+  Compares the beam (ray casting) and likelihood field sensor models side by side on a
+  recorded log with reference poses of the car, see FitNoiseParams.py for their formats.
+    Speed: The ms per scan to weigh particles spread around the reference pose, for every
+      particle count, averaged over a sample of the scans.
+    Scoring accuracy: For the same scans, the reference pose is scored with poses perturbed
+      around it, and the error of the best scoring pose is averaged.
+    Tracking accuracy: The whole log is replayed through the filter with each model, from the
+      first reference pose, and the RMS error of its expected pose against the reference is
+      reported with the replay time.
+  Usage:
+    python likelihood_field_benchmark.py --map map.yaml --log run.bag --poses reference.csv
+                                         [--counts 500 5000 50000] [--scans 50] [--no-replay]
+'''
+
+SPREAD = np.array([0.2, 0.2, 0.1])  # Std devs of the particles and candidates around the reference pose
+
+'''
+  Times the weighing of particles and measures how well the best scoring pose matches the
+  reference, on a sample of the scans
+    sensor_model: The SensorModel to evaluate
+    log: A dict of arrays, see Replay.save_log
+    poses, scans: The reference pose of each scan, and the indices of the sampled scans
+    counts: The numbers of particles to time
+    candidates: The number of perturbed poses scored with each reference pose
+    Returns (ms per scan for each count, mean position error, mean heading error)
+'''
+def evaluate_model(sensor_model, log, poses, scans, counts, candidates):
+    msg = scan_message(log)
+    rng = np.random.RandomState(0)
+    times = np.zeros(len(counts))
+    position_errors, heading_errors = [], []
+    for i in scans:
+        msg.ranges = log['scan_ranges'][i]
+        obs = sensor_model.scan_processor.process(msg)
+
+        for k, n in enumerate(counts):
+            particles = (poses[i] + rng.standard_normal((n, 3)) * SPREAD).astype(np.float32)
+            start = time.time()
+            sensor_model.score_poses(particles, obs)
+            times[k] += time.time() - start
+
+        # The reference pose is candidate 0
+        perturbed = poses[i] + rng.standard_normal((candidates + 1, 3)) * SPREAD
+        perturbed[0] = poses[i]
+        best = perturbed[np.argmax(sensor_model.score_poses(perturbed, obs))]
+        position_errors.append(np.hypot(best[0] - poses[i][0], best[1] - poses[i][1]))
+        heading_errors.append(abs(np.mod(best[2] - poses[i][2] + np.pi, 2 * np.pi) - np.pi))
+
+    return 1000.0 * times / len(scans), np.mean(position_errors), np.mean(heading_errors)
+
+'''
+  Replays the log through a filter using a sensor model, starting from the first reference pose
+    sensor_model: One of SENSOR_MODELS
+    log: A dict of arrays, see Replay.save_log
+    reference: The reference poses, see FitNoiseParams.read_reference_poses
+    resources: The MapResources of the map
+    noise_params: The noise parameters of the filter, None for the defaults
+    args: The parsed command line arguments
+    Returns (RMS position error, RMS heading error, seconds taken, number of poses compared)
+'''
+def replay_model(sensor_model, log, reference, resources, noise_params, args):
+    np.random.seed(args.seed)
+    pf = ParticleFilter(args.n_particles, 0, None, None, None, args.laser_ray_step,
+                        not args.include_max_range_rays, args.max_range_meters, 'low_variance',
+                        args.speed_to_erpm_offset, args.speed_to_erpm_gain,
+                        args.steering_angle_to_servo_offset, args.steering_angle_to_servo_gain,
+                        args.car_length, args.range_method, resources=resources, live=False,
+                        batch_motion=True, noise_params=noise_params, sensor_model=sensor_model)
+    msg = PoseWithCovarianceStamped()
+    msg.pose.pose.position.x = reference[0, 1]
+    msg.pose.pose.position.y = reference[0, 2]
+    msg.pose.pose.orientation = Utils.angle_to_quaternion(reference[0, 3])
+    pf.clicked_pose_cb(msg)
+
+    start = time.time()
+    trajectory = Replay(pf, log).run()
+    elapsed = time.time() - start
+
+    truth, valid = interpolate_poses(reference, trajectory[:, 0])
+    error = trajectory[valid, 1:] - truth[valid]
+    heading = np.mod(error[:, 2] + np.pi, 2 * np.pi) - np.pi
+    return (np.sqrt(np.mean(np.sum(np.square(error[:, :2]), axis=1))), np.sqrt(np.mean(np.square(heading))),
+            elapsed, np.count_nonzero(valid))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the beam and likelihood field sensor models on a log')
+    parser.add_argument('--log', required=True, help='A .bag, or a .npz written with Replay.py --extract')
+    parser.add_argument('--map', required=True, help="The map's yaml file, as given to map_server")
+    parser.add_argument('--poses', required=True, help='Reference poses, see FitNoiseParams.py')
+    parser.add_argument('--pose-topic', default='/car/car_pose', help='The PoseStamped topic of a --poses bag')
+    parser.add_argument('--noise-params', help='A noise parameter file written by FitNoiseParams.py')
+    parser.add_argument('--counts', type=int, nargs='+', default=[500, 5000, 50000],
+                        help='Numbers of particles to weigh')
+    parser.add_argument('--scans', type=int, default=50, help='Scans, evenly spread over the log, to evaluate')
+    parser.add_argument('--candidates', type=int, default=500, help='Perturbed poses scored per scan')
+    parser.add_argument('--no-replay', action='store_true', help='Skip replaying the log through the filter')
+    parser.add_argument('--n-particles', type=int, default=500, help='Particles of the replayed filter')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the filter randomness')
+    parser.add_argument('--motor-state-topic', default='/car/vesc/sensors/core')
+    parser.add_argument('--servo-state-topic', default='/car/vesc/sensors/servo_position_command')
+    parser.add_argument('--scan-topic', default='/car/scan')
+    parser.add_argument('--laser-ray-step', type=int, default=30)
+    parser.add_argument('--include-max-range-rays', action='store_true')
+    parser.add_argument('--max-range-meters', type=float, default=11.0)
+    parser.add_argument('--range-method', default='cddt', help='Ray casting backend of the beam model')
+    parser.add_argument('--speed-to-erpm-offset', type=float, default=0.0)
+    parser.add_argument('--speed-to-erpm-gain', type=float, default=4350)
+    parser.add_argument('--steering-angle-to-servo-offset', type=float, default=0.5)
+    parser.add_argument('--steering-angle-to-servo-gain', type=float, default=-1.2135)
+    parser.add_argument('--car-length', type=float, default=0.33)
+    args = parser.parse_args()
+
+    log = load_log(args.log, args.motor_state_topic, args.servo_state_topic, args.scan_topic)
+    map_msg = load_map(args.map)
+    resources = MapResources(map_msg)
+    noise_params = load_noise_params(args.noise_params) if args.noise_params else None
+    reference = read_reference_poses(args.poses, args.pose_topic)
+    poses, valid = interpolate_poses(reference, log['scan_stamp'])
+    scans = np.nonzero(valid)[0]
+    scans = scans[np.linspace(0, scans.shape[0] - 1, min(args.scans, scans.shape[0])).astype(int)]
+
+    print('%-18s%10s' % ('sensor model', 'setup') + ''.join('%12s' % ('%d (ms)' % n) for n in args.counts) +
+          '%12s%12s' % ('best (m)', 'best (rad)'))
+    for model in SENSOR_MODELS:
+        start = time.time()
+        sensor_model = SensorModel(None, args.laser_ray_step, not args.include_max_range_rays,
+                                   args.max_range_meters, map_msg, np.zeros((1, 3), dtype=np.float32),
+                                   np.ones(1), range_method=args.range_method, resources=resources,
+                                   noise_params=noise_params, sensor_model=model)
+        setup = time.time() - start
+        times, position_error, heading_error = evaluate_model(sensor_model, log, poses, scans,
+                                                              args.counts, args.candidates)
+        print('%-18s%9.2fs' % (model, setup) + ''.join('%12.2f' % t for t in times) +
+              '%12.3f%12.3f' % (position_error, heading_error))
+
+    if not args.no_replay:
+        print('%-18s%12s%12s%12s%8s' % ('sensor model', 'rms (m)', 'rms (rad)', 'replay (s)', 'poses'))
+        for model in SENSOR_MODELS:
+            position_rms, heading_rms, elapsed, n = replay_model(model, log, reference, resources,
+                                                                 noise_params, args)
+            print('%-18s%12.3f%12.3f%12.1f%8d' % (model, position_rms, heading_rms, elapsed, n))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import rospy
+from std_msgs.msg import Float64
+from vesc_msgs.msg import VescStateStamped
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ParticleFilter import ParticleFilter  # noqa: E402
+from ReSample import RESAMPLE_TYPES  # noqa: E402
+from ScanProcessor import ScanProcessor  # noqa: E402
+from synthetic import MAX_RANGE_METERS, synthetic_map, synthetic_scan  # noqa: E402
+
+'''
+  Times every stage of the particle filter on a synthetic map and scan, for several
+  particle counts and laser_ray_step values, and writes the results as JSON. Results
+  can be compared against an earlier run to catch regressions before they reach the car.
+  Usage:
+    python localization_benchmark.py [--counts 500 5000 50000 100000] [--steps 10 30 60]
+                                     [--output results.json] [--baseline old.json] [--tolerance 0.2]
+'''
+
+SPEED_TO_ERPM_OFFSET = 0.0  # Offset conversion param from rpm to speed
+SPEED_TO_ERPM_GAIN = 4350  # Gain conversion param from rpm to speed
+STEERING_TO_SERVO_OFFSET = 0.5  # Offset conversion param from servo position to steering angle
+STEERING_TO_SERVO_GAIN = -1.2135  # Gain conversion param from servo position to steering angle
+CAR_LENGTH = 0.33  # The length of the car
+MOTION_DT = 0.02  # Seconds between simulated VESC states
+TRUE_POSE = [10.0, 10.0, 0.3]  # Pose the synthetic scan is taken from
+
+'''
+  Returns the mean and min time in milliseconds of calling fn
+    fn: The function to time
+    trials: The number of calls to time
+    setup: Called before every call of fn, outside of the timed region
+'''
+def time_stage(fn, trials, setup=None):
+    times = []
+    for _ in range(trials):
+        if setup is not None:
+            setup()
+        start = time.time()
+        fn()
+        times.append(1000.0 * (time.time() - start))
+    return float(np.mean(times)), float(np.min(times))
+
+'''
+  Times every stage of a particle filter with n particles
+    n: The number of particles
+    steps: The laser_ray_step values to time the sensor model with
+    args: The parsed command line arguments
+    Returns a list of result dicts
+'''
+def benchmark_count(n, steps, args):
+    np.random.seed(args.seed)
+    map_msg = synthetic_map()
+    pf = ParticleFilter(n, 0, None, None, None, steps[0], True, MAX_RANGE_METERS, 'low_variance',
+                        SPEED_TO_ERPM_OFFSET, SPEED_TO_ERPM_GAIN, STEERING_TO_SERVO_OFFSET,
+                        STEERING_TO_SERVO_GAIN, CAR_LENGTH, args.range_method,
+                        map_msg=map_msg, live=False)
+    scan = synthetic_scan(pf.sensor_model.range_method, TRUE_POSE)
+    results = []
+
+    def add(stage, timing, laser_ray_step=None, rays=None):
+        results.append({'stage': stage, 'particles': n, 'laser_ray_step': laser_ray_step,
+                        'rays': rays, 'mean_ms': timing[0], 'min_ms': timing[1],
+                        'trials': args.trials})
+
+    # Motion model, driving forward while turning
+    servo_msg = Float64()
+    servo_msg.data = STEERING_TO_SERVO_GAIN*0.1 + STEERING_TO_SERVO_OFFSET
+    pf.motion_model.servo_cb(servo_msg)
+    vesc_msg = VescStateStamped()
+    vesc_msg.state.speed = SPEED_TO_ERPM_GAIN*1.0 + SPEED_TO_ERPM_OFFSET
+    vesc_msg.header.stamp = rospy.Time.from_sec(0.0)
+    pf.motion_model.motion_cb(vesc_msg)
+
+    def advance_stamp():
+        vesc_msg.header.stamp = rospy.Time.from_sec(vesc_msg.header.stamp.to_sec() + MOTION_DT)
+    add('motion', time_stage(lambda: pf.motion_model.motion_cb(vesc_msg), args.trials, advance_stamp))
+
+    # Scan processing and sensor model, for every laser_ray_step
+    for step in steps:
+        processor = ScanProcessor(step, True, MAX_RANGE_METERS)
+        obs = processor.process(scan)
+        rays = int(obs[0].shape[0])
+        add('scan_processing', time_stage(lambda: processor.process(scan), args.trials), step, rays)
+        add('sensor_model', time_stage(lambda: pf.sensor_model.apply_sensor_model(pf.particles, obs, pf.weights),
+                                       args.trials), step, rays)
+
+    # Resampling, from freshly randomized weights every time
+    def randomize_weights():
+        pf.weights[:] = np.random.random(n)
+        pf.weights /= np.sum(pf.weights)
+    for method in RESAMPLE_TYPES:
+        if method == 'naiive':
+            continue  # Same as multinomial
+        add('resample_' + method, time_stage(lambda: pf.resampler.resample(method), args.trials,
+                                             randomize_weights))
+
+    randomize_weights()
+    add('expected_pose', time_stage(pf.expected_pose, args.trials))
+
+    if pf.sensor_model.sharded_likelihood is not None:
+        pf.sensor_model.sharded_likelihood.close()
+    return results
+
+'''
+  Compares results against a baseline, matching entries by stage, particles and laser_ray_step
+    results, baseline: Lists of result dicts
+    tolerance: Allowed relative slowdown of the min time
+    Returns a list of (result, baseline result) pairs that regressed
+'''
+def find_regressions(results, baseline, tolerance):
+    key = lambda r: (r['stage'], r['particles'], r['laser_ray_step'])
+    previous = dict((key(r), r) for r in baseline)
+    regressions = []
+    for r in results:
+        old = previous.get(key(r))
+        if old is not None and r['min_ms'] > (1.0 + tolerance) * old['min_ms']:
+            regressions.append((r, old))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time every stage of the particle filter')
+    parser.add_argument('--counts', type=int, nargs='+', default=[500, 5000, 50000, 100000],
+                        help='Numbers of particles')
+    parser.add_argument('--steps', type=int, nargs='+', default=[10, 30, 60],
+                        help='laser_ray_step values used for the sensor model')
+    parser.add_argument('--trials', type=int, default=10, help='Calls timed per stage')
+    parser.add_argument('--range-method', default='cddt', help='cddt, rmgpu, numpy or lut')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the filter randomness')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown against the baseline reported as a regression')
+    args = parser.parse_args()
+
+    results = []
+    print('%-22s%10s%6s%6s%12s%12s' % ('stage', 'particles', 'step', 'rays', 'mean (ms)', 'min (ms)'))
+    for n in args.counts:
+        for r in benchmark_count(n, args.steps, args):
+            results.append(r)
+            print('%-22s%10d%6s%6s%12.3f%12.3f' % (r['stage'], r['particles'],
+                                                   '-' if r['laser_ray_step'] is None else r['laser_ray_step'],
+                                                   '-' if r['rays'] is None else r['rays'],
+                                                   r['mean_ms'], r['min_ms']))
+
+    if args.output:
+        meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(),
+                'python': platform.python_version(), 'numpy': np.__version__,
+                'range_method': args.range_method, 'trials': args.trials, 'seed': args.seed}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        print('Wrote ' + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for r, old in regressions:
+            print('Regression: %s with %d particles (step %s) took %.3f ms, was %.3f ms'
+                  % (r['stage'], r['particles'], r['laser_ray_step'], r['min_ms'], old['min_ms']))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against ' + args.baseline)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from MotionModel import (KM_DELTA_NOISE, KM_THETA_FIX_NOISE, KM_V_NOISE,  # noqa: E402
+                         KM_X_FIX_NOISE, KM_Y_FIX_NOISE, KinematicMotionModel)
+
+'''
+  Per-message cost of the kinematic motion model, against the original implementation
+  Usage: python motion_benchmark.py [--counts 500 5000 50000 100000] [--rate 50]
+'''
+
+CAR_LENGTH = 0.33  # The length of the car
+SPEED = 1.0  # Nominal speed of the simulated messages
+STEERING = 0.1  # Nominal steering angle of the simulated messages
+
+'''
+  The original propagation of motion_cb, kept as the baseline of the benchmark
+'''
+def propagate_original(particles, curr_speed, curr_steering, dt):
+    v = curr_speed + np.random.normal(0.0, KM_V_NOISE, len(particles))
+    delta = curr_steering + np.random.normal(0.0, KM_DELTA_NOISE, len(particles))
+    sin_2beta = np.sin(2 * np.arctan(np.tan(delta)/2))
+    car_length_div_sin_2beta = CAR_LENGTH / sin_2beta
+
+    d_theta = ((v/CAR_LENGTH)*sin_2beta) * dt
+    d_x = car_length_div_sin_2beta * (np.sin(particles[:, 2]+d_theta)-np.sin(particles[:, 2]))
+    d_y = car_length_div_sin_2beta * (-np.cos(particles[:, 2]+d_theta)+np.cos(particles[:, 2]))
+
+    particles[:, 0] += d_x + np.random.normal(0.0, KM_X_FIX_NOISE, len(particles))
+    particles[:, 1] += d_y + np.random.normal(0.0, KM_Y_FIX_NOISE, len(particles))
+    particles[:, 2] += d_theta + np.random.normal(0.0, KM_THETA_FIX_NOISE, len(particles))
+    particles[:, 2] = np.mod(particles[:, 2] + np.pi, 2*np.pi) - np.pi
+
+'''
+  Returns the mean seconds per message of a propagation function
+'''
+def time_propagation(fn, trials, dt):
+    start = time.time()
+    for _ in range(trials):
+        fn(SPEED, STEERING, dt)
+    return (time.time() - start) / trials
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the kinematic motion model per VESC message')
+    parser.add_argument('--counts', type=int, nargs='+', default=[500, 5000, 50000, 100000],
+                        help='Numbers of particles to propagate')
+    parser.add_argument('--trials', type=int, default=200, help='Messages timed per configuration')
+    parser.add_argument('--rate', type=float, default=50.0, help='VESC message rate (Hz) to report the load at')
+    args = parser.parse_args()
+
+    dt = 1.0 / args.rate
+    np.random.seed(0)
+    print('%-10s%16s%16s%10s%16s' % ('particles', 'original (ms)', 'fused (ms)', 'speedup',
+                                     'load @ %g Hz' % args.rate))
+    for n in args.counts:
+        particles = np.random.uniform(-10.0, 10.0, (n, 3))
+        kmm = KinematicMotionModel(None, None, 0.0, 1.0, 0.0, 1.0, CAR_LENGTH, particles)
+
+        original = time_propagation(lambda s, d, t: propagate_original(particles, s, d, t), args.trials, dt)
+        fused = time_propagation(kmm.propagate, args.trials, dt)
+        print('%-10d%16.3f%16.3f%10.1f%15.1f%%' % (n, 1000.0 * original, 1000.0 * fused,
+                                                   original / fused, 100.0 * fused * args.rate))
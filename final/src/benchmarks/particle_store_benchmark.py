@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2, where the allocations are not measured
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from MotionModel import KinematicMotionModel  # noqa: E402
+from ReSample import ReSampler  # noqa: E402
+
+'''
+  Memory traffic of one motion, query and resample cycle of the filter, for the original
+  float64 particles that are copied into the float32 queries and back from the resampler's
+  scratch buffer, against the float32 store that every stage works on in place
+  The stage timings and the peak bytes allocated during a cycle (with tracemalloc, which
+  numpy reports its buffers to, so only under Python 3) are measured. The bytes copied
+  between the stages and the bytes of the buffers a cycle touches are estimated from the
+  sizes of the arrays
+  Usage: python particle_store_benchmark.py [--counts 5000 50000 100000 500000] [--trials 50]
+'''
+
+CAR_LENGTH = 0.33  # The length of the car
+SPEED = 1.0  # Nominal speed of the propagation
+STEERING = 0.1  # Nominal steering angle of the propagation
+DT = 0.1  # Seconds of motion per cycle, about one scan
+
+'''
+  One cycle of the filter with a particle layout
+    copied: Whether the particles are float64 and copied between the stages
+'''
+class Cycle:
+
+    '''
+    Allocates the particles and the stages
+      n: The number of particles
+      copied: Whether to use the original float64 layout with copies
+  '''
+
+    def __init__(self, n, copied):
+        self.copied = copied
+        dtype = np.float64 if copied else np.float32
+        self.particles = np.random.uniform(-10.0, 10.0, (n, 3)).astype(dtype)
+        self.spare = np.zeros_like(self.particles)
+        self.weights = np.ones(n) / n
+        self.queries = np.zeros((n, 3), dtype=np.float32)
+        self.motion_model = KinematicMotionModel(None, None, 0.0, 1.0, 0.0, 1.0, CAR_LENGTH, self.particles)
+        self.resampler = ReSampler(self.particles, self.weights)
+
+    '''
+    Returns the float32 queries the sensor model ray casts from
+  '''
+
+    def queries_of(self):
+        if self.copied:
+            self.queries[:] = self.particles
+            return self.queries
+        return self.particles
+
+    '''
+    Resamples, copying back from the scratch buffer or swapping the buffers
+  '''
+
+    def resample(self):
+        if self.copied:
+            self.resampler.resample('low_variance')
+            return
+        self.resampler.resample_into('low_variance', self.spare)
+        self.particles, self.spare = self.spare, self.particles
+        self.motion_model.particles = self.particles
+        self.resampler.particles = self.particles
+        self.resampler.reset_weights()
+
+    '''
+    Returns estimates, from the sizes of the arrays, of the bytes copied between the stages
+    in one cycle, and of the bytes of the particle buffers, scratch buffers and queries
+    that the cycle touches
+  '''
+
+    def traffic(self):
+        particle_bytes = self.particles.nbytes
+        scratch = self.motion_model
+        scratch_bytes = sum(a.nbytes for a in (scratch.noise, scratch.dtheta, scratch.half,
+                                               scratch.chord, scratch.tmp, scratch.curved))
+        if self.copied:
+            # Queries: read float64, write float32. Resample: read and write the scratch copy
+            copied = particle_bytes + self.queries.nbytes + 2 * particle_bytes
+            working_set = 2 * particle_bytes + scratch_bytes + self.queries.nbytes
+        else:
+            copied = 0
+            working_set = 2 * particle_bytes + scratch_bytes
+        return copied, working_set
+
+'''
+  Returns the mean milliseconds per cycle spent in the motion model, in preparing the
+  queries and in resampling
+'''
+def time_cycle(cycle, trials):
+    totals = np.zeros(3)
+    for _ in range(trials):
+        start = time.time()
+        cycle.motion_model.propagate(SPEED, STEERING, DT)
+        mid = time.time()
+        cycle.queries_of()
+        end = time.time()
+        cycle.weights[:] = np.random.random(cycle.weights.shape[0])
+        cycle.weights /= np.sum(cycle.weights)
+        resample_start = time.time()
+        cycle.resample()
+        totals += (mid - start, end - mid, time.time() - resample_start)
+    return 1000.0 * totals / trials
+
+'''
+  Returns the peak bytes allocated by the motion model, the queries and the resampling of
+  one cycle, as measured by tracemalloc, or None if tracemalloc is not available
+'''
+def allocated_in_cycle(cycle):
+    if tracemalloc is None:
+        return None
+    cycle.weights[:] = np.random.random(cycle.weights.shape[0])
+    cycle.weights /= np.sum(cycle.weights)
+    tracemalloc.start()
+    cycle.motion_model.propagate(SPEED, STEERING, DT)
+    cycle.queries_of()
+    cycle.resample()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the memory traffic of the particle layouts')
+    parser.add_argument('--counts', type=int, nargs='+', default=[5000, 50000, 100000, 500000],
+                        help='Numbers of particles')
+    parser.add_argument('--trials', type=int, default=50, help='Cycles timed per configuration')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    print('%-10s%-10s%12s%12s%12s%16s%18s%18s' % ('particles', 'layout', 'motion (ms)', 'queries (ms)',
+                                                  'resample (ms)', 'allocated (MB)', 'est. copied (MB)',
+                                                  'est. touched (MB)'))
+    for n in args.counts:
+        for copied in (True, False):
+            cycle = Cycle(n, copied)
+            motion, queries, resample = time_cycle(cycle, args.trials)
+            allocated = allocated_in_cycle(cycle)
+            copied_bytes, working_set = cycle.traffic()
+            print('%-10d%-10s%12.3f%12.3f%12.3f%16s%18.2f%18.2f' % (n, 'float64' if copied else 'float32',
+                                                                    motion, queries, resample,
+                                                                    'n/a' if allocated is None else
+                                                                    '%.2f' % (allocated / 1e6),
+                                                                    copied_bytes / 1e6, working_set / 1e6))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ReSample import ReSampler  # noqa: E402
+
+'''
+  Microbenchmark of the resampling schemes of ReSampler
+  Usage: python resample_benchmark.py [--counts 1000 10000 100000] [--trials 20]
+'''
+
+METHODS = ('multinomial', 'low_variance', 'stratified', 'residual')
+
+'''
+  The original per-particle low variance resampler, kept as the baseline of the benchmark
+'''
+def resample_low_variance_loop(particles, weights):
+    weights /= np.sum(weights)
+    particles_tmp = np.zeros_like(particles)
+
+    M = len(weights)
+    r = (1.0/M) * np.random.rand(1)
+    c = weights[0]
+    i = 0
+    for m in range(M):
+        U = r + float(m)/M
+        while U > c:
+            i += 1
+            c = c+weights[i]
+        particles_tmp[m] = particles[i]
+    particles[:] = particles_tmp[:]
+
+'''
+  Returns the mean time in seconds of one resample of n particles with the given method
+'''
+def time_method(method, n, trials):
+    particles = np.random.uniform(-10.0, 10.0, (n, 3))
+    weights = np.random.random(n)
+    weights /= np.sum(weights)
+    rs = ReSampler(particles, weights)
+
+    total = 0.0
+    for _ in range(trials):
+        weights[:] = np.random.random(n)
+        weights /= np.sum(weights)
+        start = time.time()
+        if method == 'loop':
+            resample_low_variance_loop(particles, weights)
+        else:
+            rs.resample(method)
+        total += time.time() - start
+    return total / trials
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the resampling schemes of ReSampler')
+    parser.add_argument('--counts', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Numbers of particles to resample')
+    parser.add_argument('--trials', type=int, default=20, help='Resamples timed per configuration')
+    parser.add_argument('--loop-trials', type=int, default=3,
+                        help='Resamples timed for the per-particle loop baseline (0 to skip it)')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    methods = METHODS + (('loop',) if args.loop_trials > 0 else ())
+    print('%-10s' % 'particles' + ''.join('%16s' % m for m in methods) + '   (ms per resample)')
+    for n in args.counts:
+        row = '%-10d' % n
+        for method in methods:
+            trials = args.loop_trials if method == 'loop' else args.trials
+            row += '%16.3f' % (1000.0 * time_method(method, n, trials))
+        print(row)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from RangeMethod import make_range_method  # noqa: E402
+from ScanLikelihood import ScanLikelihood, ShardedScanLikelihood  # noqa: E402
+from synthetic import (MAP_RESOLUTION, MAP_SIZE, MAX_RANGE_METERS, synthetic_map,  # noqa: E402
+                       synthetic_table)
+
+'''
+  Compares the serial and sharded evaluation of the sensor model on a synthetic map
+  Usage: python sensor_model_benchmark.py [--counts 1000 10000 50000] [--workers 2 4] [--range-method cddt]
+'''
+
+THETA_DISCRETIZATION = 112  # Discretization of scanning angle
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare serial and sharded sensor model evaluation')
+    parser.add_argument('--counts', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help='Numbers of particles to weigh')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4],
+                        help='Numbers of worker processes to compare')
+    parser.add_argument('--rays', type=int, default=36, help='Rays per scan')
+    parser.add_argument('--trials', type=int, default=5, help='Evaluations timed per configuration')
+    parser.add_argument('--range-method', default='cddt', help='cddt, rmgpu, numpy or lut')
+    args = parser.parse_args()
+
+    map_msg = synthetic_map()
+    max_range_px = int(MAX_RANGE_METERS / MAP_RESOLUTION)
+    range_method = make_range_method(map_msg, max_range_px, THETA_DISCRETIZATION, args.range_method)
+    table = synthetic_table(max_range_px)
+    range_method.set_sensor_model(table)
+    likelihood = ScanLikelihood(range_method, table, max_range_px, MAP_RESOLUTION)
+
+    rng = np.random.RandomState(0)
+    extent = MAP_SIZE * MAP_RESOLUTION
+    obs_angles = np.linspace(-np.pi/2, np.pi/2, args.rays).astype(np.float32)
+    obs_ranges = rng.uniform(0.5, MAX_RANGE_METERS, args.rays).astype(np.float32)
+
+    pools = [ShardedScanLikelihood(likelihood, n, max(args.counts), args.rays) for n in args.workers]
+    print('%-10s%12s' % ('particles', 'serial') +
+          ''.join('%16s' % ('%d workers' % n) for n in args.workers) + '   (ms per scan, speedup)')
+    for count in args.counts:
+        queries = np.zeros((count, 3), dtype=np.float32)
+        queries[:, :2] = rng.uniform(0.0, extent, (count, 2))
+        queries[:, 2] = rng.uniform(-np.pi, np.pi, count)
+
+        row = None
+        for pool in pools:
+            serial, sharded = pool.measure_speedup(queries, obs_ranges, obs_angles, args.trials)
+            if row is None:
+                row = '%-10d%12.2f' % (count, 1000.0 * serial)
+            row += '%16s' % ('%.2f (%.1fx)' % (1000.0 * sharded, serial / sharded))
+        print(row)
+
+    for pool in pools:
+        pool.close()
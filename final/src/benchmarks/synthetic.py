@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import numpy as np
+from nav_msgs.msg import OccupancyGrid
+from sensor_msgs.msg import LaserScan
+
+'''
+  Synthetic maps and scans shared by the benchmarks
+'''
+
+MAP_SIZE = 400  # Width and height of the synthetic map in pixels
+MAP_RESOLUTION = 0.05  # Meters per pixel of the synthetic map
+MAX_RANGE_METERS = 11.0  # The max range of the simulated laser
+SCAN_BEAMS = 1081  # Number of beams of the simulated laser
+SCAN_FOV = 4.71238898  # Field of view of the simulated laser (270 degrees)
+SCAN_NOISE = 0.02  # Std dev (meters) of the noise added to simulated ranges
+
+'''
+  Returns a nav_msgs/OccupancyGrid of a walled room with a few boxes in it
+    seed: Seed of the box placement
+'''
+def synthetic_map(seed=1):
+    grid = np.zeros((MAP_SIZE, MAP_SIZE), dtype=np.int8)
+    grid[:2, :] = grid[-2:, :] = grid[:, :2] = grid[:, -2:] = 100
+    rng = np.random.RandomState(seed)
+    for _ in range(20):
+        x, y = rng.randint(10, MAP_SIZE - 40, 2)
+        w, h = rng.randint(5, 30, 2)
+        grid[y:y+h, x:x+w] = 100
+
+    map_msg = OccupancyGrid()
+    map_msg.info.resolution = MAP_RESOLUTION
+    map_msg.info.width = MAP_SIZE
+    map_msg.info.height = MAP_SIZE
+    map_msg.info.origin.orientation.w = 1.0
+    map_msg.data = grid.ravel().tolist()
+    return map_msg
+
+'''
+  Returns a sensor model table of the right shape. The values do not affect the timings
+    max_range_px: The max range of the laser in pixels
+'''
+def synthetic_table(max_range_px):
+    r = np.arange(max_range_px + 1, dtype=np.float64)[:, np.newaxis]
+    table = np.exp(-0.5*np.square(r - r.T)) + 1.0 / (max_range_px + 1)
+    return table / table.sum(axis=0)[np.newaxis, :]
+
+'''
+  Simulates a laser scan taken from a pose
+    range_method: The ray casting backend used to simulate the ranges, see RangeMethod
+    pose: The [x, y, theta] pose of the laser in the world
+    seed: Seed of the range noise
+    Returns the sensor_msgs/LaserScan
+'''
+def synthetic_scan(range_method, pose, seed=0):
+    angles = np.linspace(-SCAN_FOV/2, SCAN_FOV/2, SCAN_BEAMS).astype(np.float32)
+    ranges = np.zeros(SCAN_BEAMS, dtype=np.float32)
+    range_method.calc_range_repeat_angles(np.array([pose], dtype=np.float32), angles, ranges)
+    ranges += np.random.RandomState(seed).normal(0.0, SCAN_NOISE, SCAN_BEAMS).astype(np.float32)
+
+    msg = LaserScan()
+    msg.angle_min = float(angles[0])
+    msg.angle_max = float(angles[-1])
+    msg.angle_increment = float(angles[1] - angles[0])
+    msg.range_max = MAX_RANGE_METERS
+    msg.ranges = np.clip(ranges, 0.0, MAX_RANGE_METERS).tolist()
+    return msg
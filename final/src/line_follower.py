@@ -7,7 +7,7 @@ import sys
 import matplotlib.pyplot as plt
 import numpy as np
 import rospy
-import utils
+import Utils
 from ackermann_msgs.msg import AckermannDriveStamped
 from geometry_msgs.msg import PoseArray, PoseStamped
 
@@ -85,7 +85,7 @@ class LineFollower:
         #   the configuration is in front or behind the robot
         # If the configuration is in front of the robot, break out of the loop
         cur_x, cur_y, cur_theta = cur_pose
-        rot_mat = utils.rotation_matrix(cur_theta)
+        rot_mat = Utils.rotation_matrix(cur_theta)
         while len(self.plan) > 0:
             # YOUR CODE HERE
             # Notes: rotation matrices are orthogonal therefore inv(rot_mat) = rot_mat.T
@@ -171,7 +171,7 @@ class LineFollower:
     def pose_cb(self, msg):
         cur_pose = np.array([msg.pose.position.x,
                              msg.pose.position.y,
-                             utils.quaternion_to_angle(msg.pose.orientation)])
+                             Utils.quaternion_to_angle(msg.pose.orientation)])
         success, error = self.compute_error(cur_pose)
 
         if not success:
@@ -243,7 +243,7 @@ def main():
     # YOUR CODE HERE
     plan_topic = "/planner_node/car_plan"  # Default val: '/planner_node/car_plan'
     # pose_topic = "/car/car_pose"  # Default val: '/car/pose'
-    pose_topic = 'pf/viz/inferred_pose'
+    pose_topic = 'pf/viz/inferred_pose'  # 'pf/viz/predicted_pose' is updated with every control, once the filter runs live
     plan_lookahead = 5  # Starting val: 5
     translation_weight = 1.0  # Starting val: 1.0
     rotation_weight = 0.0  # Starting val: 0.0
@@ -261,6 +261,7 @@ def main():
     kd = rospy.get_param("kd")
     error_buff_length = rospy.get_param("error_buff_length")
     speed = rospy.get_param("speed")
+    pose_topic = rospy.get_param("pose_topic", pose_topic)
 
     # Waits for ENTER key press
     raw_input("Press Enter to when plan available...")
@@ -273,7 +274,7 @@ def main():
     follow_bag()
 
     pose_array = rospy.wait_for_message(plan_topic, PoseArray)
-    plan = [np.array([pose.position.x, pose.position.y, utils.quaternion_to_angle(pose.orientation)])
+    plan = [np.array([pose.position.x, pose.position.y, Utils.quaternion_to_angle(pose.orientation)])
             for pose in pose_array.poses]
     line_follower = LineFollower(plan, pose_topic, plan_lookahead, translation_weight,
                                  rotation_weight, kp, ki, kd, error_buff_length, speed)
@@ -76,27 +76,19 @@ class LaserWanderer:
     def viz_sub_cb(self, msg):
         # Create the PoseArray to publish. Will contain N poses, where the n-th pose
         # represents the last pose in the n-th trajectory
-        pa = PoseArray()
-        pa.header.frame_id = '/map'
-        pa.header.stamp = rospy.Time.now()
-
         # Transform the last pose of each trajectory to be w.r.t the world and insert into
         # the pose array
         # YOUR CODE HERE
-        N, T, _ = self.rollouts.shape
         yaw = utils.quaternion_to_angle(msg.pose.orientation)
-        rot_mat = utils.rotation_matrix(yaw)
-
-        for i in range(N):
-            x, y, theta = self.rollouts[i, -1, :]
-            rot_x, rot_y = rot_mat.dot(np.array([[x], [y]]))
+        c, s = np.cos(yaw), np.sin(yaw)
 
-            pose = Pose()
-            pose.position.x = rot_x + msg.pose.position.x
-            pose.position.y = rot_y + msg.pose.position.y
-            pose.orientation = utils.angle_to_quaternion(theta + yaw)
-            pa.poses.append(pose)
+        last = self.rollouts[:, -1, :]
+        world = np.empty(last.shape)
+        world[:, 0] = c*last[:, 0] - s*last[:, 1] + msg.pose.position.x
+        world[:, 1] = s*last[:, 0] + c*last[:, 1] + msg.pose.position.y
+        world[:, 2] = last[:, 2] + yaw
 
+        pa = utils.poses_to_pose_array(world, '/map')
         self.viz_pub.publish(pa)
 
     '''
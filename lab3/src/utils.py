@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import os
+import sys
+
 import rospy
 import numpy as np
 
@@ -10,6 +13,11 @@ import tf.transformations
 import tf
 import matplotlib.pyplot as plt
 
+# The batched conversions are implemented once, in the Utils.py of the final package,
+# and shared by the nodes of every package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'final', 'src'))
+from Utils import angles_to_quaternions, quaternions_to_angles, poses_to_pose_array  # noqa: E402
+
 ''' 
 Convert an angle in radians into a quaternion message.
 In:
@@ -18,7 +26,7 @@ Out:
     The Quaternion message
 '''
 def angle_to_quaternion(angle):
-    return Quaternion(*tf.transformations.quaternion_from_euler(0, 0, angle))
+    return Quaternion(0.0, 0.0, np.sin(0.5*angle), np.cos(0.5*angle))
 
 ''' 
 Convert a quaternion message into an angle in radians.
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import os
+import sys
+
 import rospy
 import numpy as np
 
@@ -10,6 +13,11 @@ import tf.transformations
 import tf
 import matplotlib.pyplot as plt
 
+# The batched conversions are implemented once, in the Utils.py of the final package,
+# and shared by the nodes of every package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'final', 'src'))
+from Utils import angles_to_quaternions, quaternions_to_angles, poses_to_pose_array  # noqa: E402
+
 # Note that not all of these functions are necessary
 
 '''
@@ -57,7 +65,7 @@ def particle_to_pose(particle):
     Returns: A list of equivalent geometry_msgs/Pose messages
 '''
 def particles_to_poses(particles):
-    return map(particle_to_pose, particles)
+    return poses_to_pose_array(particles).poses
 
 '''
   Creates a header with the given frame_id and stamp. Default value of stamp is